@@ -1,6 +1,6 @@
-from typing import NamedTuple
 import argparse
 import os
+from typing import NamedTuple
 
 
 class Args(NamedTuple):
@@ -17,6 +17,10 @@ class Args(NamedTuple):
     debug: bool
     acceleration: str
     engine_dir: str
+    frame_encoder: str
+    jpeg_quality: int
+    jpeg_subsampling: str
+    raw_frames: bool
     # ComfyUI 工作流特定参数
     model_path: str
     lora_path: str
@@ -35,6 +39,10 @@ TIMEOUT = float(os.environ.get("TIMEOUT", 0))
 SAFETY_CHECKER = os.environ.get("SAFETY_CHECKER", None) == "True"
 USE_TAESD = os.environ.get("USE_TAESD", "True") == "True"
 ENGINE_DIR = os.environ.get("ENGINE_DIR", "engines")
+FRAME_ENCODER = os.environ.get("FRAME_ENCODER", "auto")
+JPEG_QUALITY = int(os.environ.get("JPEG_QUALITY", 75))
+JPEG_SUBSAMPLING = os.environ.get("JPEG_SUBSAMPLING", "4:2:0")
+RAW_FRAMES = os.environ.get("RAW_FRAMES", "False") == "True"
 ACCELERATION = os.environ.get("ACCELERATION", "xformers")  # 默认使用 xformers，更稳定
 
 # ComfyUI 工作流默认参数
@@ -145,6 +153,42 @@ parser.add_argument(
     default=DEFAULT_LORA_STRENGTH_CLIP,
     help="LoRA strength for CLIP (Text Encoder)",
 )
+parser.add_argument(
+    "--frame-encoder",
+    dest="frame_encoder",
+    type=str,
+    default=FRAME_ENCODER,
+    choices=["auto", "pil", "turbojpeg", "torchvision"],
+    help="JPEG encoder for the MJPEG stream",
+)
+parser.add_argument(
+    "--jpeg-quality",
+    dest="jpeg_quality",
+    type=int,
+    default=JPEG_QUALITY,
+    help="Default JPEG quality of the stream, can be overridden per session",
+)
+parser.add_argument(
+    "--jpeg-subsampling",
+    dest="jpeg_subsampling",
+    type=str,
+    default=JPEG_SUBSAMPLING,
+    choices=["4:4:4", "4:2:2", "4:2:0"],
+    help="Default JPEG chroma subsampling, can be overridden per session",
+)
+parser.add_argument(
+    "--raw-frames",
+    dest="raw_frames",
+    action="store_true",
+    help="Accept raw RGB/I420 input frames in addition to JPEG",
+)
+parser.add_argument(
+    "--no-raw-frames",
+    dest="raw_frames",
+    action="store_false",
+    help="Only accept encoded (JPEG) input frames",
+)
+parser.set_defaults(raw_frames=RAW_FRAMES)
 parser.set_defaults(taesd=USE_TAESD)
 config = Args(**vars(parser.parse_args()))
 config.pretty_print()
@@ -1,30 +1,38 @@
-from fastapi import FastAPI, WebSocket, HTTPException, WebSocketDisconnect
-from fastapi.responses import StreamingResponse, JSONResponse
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from fastapi import Request
-
-import markdown2
-
-import logging
-import uuid
-import time
-from types import SimpleNamespace
 import asyncio
+import logging
+import mimetypes
 import os
+import sys
 import time
-import mimetypes
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Dict, Optional
+
+import markdown2
 import torch
+from fastapi import FastAPI, HTTPException, Query, Request, WebSocket
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from fastapi.staticfiles import StaticFiles
+
 
-from config import config, Args
-from util import pil_to_frame, bytes_to_pil
-from connection_manager import ConnectionManager, ServerFullException
+# the modules shared by the realtime demos live next to them
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from config import Args, config
+from realtime_common.connection_manager import ConnectionManager, ServerFullException
+from realtime_common.frame_encoder import FrameEncoder, create_frame_encoder
+from realtime_common.frame_protocol import RawFrameError, decode_frame, raw_frame_settings
+from realtime_common.telemetry import Telemetry
 from workflow import Pipeline
 
+
 # fix mime error on windows
 mimetypes.add_type("application/javascript", ".js")
 
 THROTTLE = 1.0 / 120
+ENCODE_WORKERS = 2
 # logging.basicConfig(level=logging.DEBUG)
 
 
@@ -34,8 +42,41 @@ class App:
         self.pipeline = pipeline
         self.app = FastAPI()
         self.conn_manager = ConnectionManager()
+        # JPEG decode/encode runs off the event loop, in parallel with inference
+        self.encode_executor = ThreadPoolExecutor(max_workers=ENCODE_WORKERS)
+        self.frame_encoders: Dict[uuid.UUID, FrameEncoder] = {}
+        self.telemetry = Telemetry()
+        # a single worker keeps GPU work serialized
+        self.inference_executor = ThreadPoolExecutor(max_workers=1)
         self.init_app()
 
+    def frame_headers(self, params: SimpleNamespace) -> Dict[str, str]:
+        headers = {
+            "X-Server-Latency-Ms": f"{(time.perf_counter() - params.received_at) * 1000:.1f}"
+        }
+        if params.seq is not None:
+            headers["X-Frame-Seq"] = str(params.seq)
+        if params.timestamp is not None:
+            headers["X-Client-Timestamp"] = str(params.timestamp)
+        return headers
+
+    def record_frame(
+        self,
+        user_id: uuid.UUID,
+        params: SimpleNamespace,
+        encoder: FrameEncoder,
+        send_start: float,
+    ):
+        send_end = time.perf_counter()
+        self.telemetry.observe("queue_wait", params.inference_start - params.received_at)
+        self.telemetry.observe(
+            "inference", params.inference_end - params.inference_start
+        )
+        self.telemetry.observe("encode", encoder.last_encode_time)
+        self.telemetry.observe("send", send_end - send_start)
+        self.telemetry.observe("server_latency", send_end - params.received_at)
+        self.telemetry.observe_output(user_id, params.seq)
+
     def init_app(self):
         self.app.add_middleware(
             CORSMiddleware,
@@ -45,6 +86,11 @@ class App:
             allow_headers=["*"],
         )
 
+        @self.app.on_event("shutdown")
+        async def shutdown_executors():
+            self.inference_executor.shutdown(wait=False)
+            self.encode_executor.shutdown(wait=False)
+
         @self.app.websocket("/api/ws/{user_id}")
         async def websocket_endpoint(user_id: uuid.UUID, websocket: WebSocket):
             try:
@@ -56,6 +102,8 @@ class App:
                 logging.error(f"Server Full: {e}")
             finally:
                 await self.conn_manager.disconnect(user_id)
+                self.frame_encoders.pop(user_id, None)
+                self.telemetry.remove_session(user_id)
                 logging.info(f"User disconnected: {user_id}")
 
         async def handle_websocket_data(user_id: uuid.UUID):
@@ -81,8 +129,13 @@ class App:
                     if data["status"] == "next_frame":
                         info = pipeline.Info()
                         params = await self.conn_manager.receive_json(user_id)
+                        # client stamps, raw frames carry their own in the frame header
+                        seq = params.pop("seq", None)
+                        timestamp = params.pop("timestamp", None)
                         params = pipeline.InputParams(**params)
                         params = SimpleNamespace(**params.dict())
+                        params.seq = seq
+                        params.timestamp = timestamp
                         if info.input_mode == "image":
                             image_data = await self.conn_manager.receive_bytes(user_id)
                             if len(image_data) == 0:
@@ -90,7 +143,33 @@ class App:
                                     user_id, {"status": "send_frame"}
                                 )
                                 continue
-                            params.image = bytes_to_pil(image_data)
+                            decode_start = time.perf_counter()
+                            try:
+                                (
+                                    params.image,
+                                    raw_seq,
+                                    raw_timestamp,
+                                ) = await asyncio.get_running_loop().run_in_executor(
+                                    self.encode_executor,
+                                    decode_frame,
+                                    image_data,
+                                    params.width,
+                                    params.height,
+                                    self.args.raw_frames,
+                                )
+                            except RawFrameError as e:
+                                logging.warning(f"Rejected raw frame: {e}, {user_id} ")
+                                await self.conn_manager.send_json(
+                                    user_id, {"status": "send_frame"}
+                                )
+                                continue
+                            self.telemetry.observe(
+                                "decode", time.perf_counter() - decode_start
+                            )
+                            if raw_seq is not None:
+                                params.seq = raw_seq
+                                params.timestamp = raw_timestamp
+                        params.received_at = time.perf_counter()
                         await self.conn_manager.update_data(user_id, params)
 
             except Exception as e:
@@ -100,13 +179,61 @@ class App:
         @self.app.get("/api/queue")
         async def get_queue_size():
             queue_size = self.conn_manager.get_user_count()
-            return JSONResponse({"queue_size": queue_size})
+            encoders = {
+                str(user_id): encoder.get_stats()
+                for user_id, encoder in self.frame_encoders.items()
+            }
+            return JSONResponse(
+                {
+                    "queue_size": queue_size,
+                    **self.conn_manager.get_stats(),
+                    "encoders": encoders,
+                }
+            )
+
+        @self.app.get("/api/metrics")
+        async def get_metrics():
+            snapshot = await asyncio.get_running_loop().run_in_executor(
+                None, self.telemetry.snapshot
+            )
+            return JSONResponse(snapshot)
+
+        @self.app.get("/metrics")
+        async def get_prometheus_metrics():
+            # pipeline stage durations, skipped frames, prompt encodes and memory;
+            # rendering reads device memory stats, so it stays off the event loop
+            metrics = await asyncio.get_running_loop().run_in_executor(
+                None, self.pipeline.stream.render_metrics
+            )
+            return PlainTextResponse(metrics, media_type="text/plain; version=0.0.4")
 
         @self.app.get("/api/stream/{user_id}")
-        async def stream(user_id: uuid.UUID, request: Request):
+        async def stream(
+            user_id: uuid.UUID,
+            request: Request,
+            quality: Optional[int] = Query(None, ge=1, le=100),
+            subsampling: Optional[str] = None,
+        ):
+            quality = quality or self.args.jpeg_quality
+            subsampling = subsampling or self.args.jpeg_subsampling
+            try:
+                encoder = create_frame_encoder(
+                    self.args.frame_encoder, quality=quality, subsampling=subsampling
+                )
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            except (ImportError, OSError, RuntimeError) as e:
+                logging.warning(
+                    f"Frame encoder {self.args.frame_encoder} is unavailable, using PIL: {e}"
+                )
+                encoder = create_frame_encoder(
+                    "pil", quality=quality, subsampling=subsampling
+                )
+            self.frame_encoders[user_id] = encoder
             try:
 
                 async def generate():
+                    loop = asyncio.get_running_loop()
                     while True:
                         last_time = time.time()
                         await self.conn_manager.send_json(
@@ -114,14 +241,40 @@ class App:
                         )
                         params = await self.conn_manager.get_latest_data(user_id)
                         if params is None:
+                            if not self.conn_manager.check_user(user_id):
+                                return
                             continue
-                        image = pipeline.predict(params)
+                        params.inference_start = time.perf_counter()
+                        image = await loop.run_in_executor(
+                            self.inference_executor, pipeline.predict, params
+                        )
+                        params.inference_end = time.perf_counter()
                         if image is None:
                             continue
-                        frame = pil_to_frame(image)
+                        frame = await loop.run_in_executor(
+                            self.encode_executor,
+                            encoder.encode_frame,
+                            image,
+                            self.frame_headers(params),
+                        )
+                        send_start = time.perf_counter()
                         yield frame
+                        self.record_frame(user_id, params, encoder, send_start)
+                        await self.conn_manager.send_json(
+                            user_id,
+                            {
+                                "status": "frame_info",
+                                "seq": params.seq,
+                                "timestamp": params.timestamp,
+                                "server_latency": time.perf_counter()
+                                - params.received_at,
+                            },
+                        )
                         if self.args.debug:
-                            print(f"Time taken: {time.time() - last_time}")
+                            print(
+                                f"Time taken: {time.time() - last_time}, "
+                                f"encode: {encoder.last_encode_time}"
+                            )
 
                 return StreamingResponse(
                     generate(),
@@ -141,12 +294,20 @@ class App:
                 page_content = markdown2.markdown(info.page_content)
 
             input_params = pipeline.InputParams.schema()
+            if self.args.raw_frames:
+                default_params = pipeline.InputParams()
+                raw_frame = raw_frame_settings(
+                    default_params.width, default_params.height
+                )
+            else:
+                raw_frame = None
             return JSONResponse(
                 {
                     "info": info_schema,
                     "input_params": input_params,
                     "max_queue_size": self.args.max_queue_size,
                     "page_content": page_content if info.page_content else "",
+                    "raw_frame": raw_frame,
                 }
             )
 
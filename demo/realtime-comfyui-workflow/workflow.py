@@ -1,8 +1,9 @@
-import sys
 import os
+import sys
 from pathlib import Path
 from typing import Dict, Optional
 
+
 sys.path.append(
     os.path.join(
         os.path.dirname(__file__),
@@ -11,13 +12,13 @@ sys.path.append(
     )
 )
 
-from utils.wrapper import StreamDiffusionWrapper
-
 import torch
-
 from config import Args
-from pydantic import BaseModel, Field
 from PIL import Image
+from pydantic import BaseModel, Field
+
+from utils.wrapper import StreamDiffusionWrapper
+
 
 # 默认模型（使用 sd-turbo，与 realtime-img2img 一致）
 base_model = "stabilityai/sd-turbo"
@@ -60,29 +61,29 @@ def calculate_t_index_list(steps: int, denoise: float, num_inference_steps: int
     """
     start_index = int(num_inference_steps * denoise)
     start_index = min(num_inference_steps - 1, max(0, start_index))
-    
+
     if steps == 1:
         return [start_index]
-    
+
     indices = []
     if steps > 1:
         step_size = start_index / (steps - 1)
     else:
         step_size = 0
-    
+
     for i in range(steps):
         idx = int(start_index - i * step_size)
         indices.append(max(0, idx))
-    
+
     indices = sorted(set(indices), reverse=True)
-    
+
     if start_index not in indices:
         indices.append(start_index)
     if 0 not in indices:
         indices.append(0)
-    
+
     indices = sorted(set(indices), reverse=True)
-    
+
     if len(indices) > steps:
         selected = [indices[0]]
         if steps > 2:
@@ -92,7 +93,7 @@ def calculate_t_index_list(steps: int, denoise: float, num_inference_steps: int
                 selected.append(idx)
         selected.append(indices[-1])
         indices = sorted(set(selected), reverse=True)
-    
+
     return indices
 
 
@@ -137,12 +138,12 @@ class Pipeline:
 
     def __init__(self, args: Args, device: torch.device, torch_dtype: torch.dtype):
         params = self.InputParams()
-        
+
         # 检查模型路径
         # 如果提供的是本地文件路径且不存在，尝试使用默认模型
         model_path_str = args.model_path
         model_path = Path(args.model_path)
-        
+
         # 检查是否是本地文件路径
         if not model_path.exists() and not model_path.is_absolute():
             # 尝试在常见路径中查找
@@ -159,7 +160,7 @@ class Pipeline:
                     found = True
                     print(f"找到模型文件: {model_path_str}")
                     break
-            
+
             # 如果本地文件不存在，且不是 HuggingFace ID 格式，使用默认模型
             if not found and "/" not in args.model_path and "\\" not in args.model_path:
                 print(f"警告: 未找到本地模型文件 {args.model_path}")
@@ -172,10 +173,11 @@ class Pipeline:
         else:
             model_path_str = str(args.model_path)
             print(f"使用模型路径: {model_path_str}")
-        
+
         # 判断是否是 SD-Turbo 模型
         is_turbo = "turbo" in model_path_str.lower()
-        
+        self.is_turbo = is_turbo
+
         # 计算 t_index_list（SD-Turbo 优化配置）
         if is_turbo:
             # SD-Turbo 性能优化：单步 [45] 最快（~94 fps），2步 [35, 45] 质量稍好但较慢
@@ -190,7 +192,7 @@ class Pipeline:
         else:
             t_index_list = calculate_t_index_list(params.steps, params.denoise)
             print(f"计算的 t_index_list: {t_index_list}")
-        
+
         # 准备 LoRA 字典
         lora_dict: Optional[Dict[str, float]] = None
         if args.lora_path:
@@ -217,7 +219,7 @@ class Pipeline:
                     print(f"找到 LoRA 文件: {lora_full_path}")
             else:
                 lora_dict = {str(lora_full_path): args.lora_strength_model}
-        
+
         self.stream = StreamDiffusionWrapper(
             model_id_or_path=model_path_str,
             lora_dict=lora_dict,
@@ -244,7 +246,7 @@ class Pipeline:
         self.last_steps = params.steps
         self.last_denoise = params.denoise
         self.last_seed = params.seed
-        
+
         # 准备模型
         self.stream.prepare(
             prompt=default_prompt,
@@ -260,10 +262,19 @@ class Pipeline:
             or params.negative_prompt != self.last_negative_prompt
             or params.cfg_scale != self.last_cfg_scale
         )
-        
+
+        # steps / denoise 变化时在线更新 t_index_list，无需重新创建 StreamDiffusionWrapper
+        # SD-Turbo 使用固定的 t_index_list
+        if not self.is_turbo and (
+            params.steps != self.last_steps or params.denoise != self.last_denoise
+        ):
+            t_index_list = calculate_t_index_list(params.steps, params.denoise)
+            print(f"更新 t_index_list: {t_index_list}")
+            self.stream.set_timesteps(t_index_list)
+            self.last_steps = params.steps
+            self.last_denoise = params.denoise
+
         if need_reprepare:
-            # 注意：StreamDiffusion 不支持动态修改 t_index_list
-            # 如果需要修改 steps 或 denoise，需要重新创建 StreamDiffusionWrapper
             # 这里只更新提示词和 CFG scale
             if params.cfg_scale != self.last_cfg_scale or params.negative_prompt != self.last_negative_prompt:
                 # 重新准备以更新 CFG scale 和 negative prompt
@@ -276,11 +287,11 @@ class Pipeline:
             else:
                 # 只更新 prompt
                 self.stream.update_prompt(params.prompt)
-            
+
             self.last_prompt = params.prompt
             self.last_negative_prompt = params.negative_prompt
             self.last_cfg_scale = params.cfg_scale
-        
+
         image_tensor = self.stream.preprocess_image(params.image)
         output_image = self.stream(image=image_tensor, prompt=params.prompt)
 
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from uuid import UUID
+
+from realtime_common.telemetry import Telemetry
+
+
+PredictBatch = Callable[[List[Tuple[UUID, SimpleNamespace]]], List[Any]]
+
+
+class BatchScheduler:
+    """
+    Collects the latest pending frame of every session and runs them as one
+    batched pipeline call on a single inference thread.
+
+    A batch is started as soon as ``max_batch_size`` sessions are pending or
+    ``max_wait`` seconds after the first pending frame, whichever comes first.
+    A session submitting a newer frame before its previous one was picked up
+    replaces it, and the older request resolves to ``None``.
+
+    Each request's params get ``inference_start`` and ``inference_end``
+    perf_counter stamps of the batch it ran in.
+    """
+
+    def __init__(
+        self,
+        predict_batch: PredictBatch,
+        max_batch_size: int = 1,
+        max_wait: float = 0,
+        telemetry: Optional[Telemetry] = None,
+    ):
+        self.predict_batch = predict_batch
+        self.telemetry = telemetry
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.pending: Dict[UUID, Tuple[SimpleNamespace, asyncio.Future]] = {}
+        self.has_pending = asyncio.Event()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        for user_id in list(self.pending):
+            self.cancel(user_id)
+        self.executor.shutdown(wait=False)
+
+    async def submit(self, user_id: UUID, params: SimpleNamespace) -> Optional[Any]:
+        self.cancel(user_id)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[user_id] = (params, future)
+        self.has_pending.set()
+        return await future
+
+    def cancel(self, user_id: UUID):
+        request = self.pending.pop(user_id, None)
+        if request is not None and not request[1].done():
+            request[1].set_result(None)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.has_pending.wait()
+            if not self.pending:
+                self.has_pending.clear()
+                continue
+
+            # give other sessions up to max_wait to join the batch
+            deadline = loop.time() + self.max_wait
+            while len(self.pending) < self.max_batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                self.has_pending.clear()
+                try:
+                    await asyncio.wait_for(self.has_pending.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+
+            user_ids = list(self.pending)[: self.max_batch_size]
+            batch = [(user_id, self.pending.pop(user_id)) for user_id in user_ids]
+            if self.pending:
+                self.has_pending.set()
+            else:
+                self.has_pending.clear()
+
+            requests = [(user_id, params) for user_id, (params, _) in batch]
+            inference_start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(
+                    self.executor, self.predict_batch, requests
+                )
+            except Exception as e:
+                logging.error(f"Batch Error: {e}")
+                results = [None] * len(batch)
+            inference_end = time.perf_counter()
+            for _, params in requests:
+                params.inference_start = inference_start
+                params.inference_end = inference_end
+            if self.telemetry is not None:
+                self.telemetry.batch_sizes.observe(len(batch))
+
+            for (_, (_, future)), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
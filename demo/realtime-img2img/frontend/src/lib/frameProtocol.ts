@@ -0,0 +1,31 @@
+import type { RawFrameSettings } from './types';
+
+let sequence = 0;
+
+// Packs canvas RGBA pixels into the server's raw frame format:
+// header (magic, version, format, reserved, width, height, seq, timestamp) + RGB bytes
+export function encodeRawFrame(settings: RawFrameSettings, rgba: Uint8ClampedArray): Blob {
+    const { width, height } = settings;
+    const numPixels = width * height;
+    const buffer = new ArrayBuffer(settings.header_size + numPixels * 3);
+    const view = new DataView(buffer);
+    for (let i = 0; i < settings.magic.length; i++) {
+        view.setUint8(i, settings.magic.charCodeAt(i));
+    }
+    view.setUint8(4, settings.version);
+    view.setUint8(5, settings.formats.rgb);
+    view.setUint16(6, 0, true);
+    view.setUint16(8, width, true);
+    view.setUint16(10, height, true);
+    view.setUint32(12, sequence, true);
+    view.setFloat64(16, performance.timeOrigin + performance.now(), true);
+    sequence = (sequence + 1) >>> 0;
+
+    const rgb = new Uint8Array(buffer, settings.header_size);
+    for (let i = 0, j = 0; j < rgb.length; i += 4, j += 3) {
+        rgb[j] = rgba[i];
+        rgb[j + 1] = rgba[i + 1];
+        rgb[j + 2] = rgba[i + 2];
+    }
+    return new Blob([buffer]);
+}
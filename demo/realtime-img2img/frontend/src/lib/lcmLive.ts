@@ -13,6 +13,10 @@ const initStatus: LCMLiveStatus = LCMLiveStatus.DISCONNECTED;
 
 export const lcmLiveStatus = writable<LCMLiveStatus>(initStatus);
 export const streamId = writable<string | null>(null);
+// glass-to-glass latency in ms of the last frame the server reported back
+export const frameLatency = writable<number | null>(null);
+
+let frameSeq = 0;
 
 let websocket: WebSocket | null = null;
 export const lcmLiveActions = {
@@ -47,8 +51,18 @@ export const lcmLiveActions = {
                             lcmLiveStatus.set(LCMLiveStatus.SEND_FRAME);
                             const streamData = getSreamdata();
                             websocket?.send(JSON.stringify({ status: "next_frame" }));
+                            frameSeq = (frameSeq + 1) >>> 0;
                             for (const d of streamData) {
-                                this.send(d);
+                                if (d && !(d instanceof Blob)) {
+                                    this.send({ ...d, seq: frameSeq, timestamp: performance.timeOrigin + performance.now() });
+                                } else {
+                                    this.send(d);
+                                }
+                            }
+                            break;
+                        case "frame_info":
+                            if (data.timestamp != null) {
+                                frameLatency.set(performance.timeOrigin + performance.now() - data.timestamp);
                             }
                             break;
                         case "wait":
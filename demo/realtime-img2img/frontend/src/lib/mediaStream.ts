@@ -1,4 +1,5 @@
 import { writable, type Writable, get } from 'svelte/store';
+import type { RawFrameSettings } from './types';
 
 export enum MediaStreamStatusEnum {
     INIT = "init",
@@ -10,6 +11,8 @@ export const onFrameChangeStore: Writable<{ blob: Blob }> = writable({ blob: new
 export const mediaDevices = writable<MediaDeviceInfo[]>([]);
 export const mediaStreamStatus = writable(MediaStreamStatusEnum.INIT);
 export const mediaStream = writable<MediaStream | null>(null);
+// set when the server accepts raw frames, null means JPEG frames
+export const rawFrameSettings = writable<RawFrameSettings | null>(null);
 
 export const mediaStreamActions = {
     async enumerateDevices() {
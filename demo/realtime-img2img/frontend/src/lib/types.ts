@@ -37,4 +37,13 @@ export interface PipelineInfo {
     input_mode: {
         default: PipelineMode;
     }
-}
\ No newline at end of file
+}
+export interface RawFrameSettings {
+    magic: string;
+    version: number;
+    header: string;
+    header_size: number;
+    formats: { [key: string]: number };
+    width: number;
+    height: number;
+}
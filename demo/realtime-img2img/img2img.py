@@ -1,5 +1,6 @@
-import sys
 import os
+import sys
+
 
 sys.path.append(
     os.path.join(
@@ -9,14 +10,19 @@ sys.path.append(
     )
 )
 
-from utils.wrapper import StreamDiffusionWrapper
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple, Union
+from uuid import UUID
 
+import numpy as np
 import torch
-
 from config import Args
-from pydantic import BaseModel, Field
 from PIL import Image
-import math
+from pydantic import BaseModel, Field
+
+from streamdiffusion.stream_state import StreamState
+from utils.wrapper import StreamDiffusionWrapper
+
 
 base_model = "stabilityai/sd-turbo"
 taesd_model = "madebyollin/taesd"
@@ -77,11 +83,11 @@ class Pipeline:
             device=device,
             dtype=torch_dtype,
             t_index_list=[35, 45],
-            frame_buffer_size=1,
+            frame_buffer_size=args.max_batch_size,
             width=params.width,
             height=params.height,
             use_lcm_lora=False,
-            output_type="pil",
+            output_type="uint8",
             warmup=10,
             vae_id=None,
             acceleration=args.acceleration,
@@ -95,6 +101,7 @@ class Pipeline:
         )
 
         self.last_prompt = default_prompt
+        self.states: Dict[Optional[UUID], StreamState] = {}
         self.stream.prepare(
             prompt=default_prompt,
             negative_prompt=default_negative_prompt,
@@ -102,8 +109,22 @@ class Pipeline:
             guidance_scale=1.2,
         )
 
-    def predict(self, params: "Pipeline.InputParams") -> Image.Image:
-        image_tensor = self.stream.preprocess_image(params.image)
-        output_image = self.stream(image=image_tensor, prompt=params.prompt)
+    def predict(self, params: "Pipeline.InputParams") -> Union[Image.Image, np.ndarray]:
+        return self.predict_batch([(None, params)])[0]
+
+    def predict_batch(
+        self, requests: List[Tuple[Optional[UUID], SimpleNamespace]]
+    ) -> List[Union[Image.Image, np.ndarray]]:
+        states = []
+        for user_id, params in requests:
+            state = self.states.get(user_id)
+            if state is None:
+                state = self.stream.create_state()
+                self.states[user_id] = state
+            state.prompt = params.prompt
+            states.append(state)
+        images = [params.image for _, params in requests]
+        return self.stream.img2img_batch(images, states)
 
-        return output_image
+    def drop_session(self, user_id: UUID):
+        self.states.pop(user_id, None)
@@ -1,9 +1,8 @@
+import io
 from importlib import import_module
 from types import ModuleType
-from typing import Dict, Any
-from pydantic import BaseModel as PydanticBaseModel, Field
+
 from PIL import Image
-import io
 
 
 def get_pipeline_class(pipeline_name: str) -> ModuleType:
@@ -22,6 +21,8 @@ def get_pipeline_class(pipeline_name: str) -> ModuleType:
 
 def bytes_to_pil(image_bytes: bytes) -> Image.Image:
     image = Image.open(io.BytesIO(image_bytes))
+    # decode now rather than lazily on whichever thread first touches the pixels
+    image.load()
     return image
 
 
@@ -1,12 +1,58 @@
-from typing import Dict, Union
-from uuid import UUID
 import asyncio
-from fastapi import WebSocket
-from starlette.websockets import WebSocketState
 import logging
 from types import SimpleNamespace
+from typing import Dict, Optional, Union
+from uuid import UUID
+
+from fastapi import WebSocket
+from starlette.websockets import WebSocketState
+
+
+class FrameMailbox:
+    """Single-slot mailbox that only keeps the most recent frame of a session.
 
-Connections = Dict[UUID, Dict[str, Union[WebSocket, asyncio.Queue]]]
+    A frame that arrives before the previous one was taken replaces it and
+    counts as dropped, so the frame handed to inference is never older than
+    one inference time.
+    """
+
+    def __init__(self):
+        self.data: Optional[SimpleNamespace] = None
+        self.event = asyncio.Event()
+        self.closed = False
+        self.received = 0
+        self.dropped = 0
+        self.processed = 0
+
+    def put(self, data: SimpleNamespace):
+        if self.data is not None:
+            self.dropped += 1
+        self.data = data
+        self.received += 1
+        self.event.set()
+
+    async def get(self) -> Optional[SimpleNamespace]:
+        await self.event.wait()
+        self.event.clear()
+        data, self.data = self.data, None
+        if data is not None:
+            self.processed += 1
+        return data
+
+    def close(self):
+        self.closed = True
+        self.data = None
+        self.event.set()
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "received": self.received,
+            "dropped": self.dropped,
+            "processed": self.processed,
+        }
+
+
+Connections = Dict[UUID, Dict[str, Union[WebSocket, FrameMailbox]]]
 
 
 class ServerFullException(Exception):
@@ -18,6 +64,12 @@ class ServerFullException(Exception):
 class ConnectionManager:
     def __init__(self):
         self.active_connections: Connections = {}
+        # counters of sessions that already disconnected
+        self.closed_stats: Dict[str, int] = {
+            "received": 0,
+            "dropped": 0,
+            "processed": 0,
+        }
 
     async def connect(
         self, user_id: UUID, websocket: WebSocket, max_queue_size: int = 0
@@ -33,7 +85,7 @@ class ConnectionManager:
         print(f"New user connected: {user_id}")
         self.active_connections[user_id] = {
             "websocket": websocket,
-            "queue": asyncio.Queue(),
+            "mailbox": FrameMailbox(),
         }
         await websocket.send_json(
             {"status": "connected", "message": "Connected"},
@@ -47,31 +99,36 @@ class ConnectionManager:
     async def update_data(self, user_id: UUID, new_data: SimpleNamespace):
         user_session = self.active_connections.get(user_id)
         if user_session:
-            queue = user_session["queue"]
-            await queue.put(new_data)
+            user_session["mailbox"].put(new_data)
 
-    async def get_latest_data(self, user_id: UUID) -> SimpleNamespace:
+    async def get_latest_data(self, user_id: UUID) -> Optional[SimpleNamespace]:
         user_session = self.active_connections.get(user_id)
         if user_session:
-            queue = user_session["queue"]
-            try:
-                return await queue.get()
-            except asyncio.QueueEmpty:
-                return None
+            return await user_session["mailbox"].get()
+        return None
 
     def delete_user(self, user_id: UUID):
         user_session = self.active_connections.pop(user_id, None)
         if user_session:
-            queue = user_session["queue"]
-            while not queue.empty():
-                try:
-                    queue.get_nowait()
-                except asyncio.QueueEmpty:
-                    continue
+            mailbox = user_session["mailbox"]
+            mailbox.close()
+            for key, value in mailbox.get_stats().items():
+                self.closed_stats[key] += value
 
     def get_user_count(self) -> int:
         return len(self.active_connections)
 
+    def get_stats(self) -> Dict[str, Union[int, Dict[str, Dict[str, int]]]]:
+        sessions = {
+            str(user_id): user_session["mailbox"].get_stats()
+            for user_id, user_session in self.active_connections.items()
+        }
+        totals = dict(self.closed_stats)
+        for session_stats in sessions.values():
+            for key, value in session_stats.items():
+                totals[key] += value
+        return {**totals, "sessions": sessions}
+
     def get_websocket(self, user_id: UUID) -> WebSocket:
         user_session = self.active_connections.get(user_id)
         if user_session:
@@ -0,0 +1,193 @@
+import io
+import time
+from typing import Dict, Optional, Union
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+Frame = Union[Image.Image, np.ndarray, torch.Tensor]
+
+SUBSAMPLING = ("4:4:4", "4:2:2", "4:2:0")
+
+
+def to_multipart_frame(jpeg: bytes, headers: Optional[Dict[str, str]] = None) -> bytes:
+    extra_headers = "".join(
+        f"{name}: {value}\r\n" for name, value in (headers or {}).items()
+    )
+    return b"".join(
+        [
+            b"--frame\r\nContent-Type: image/jpeg\r\n",
+            f"{extra_headers}Content-Length: {len(jpeg)}\r\n\r\n".encode(),
+            jpeg,
+            b"\r\n",
+        ]
+    )
+
+
+class FrameEncoder:
+    """Encodes output frames to JPEG for the MJPEG stream.
+
+    Frames can be PIL images or uint8 HWC arrays/tensors, as produced by
+    the pipeline with ``output_type="uint8"``. One encoder is created per
+    session, so quality and chroma subsampling can differ between sessions.
+    """
+
+    name = "base"
+
+    def __init__(self, quality: int = 75, subsampling: str = "4:2:0"):
+        if subsampling not in SUBSAMPLING:
+            raise ValueError(f"subsampling must be one of {SUBSAMPLING}")
+        if not 1 <= quality <= 100:
+            raise ValueError(f"quality must be between 1 and 100, got {quality}")
+        self.quality = quality
+        self.subsampling = subsampling
+        self.frames = 0
+        self.last_encode_time = 0.0
+        self.encode_time_ema = 0.0
+
+    def encode(self, frame: Frame) -> bytes:
+        raise NotImplementedError
+
+    def encode_frame(self, frame: Frame, headers: Optional[Dict[str, str]] = None) -> bytes:
+        start = time.perf_counter()
+        jpeg = self.encode(frame)
+        self.last_encode_time = time.perf_counter() - start
+        if self.frames == 0:
+            self.encode_time_ema = self.last_encode_time
+        else:
+            self.encode_time_ema = (
+                0.9 * self.encode_time_ema + 0.1 * self.last_encode_time
+            )
+        self.frames += 1
+        return to_multipart_frame(jpeg, headers)
+
+    def get_stats(self) -> Dict[str, Union[str, int, float]]:
+        return {
+            "encoder": self.name,
+            "frames": self.frames,
+            "last_encode_time": self.last_encode_time,
+            "encode_time_ema": self.encode_time_ema,
+        }
+
+
+def to_numpy(frame: Frame) -> np.ndarray:
+    if isinstance(frame, Image.Image):
+        return np.asarray(frame.convert("RGB"))
+    if isinstance(frame, torch.Tensor):
+        return frame.cpu().numpy()
+    return frame
+
+
+class PILFrameEncoder(FrameEncoder):
+    name = "pil"
+
+    def __init__(self, quality: int = 75, subsampling: str = "4:2:0"):
+        super().__init__(quality, subsampling)
+        # reused between frames instead of allocating a new buffer each time
+        self.buffer = io.BytesIO()
+
+    def encode(self, frame: Frame) -> bytes:
+        if not isinstance(frame, Image.Image):
+            frame = Image.fromarray(to_numpy(frame))
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        frame.save(
+            self.buffer,
+            format="JPEG",
+            quality=self.quality,
+            subsampling=self.subsampling,
+        )
+        return self.buffer.getvalue()
+
+
+class TurboJPEGFrameEncoder(FrameEncoder):
+    name = "turbojpeg"
+
+    def __init__(self, quality: int = 75, subsampling: str = "4:2:0"):
+        from turbojpeg import TJPF_RGB, TurboJPEG
+
+        super().__init__(quality, subsampling)
+        self.jpeg = TurboJPEG()
+        self.pixel_format = TJPF_RGB
+        # TJSAMP_444, TJSAMP_422 and TJSAMP_420
+        self.jpeg_subsample = SUBSAMPLING.index(subsampling)
+
+    def encode(self, frame: Frame) -> bytes:
+        return self.jpeg.encode(
+            np.ascontiguousarray(to_numpy(frame)),
+            quality=self.quality,
+            pixel_format=self.pixel_format,
+            jpeg_subsample=self.jpeg_subsample,
+        )
+
+
+class TorchvisionFrameEncoder(FrameEncoder):
+    """Encodes on the GPU with nvjpeg through torchvision.
+
+    torchvision only encodes 4:2:0, so the subsampling setting is ignored.
+    Frames already on the device are encoded in place; host frames are
+    uploaded first, which usually costs more than encoding on the CPU.
+    """
+
+    name = "torchvision"
+
+    def __init__(
+        self,
+        quality: int = 75,
+        subsampling: str = "4:2:0",
+        device: Optional[torch.device] = None,
+    ):
+        from torchvision.io import encode_jpeg
+
+        super().__init__(quality, subsampling)
+        self.encode_jpeg = encode_jpeg
+        self.device = device or torch.device("cuda")
+
+    def encode(self, frame: Frame) -> bytes:
+        if isinstance(frame, Image.Image):
+            frame = np.asarray(frame.convert("RGB"))
+        if isinstance(frame, np.ndarray):
+            frame = torch.from_numpy(frame)
+        frame = frame.to(self.device, non_blocking=True).permute(2, 0, 1).contiguous()
+        return self.encode_jpeg(frame, quality=self.quality).cpu().numpy().tobytes()
+
+
+ENCODERS = {
+    "pil": PILFrameEncoder,
+    "turbojpeg": TurboJPEGFrameEncoder,
+    "torchvision": TorchvisionFrameEncoder,
+}
+
+
+def torchvision_device_encode_available() -> bool:
+    if not torch.cuda.is_available():
+        return False
+    try:
+        import torchvision
+    except ImportError:
+        return False
+    # device side encode_jpeg landed in torchvision 0.19
+    version = tuple(int(part) for part in torchvision.__version__.split(".")[:2])
+    return version >= (0, 19)
+
+
+def create_frame_encoder(
+    name: str = "auto", quality: int = 75, subsampling: str = "4:2:0"
+) -> FrameEncoder:
+    """Creates a frame encoder by name.
+
+    ``auto`` prefers turbojpeg, then PIL. The pipeline hands over host
+    frames, so ``torchvision`` would upload every frame only to download the
+    JPEG again, and is only used when asked for by name.
+    """
+    if name == "torchvision" and not torchvision_device_encode_available():
+        raise RuntimeError("torchvision JPEG encoding needs CUDA and torchvision 0.19 or newer")
+    if name != "auto":
+        return ENCODERS[name](quality, subsampling)
+    try:
+        return TurboJPEGFrameEncoder(quality, subsampling)
+    except (ImportError, OSError, RuntimeError):
+        pass
+    return PILFrameEncoder(quality, subsampling)
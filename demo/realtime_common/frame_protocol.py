@@ -0,0 +1,109 @@
+import io
+import struct
+import warnings
+from typing import Dict, Optional, Tuple, Union
+
+import torch
+from PIL import Image
+
+
+# Raw input frames start with a fixed little-endian header followed by the
+# pixels at exactly the pipeline's width and height:
+#   magic (4s) version (B) format (B) reserved (H) width (H) height (H)
+#   sequence number (I) client timestamp in ms (d)
+# Anything without the magic is decoded as an encoded image (JPEG/PNG).
+RAW_FRAME_MAGIC = b"SDRF"
+RAW_FRAME_VERSION = 1
+RAW_FRAME_HEADER = struct.Struct("<4sBBHHHId")
+
+FORMAT_RGB = 0
+FORMAT_I420 = 1
+FORMATS = {"rgb": FORMAT_RGB, "i420": FORMAT_I420}
+
+
+class RawFrameError(ValueError):
+    """Exception raised when a raw frame does not match the negotiated format."""
+
+    pass
+
+
+def raw_frame_settings(width: int, height: int) -> Dict:
+    return {
+        "magic": RAW_FRAME_MAGIC.decode(),
+        "version": RAW_FRAME_VERSION,
+        "header": RAW_FRAME_HEADER.format,
+        "header_size": RAW_FRAME_HEADER.size,
+        "formats": FORMATS,
+        "width": width,
+        "height": height,
+    }
+
+
+def is_raw_frame(data: bytes) -> bool:
+    return data[: len(RAW_FRAME_MAGIC)] == RAW_FRAME_MAGIC
+
+
+def i420_to_rgb(pixels: torch.Tensor, width: int, height: int) -> torch.Tensor:
+    """Converts planar YUV 4:2:0 (BT.601 full range) to uint8 HWC RGB."""
+    if width % 2 or height % 2:
+        raise RawFrameError(f"I420 frames need an even size, got {width}x{height}")
+    luma_size = width * height
+    chroma_size = luma_size // 4
+    y = pixels[:luma_size].view(height, width).float()
+    u = pixels[luma_size : luma_size + chroma_size].view(height // 2, width // 2)
+    v = pixels[luma_size + chroma_size :].view(height // 2, width // 2)
+    u = u.repeat_interleave(2, 0).repeat_interleave(2, 1).float() - 128
+    v = v.repeat_interleave(2, 0).repeat_interleave(2, 1).float() - 128
+    rgb = torch.stack(
+        [y + 1.402 * v, y - 0.344136 * u - 0.714136 * v, y + 1.772 * u], dim=-1
+    )
+    return rgb.clamp_(0, 255).round_().to(torch.uint8)
+
+
+def decode_raw_frame(
+    data: bytes, width: int, height: int
+) -> Tuple[torch.Tensor, int, float]:
+    """Turns a raw frame into a uint8 HWC tensor without copying the pixels."""
+    if len(data) < RAW_FRAME_HEADER.size:
+        raise RawFrameError("Raw frame is shorter than its header")
+    _, version, frame_format, _, frame_width, frame_height, seq, timestamp = (
+        RAW_FRAME_HEADER.unpack_from(data)
+    )
+    if version != RAW_FRAME_VERSION:
+        raise RawFrameError(f"Unsupported raw frame version {version}")
+    if (frame_width, frame_height) != (width, height):
+        raise RawFrameError(
+            f"Raw frame is {frame_width}x{frame_height}, expected {width}x{height}"
+        )
+    if frame_format == FORMAT_RGB:
+        size = width * height * 3
+    elif frame_format == FORMAT_I420:
+        size = width * height * 3 // 2
+    else:
+        raise RawFrameError(f"Unknown raw frame format {frame_format}")
+    if len(data) != RAW_FRAME_HEADER.size + size:
+        raise RawFrameError(
+            f"Raw frame payload is {len(data) - RAW_FRAME_HEADER.size} bytes, expected {size}"
+        )
+
+    with warnings.catch_warnings():
+        # the bytes are read-only, but the pixels are never written in place
+        warnings.simplefilter("ignore", UserWarning)
+        pixels = torch.frombuffer(
+            data, dtype=torch.uint8, count=size, offset=RAW_FRAME_HEADER.size
+        )
+    if frame_format == FORMAT_RGB:
+        return pixels.view(height, width, 3), seq, timestamp
+    return i420_to_rgb(pixels, width, height), seq, timestamp
+
+
+def decode_frame(
+    data: bytes, width: int, height: int, allow_raw: bool = True
+) -> Tuple[Union[Image.Image, torch.Tensor], Optional[int], Optional[float]]:
+    """Decodes a raw frame, falling back to an encoded image."""
+    if allow_raw and is_raw_frame(data):
+        return decode_raw_frame(data, width, height)
+    image = Image.open(io.BytesIO(data))
+    # decode now rather than lazily on whichever thread first touches the pixels
+    image.load()
+    return image, None, None
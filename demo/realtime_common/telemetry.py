@@ -0,0 +1,104 @@
+import bisect
+from collections import deque
+from typing import Dict, List, Optional, Sequence
+
+
+# upper bounds in milliseconds, the last bucket catches everything above
+DEFAULT_BUCKETS_MS = (1, 2, 5, 10, 20, 35, 50, 75, 100, 150, 250, 500, 1000, 2500)
+
+
+class Histogram:
+    """Latency histogram with fixed buckets plus a window of recent samples
+    for percentiles."""
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS_MS, window: int = 1024):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.recent: deque = deque(maxlen=window)
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        self.recent.append(value)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.recent:
+            return None
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def snapshot(self) -> Dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "max": self.max,
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "buckets": {
+                **{str(le): n for le, n in zip(self.buckets, self.counts)},
+                "+Inf": self.counts[-1],
+            },
+        }
+
+
+class Telemetry:
+    """Per-stage latency histograms (in milliseconds) and frame counters
+    of the stream endpoint."""
+
+    STAGES: List[str] = [
+        "decode",
+        "queue_wait",
+        "inference",
+        "encode",
+        "send",
+        "server_latency",
+    ]
+
+    def __init__(self):
+        self.histograms: Dict[str, Histogram] = {
+            stage: Histogram() for stage in self.STAGES
+        }
+        self.batch_sizes = Histogram(buckets=(1, 2, 4, 8, 16))
+        self.counters: Dict[str, int] = {
+            "frames_out": 0,
+            # outputs whose sequence number is not newer than the previous one
+            "stale_frames": 0,
+            # input sequence numbers that never produced an output
+            "skipped_frames": 0,
+        }
+        self.last_seq: Dict[object, int] = {}
+
+    def observe(self, stage: str, seconds: float):
+        self.histograms[stage].observe(seconds * 1000)
+
+    def observe_output(self, session: object, seq: Optional[int]):
+        self.counters["frames_out"] += 1
+        if seq is None:
+            return
+        last_seq = self.last_seq.get(session)
+        if last_seq is not None:
+            if seq <= last_seq:
+                self.counters["stale_frames"] += 1
+                return
+            self.counters["skipped_frames"] += seq - last_seq - 1
+        self.last_seq[session] = seq
+
+    def remove_session(self, session: object):
+        self.last_seq.pop(session, None)
+
+    def snapshot(self) -> Dict:
+        return {
+            "latency_ms": {
+                stage: histogram.snapshot()
+                for stage, histogram in self.histograms.items()
+            },
+            "batch_size": self.batch_sizes.snapshot(),
+            **self.counters,
+        }
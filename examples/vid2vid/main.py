@@ -1,16 +1,19 @@
 import os
 import sys
-from typing import Literal, Dict, Optional
+from typing import Dict, Literal, Optional
 
 import fire
-import torch
-from torchvision.io import read_video, write_video
+import numpy as np
 from tqdm import tqdm
 
+
 sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
 
+from utils.sharded_video import process_video_sharded
+from utils.video_processor import probe_video, process_video
 from utils.wrapper import StreamDiffusionWrapper
 
+
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
@@ -24,6 +27,9 @@ def main(
     acceleration: Literal["none", "xformers", "tensorrt"] = "xformers",
     use_denoising_batch: bool = True,
     enable_similar_image_filter: bool = True,
+    frame_buffer_size: int = 1,
+    num_workers: int = 1,
+    chunk_size: int = 256,
     seed: int = 2,
 ):
 
@@ -53,50 +59,74 @@ def main(
     enable_similar_image_filter : bool, optional
         Whether to enable similar image filter or not,
         by default True.
+    frame_buffer_size : int, optional
+        The number of frames processed per model call, by default 1.
+    num_workers : int, optional
+        The number of worker processes, each loading its own model, that
+        process the clip in chunks, by default 1.
+    chunk_size : int, optional
+        The number of frames per chunk with several workers, by default 256.
     seed : int, optional
         The seed, by default 2. if -1, use random seed.
     """
-
-    video_info = read_video(input)
-    video = video_info[0] / 255
-    fps = video_info[2]["video_fps"]
-    height = int(video.shape[1] * scale)
-    width = int(video.shape[2] * scale)
-
-    stream = StreamDiffusionWrapper(
-        model_id_or_path=model_id,
-        lora_dict=lora_dict,
-        t_index_list=[35, 45],
-        frame_buffer_size=1,
-        width=width,
-        height=height,
-        warmup=10,
-        acceleration=acceleration,
-        do_add_noise=False,
-        mode="img2img",
-        output_type="pt",
-        enable_similar_image_filter=enable_similar_image_filter,
-        similar_image_filter_threshold=0.98,
-        use_denoising_batch=use_denoising_batch,
-        seed=seed,
-    )
-
-    stream.prepare(
-        prompt=prompt,
-        num_inference_steps=50,
-    )
-
-    video_result = torch.zeros(video.shape[0], height, width, 3)
-
-    for _ in range(stream.batch_size):
-        stream(image=video[0].permute(2, 0, 1))
-
-    for i in tqdm(range(video.shape[0])):
-        output_image = stream(video[i].permute(2, 0, 1))
-        video_result[i] = output_image.permute(1, 2, 0)
-
-    video_result = video_result * 255
-    write_video(output, video_result[2:], fps=fps)
+    if seed < 0:
+        # every worker has to use the same seed
+        seed = np.random.randint(0, 1000000)
+
+    video_width, video_height, _, total_frames = probe_video(input)
+    # the VAE works on multiples of 8
+    height = int(video_height * scale) // 8 * 8
+    width = int(video_width * scale) // 8 * 8
+
+    wrapper_kwargs = {
+        "model_id_or_path": model_id,
+        "lora_dict": lora_dict,
+        "t_index_list": [35, 45],
+        "frame_buffer_size": frame_buffer_size,
+        "width": width,
+        "height": height,
+        "warmup": 10,
+        "acceleration": acceleration,
+        "do_add_noise": False,
+        "mode": "img2img",
+        "output_type": "uint8",
+        "enable_similar_image_filter": enable_similar_image_filter,
+        "similar_image_filter_threshold": 0.98,
+        # skipped frames still advance the denoising batch, keeping the outputs aligned with the input frames
+        "similar_image_filter_skip_mode": "advance",
+        "use_denoising_batch": use_denoising_batch,
+        "seed": seed,
+    }
+    prepare_kwargs = {
+        "prompt": prompt,
+        "num_inference_steps": 50,
+    }
+
+    with tqdm(total=total_frames or None, unit="frame") as progress_bar:
+
+        def update_progress(stats):
+            progress_bar.n = stats.frames
+            progress_bar.set_postfix(fps=f"{stats.fps:.2f}")
+            progress_bar.refresh()
+
+        if num_workers > 1:
+            stats = process_video_sharded(
+                input,
+                output,
+                wrapper_kwargs,
+                prepare_kwargs,
+                num_workers=num_workers,
+                chunk_size=chunk_size,
+                seed=seed,
+                progress=update_progress,
+            )
+        else:
+            stream = StreamDiffusionWrapper(**wrapper_kwargs)
+            stream.prepare(**prepare_kwargs)
+            stats = process_video(
+                stream, input, output, progress=update_progress, seed=seed
+            )
+    print(stats)
 
 
 if __name__ == "__main__":
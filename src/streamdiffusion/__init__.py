@@ -1 +1,17 @@
-from .pipeline import StreamDiffusion
+from typing import TYPE_CHECKING
+
+
+if TYPE_CHECKING:
+    from .pipeline import StreamDiffusion
+
+__all__ = ["StreamDiffusion"]
+
+
+def __getattr__(name):
+    # the pipeline pulls in torch and diffusers, so it is only imported on first use;
+    # the engine cache and build plan modules work without them
+    if name == "StreamDiffusion":
+        from .pipeline import StreamDiffusion
+
+        return StreamDiffusion
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,507 @@
+"""
+A content-addressed cache of compiled engines.
+
+Engines are stored in one directory per cache key under the cache root,
+next to a JSON manifest recording their files, checksums, sizes and last
+use. The key hashes everything an engine depends on: the (fused) weights,
+the input profile, the build options and the toolchain versions. Changing
+a LoRA, a resolution or a TensorRT version yields a new key instead of
+silently reusing a stale engine, while renaming a model path does not.
+
+Nothing here imports TensorRT or needs a GPU, so keys and the manifest can
+be exercised with stand-in weights on any machine.
+
+Several processes can share a cache: manifest updates are serialized with
+a lock file, and building a missing engine holds a lock for its key, so
+concurrent workers build it once and the others pick it up.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional
+
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+
+def _tensor_bytes(value: Any) -> memoryview:
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return memoryview(value)
+    import numpy as np
+
+    if type(value).__module__.startswith("torch"):
+        import torch
+
+        # viewing as bytes also covers dtypes numpy lacks, such as bfloat16
+        value = value.detach().to("cpu").contiguous().flatten().view(torch.uint8).numpy()
+    return memoryview(np.ascontiguousarray(value)).cast("B")
+
+
+def hash_weights(state_dict: Mapping[str, Any]) -> str:
+    """
+    Hashes a state dict of tensors or arrays by name, dtype, shape and
+    content. Pass the weights after LoRA fusing so the hash follows them.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    for name in sorted(state_dict):
+        value = state_dict[name]
+        header = f"{name}|{getattr(value, 'dtype', '')}|{tuple(getattr(value, 'shape', ()))}"
+        digest.update(header.encode())
+        digest.update(_tensor_bytes(value))
+    return digest.hexdigest()
+
+
+def _describe_source(value: Any) -> Any:
+    if isinstance(value, str) and os.path.exists(value):
+        path = os.path.abspath(value)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            return {"path": path, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+        files = []
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            for file_name in sorted(names):
+                file_path = os.path.join(root, file_name)
+                stat = os.stat(file_path)
+                files.append([os.path.relpath(file_path, path), stat.st_size, stat.st_mtime_ns])
+        return {"path": path, "files": files}
+    if isinstance(value, Mapping):
+        return [[_describe_source(k), _describe_source(v)] for k, v in value.items()]
+    if isinstance(value, (list, tuple)):
+        return [_describe_source(v) for v in value]
+    return value
+
+
+def fingerprint_weights(sources: Mapping[str, Any]) -> str:
+    """
+    Returns a cheap fingerprint of where weights come from, to memoize their
+    hash with EngineCache.weights_hash instead of hashing them on every
+    start. Strings naming a local file or directory stand for the sizes and
+    modification times of its files, so a checkpoint changed in place gets
+    a new fingerprint. Anything else, such as hub ids and LoRA scales, is
+    taken as it is.
+    """
+    description = {name: _describe_source(value) for name, value in sources.items()}
+    canonical = json.dumps(description, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def toolchain_versions() -> Dict[str, Optional[str]]:
+    """
+    Returns the versions an engine build depends on: TensorRT, torch, CUDA
+    and the compute capability of the current GPU, None where unavailable.
+    """
+    versions: Dict[str, Optional[str]] = {
+        "tensorrt": None,
+        "torch": None,
+        "cuda": None,
+        "gpu_arch": None,
+    }
+    try:
+        import tensorrt
+
+        versions["tensorrt"] = tensorrt.__version__
+    except ImportError:
+        pass
+    try:
+        import torch
+
+        versions["torch"] = torch.__version__
+        versions["cuda"] = torch.version.cuda
+        if torch.cuda.is_available():
+            major, minor = torch.cuda.get_device_capability()
+            versions["gpu_arch"] = f"sm_{major}{minor}"
+    except ImportError:
+        pass
+    return versions
+
+
+def engine_key(
+    name: str,
+    weights_hash: str,
+    profile: Mapping[str, Any],
+    build_options: Mapping[str, Any],
+    toolchain: Optional[Mapping[str, Any]] = None,
+) -> str:
+    """
+    Returns the cache key of an engine.
+
+    Parameters
+    ----------
+    name : str
+        The engine kind, e.g. "unet" or "vae_decoder".
+    weights_hash : str
+        The hash of the weights, from hash_weights.
+    profile : Mapping[str, Any]
+        The input profile: batch sizes, resolution and input dimensions.
+    build_options : Mapping[str, Any]
+        The options passed to the engine builder.
+    toolchain : Optional[Mapping[str, Any]], optional
+        The toolchain versions, by default toolchain_versions().
+    """
+    if toolchain is None:
+        toolchain = toolchain_versions()
+    description = {
+        "name": name,
+        "weights": weights_hash,
+        "profile": dict(profile),
+        "build_options": dict(build_options),
+        "toolchain": dict(toolchain),
+    }
+    canonical = json.dumps(description, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class FileLock:
+    """
+    An exclusive lock on a file, held across processes. It is reentrant
+    within a process, so locked methods can call each other.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self) -> "FileLock":
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            try:
+                self._file = open(self.path, "a+")
+                _lock_file(self._file)
+            except BaseException:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                self._thread_lock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self._depth -= 1
+        if self._depth == 0:
+            _unlock_file(self._file)
+            self._file.close()
+            self._file = None
+        self._thread_lock.release()
+
+
+if os.name == "nt":
+    import msvcrt
+
+    def _lock_file(f) -> None:
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                # LK_LOCK gives up after about 10 seconds
+                continue
+
+    def _unlock_file(f) -> None:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+else:
+    import fcntl
+
+    def _lock_file(f) -> None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+    def _unlock_file(f) -> None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _dir_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            size += os.path.getsize(os.path.join(root, file))
+    return size
+
+
+class EngineCache:
+    """
+    A directory of engines indexed by a JSON manifest.
+
+    Usage::
+
+        cache = EngineCache("engines")
+        key = engine_key("unet", hash_weights(unet.state_dict()), profile, options)
+        engine_dir = cache.lookup(key)
+        if engine_dir is None:
+            with cache.lock_key(key, "unet"):
+                # another process may have built it while we waited
+                engine_dir = cache.lookup(key)
+                if engine_dir is None:
+                    engine_dir = cache.path_for(key, "unet")
+                    build(os.path.join(engine_dir, "unet.engine"))
+                    cache.register(key, "unet", ["unet.engine"], metadata=...)
+    """
+
+    def __init__(
+        self,
+        root: str,
+        max_bytes: Optional[int] = None,
+        max_entries: Optional[int] = None,
+    ) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        os.makedirs(root, exist_ok=True)
+        self.manifest_path = os.path.join(root, MANIFEST_NAME)
+        self._lock = FileLock(os.path.join(root, "manifest.lock"))
+        self._key_locks: Dict[str, FileLock] = {}
+
+    def _load(self) -> Dict[str, Any]:
+        if not os.path.exists(self.manifest_path):
+            return {"version": MANIFEST_VERSION, "entries": {}, "weights": {}}
+        with open(self.manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get("version") != MANIFEST_VERSION:
+            raise ValueError(
+                f"Unsupported engine cache manifest version {manifest.get('version')}"
+            )
+        return manifest
+
+    def _save(self, manifest: Dict[str, Any]) -> None:
+        # write then rename, so a crash never leaves a truncated manifest
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def lock_key(self, key: str, name: str) -> FileLock:
+        """
+        Returns the lock to hold while building the engine with this key.
+        Take it, check ``lookup`` again, and only build if still missing.
+        """
+        lock_name = f"{name}-{key[:16]}.lock"
+        if lock_name not in self._key_locks:
+            self._key_locks[lock_name] = FileLock(os.path.join(self.root, lock_name))
+        return self._key_locks[lock_name]
+
+    def path_for(self, key: str, name: str) -> str:
+        """
+        Returns the directory an engine with this key is built into.
+        """
+        path = os.path.join(self.root, f"{name}-{key[:16]}")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def weights_hash(self, fingerprint: str, compute: Callable[[], str]) -> str:
+        """
+        Returns the weights hash recorded for a fingerprint from
+        fingerprint_weights. The first time, ``compute`` is called to hash the
+        weights and its result is recorded, so each checkpoint is only hashed
+        once.
+        """
+        with self._lock:
+            weights_hash = self._load().get("weights", {}).get(fingerprint)
+        if weights_hash is not None:
+            return weights_hash
+        weights_hash = compute()
+        with self._lock:
+            manifest = self._load()
+            manifest.setdefault("weights", {})[fingerprint] = weights_hash
+            self._save(manifest)
+        return weights_hash
+
+    def entries(self) -> List[Dict[str, Any]]:
+        """
+        Lists the cached engines, most recently used first.
+        """
+        entries = [
+            {"key": key, **entry} for key, entry in self._load()["entries"].items()
+        ]
+        return sorted(entries, key=lambda entry: entry["last_used"], reverse=True)
+
+    def lookup(self, key: str, verify: bool = False) -> Optional[str]:
+        """
+        Returns the directory of a cached engine and marks it as used, or
+        None if it is missing or fails the integrity check. ``verify``
+        compares checksums instead of only sizes.
+        """
+        with self._lock:
+            manifest = self._load()
+            entry = manifest["entries"].get(key)
+            if entry is None:
+                return None
+            if not self._check(entry, verify):
+                self.remove(key)
+                return None
+            entry["last_used"] = time.time()
+            self._save(manifest)
+            return os.path.join(self.root, entry["path"])
+
+    def register(
+        self,
+        key: str,
+        name: str,
+        files: Iterable[str],
+        metadata: Optional[Mapping[str, Any]] = None,
+    ) -> str:
+        """
+        Records a freshly built engine, then evicts old engines if the cache
+        is over budget.
+
+        Parameters
+        ----------
+        key : str
+            The engine key, from engine_key.
+        name : str
+            The engine kind the directory was created for with path_for.
+        files : Iterable[str]
+            The artifacts in the directory to checksum, e.g. ["unet.engine"].
+        metadata : Optional[Mapping[str, Any]], optional
+            Anything worth showing when listing, e.g. the model id, profile
+            and toolchain, by default None.
+        """
+        path = self.path_for(key, name)
+        now = time.time()
+        entry = {
+            "name": name,
+            "path": os.path.relpath(path, self.root),
+            "files": {
+                file: {
+                    "size": os.path.getsize(os.path.join(path, file)),
+                    "sha256": _file_sha256(os.path.join(path, file)),
+                }
+                for file in files
+            },
+            "size": _dir_size(path),
+            "created": now,
+            "last_used": now,
+            "metadata": dict(metadata or {}),
+        }
+        with self._lock:
+            manifest = self._load()
+            manifest["entries"][key] = entry
+            self._save(manifest)
+            self.gc(keep=[key])
+        return path
+
+    def remove(self, key: str) -> None:
+        with self._lock:
+            manifest = self._load()
+            entry = manifest["entries"].pop(key, None)
+            if entry is None:
+                return
+            self._save(manifest)
+            shutil.rmtree(os.path.join(self.root, entry["path"]), ignore_errors=True)
+
+    def gc(
+        self,
+        max_bytes: Optional[int] = None,
+        max_entries: Optional[int] = None,
+        keep: Iterable[str] = (),
+    ) -> List[str]:
+        """
+        Evicts the least recently used engines until the cache fits the
+        budget, by default the one given at construction. Engines in
+        ``keep`` are never evicted. Returns the evicted keys.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        max_entries = self.max_entries if max_entries is None else max_entries
+        keep = set(keep)
+        with self._lock:
+            entries = self.entries()
+            total_size = sum(entry["size"] for entry in entries)
+
+            evicted = []
+            for entry in reversed(entries):
+                over_size = max_bytes is not None and total_size > max_bytes
+                over_count = (
+                    max_entries is not None and len(entries) - len(evicted) > max_entries
+                )
+                if not (over_size or over_count):
+                    break
+                if entry["key"] in keep:
+                    continue
+                self.remove(entry["key"])
+                total_size -= entry["size"]
+                evicted.append(entry["key"])
+        return evicted
+
+    def verify(self, key: str, full: bool = True) -> bool:
+        """
+        Checks that the files of an engine exist with the recorded sizes and,
+        with ``full``, checksums.
+        """
+        entry = self._load()["entries"].get(key)
+        return entry is not None and self._check(entry, full)
+
+    def verify_all(self, full: bool = True) -> List[str]:
+        """
+        Returns the keys of all engines that fail verification.
+        """
+        return [
+            key
+            for key, entry in self._load()["entries"].items()
+            if not self._check(entry, full)
+        ]
+
+    def _check(self, entry: Mapping[str, Any], full: bool) -> bool:
+        path = os.path.join(self.root, entry["path"])
+        for file, info in entry["files"].items():
+            file_path = os.path.join(path, file)
+            if not os.path.isfile(file_path):
+                return False
+            if os.path.getsize(file_path) != info["size"]:
+                return False
+            if full and _file_sha256(file_path) != info["sha256"]:
+                return False
+        return True
+
+
+def main() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect and prune an engine cache.")
+    parser.add_argument("root", help="the engine cache directory")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="list the cached engines")
+    gc_parser = subparsers.add_parser("gc", help="evict least recently used engines")
+    gc_parser.add_argument("--max-bytes", type=int, default=None)
+    gc_parser.add_argument("--max-entries", type=int, default=None)
+    verify_parser = subparsers.add_parser("verify", help="check the engine files")
+    verify_parser.add_argument("--remove", action="store_true", help="remove broken engines")
+    args = parser.parse_args()
+
+    cache = EngineCache(args.root)
+    if args.command == "list":
+        for entry in cache.entries():
+            last_used = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["last_used"]))
+            print(
+                f"{entry['key'][:16]}  {entry['name']:<12} {entry['size'] / 2**20:10.1f} MiB"
+                f"  last used {last_used}  {entry['path']}"
+            )
+    elif args.command == "gc":
+        for key in cache.gc(max_bytes=args.max_bytes, max_entries=args.max_entries):
+            print(f"evicted {key[:16]}")
+    elif args.command == "verify":
+        for key in cache.verify_all():
+            print(f"broken {key[:16]}")
+            if args.remove:
+                cache.remove(key)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+"""
+Planning of engine builds.
+
+A build is a set of steps, each producing artifacts from the artifacts of
+the steps it depends on (model -> ONNX -> optimized ONNX -> engine). The
+plan works out which steps are out of date, like make, and runs them with
+independent steps in parallel. Steps sharing a resource, e.g. the torch
+ONNX exporter or the TensorRT builder, never run at the same time.
+
+Nothing here imports TensorRT, so plans can be checked with stand-in
+steps on any machine.
+"""
+
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Literal,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+
+class DeploymentProfile:
+    """
+    The shapes a set of engines has to serve.
+
+    Parameters
+    ----------
+    height : int, optional
+        The image height, by default 512.
+    width : int, optional
+        The image width, by default 512.
+    unet_batch_range : Tuple[int, int], optional
+        The min and max UNet batch sizes, by default (1, 1).
+    vae_batch_range : Tuple[int, int], optional
+        The min and max VAE batch sizes, by default (1, 1).
+    opt_unet_batch_size : Optional[int], optional
+        The UNet batch size to optimize for, by default the max.
+    opt_vae_batch_size : Optional[int], optional
+        The VAE batch size to optimize for, by default the max.
+    min_image_resolution : int, optional
+        The smallest side supported with dynamic shapes, by default 256.
+    max_image_resolution : int, optional
+        The largest side supported with dynamic shapes, by default 1024.
+    dynamic_shape : bool, optional
+        Whether the engines accept any resolution between the min and the
+        max instead of only height x width, by default False.
+    resolutions : Optional[Sequence[Tuple[int, int]]], optional
+        (width, height) buckets to build one static-shape optimization
+        profile each for, instead of height x width or a dynamic shape.
+        The first bucket is used for the ONNX export and replaces height
+        and width, by default None.
+    """
+
+    def __init__(
+        self,
+        height: int = 512,
+        width: int = 512,
+        unet_batch_range: Tuple[int, int] = (1, 1),
+        vae_batch_range: Tuple[int, int] = (1, 1),
+        opt_unet_batch_size: Optional[int] = None,
+        opt_vae_batch_size: Optional[int] = None,
+        min_image_resolution: int = 256,
+        max_image_resolution: int = 1024,
+        dynamic_shape: bool = False,
+        resolutions: Optional[Sequence[Tuple[int, int]]] = None,
+    ) -> None:
+        if unet_batch_range[0] > unet_batch_range[1] or vae_batch_range[0] > vae_batch_range[1]:
+            raise ValueError("A batch range must be given as (min, max).")
+        self.height = height
+        self.width = width
+        self.unet_batch_range = tuple(unet_batch_range)
+        self.vae_batch_range = tuple(vae_batch_range)
+        self.opt_unet_batch_size = opt_unet_batch_size or unet_batch_range[1]
+        self.opt_vae_batch_size = opt_vae_batch_size or vae_batch_range[1]
+        self.min_image_resolution = min_image_resolution
+        self.max_image_resolution = max_image_resolution
+        self.dynamic_shape = dynamic_shape
+        self.resolutions = None
+        if resolutions:
+            self.resolutions = [tuple(resolution) for resolution in resolutions]
+            self.width, self.height = self.resolutions[0]
+            self.dynamic_shape = False
+            # the engine profiles are checked against the supported range
+            sides = [side for resolution in self.resolutions for side in resolution]
+            self.min_image_resolution = min(min_image_resolution, *sides)
+            self.max_image_resolution = max(max_image_resolution, *sides)
+
+    @staticmethod
+    def unet_batch_size(
+        frame_buffer_size: int,
+        denoising_steps_num: int,
+        cfg_type: Literal["none", "full", "self", "initialize"] = "self",
+        use_denoising_batch: bool = True,
+    ) -> int:
+        """
+        The UNet batch size of a pipeline configuration, as computed by
+        StreamDiffusion for its frame_buffer_size and t_index_list.
+        """
+        if not use_denoising_batch:
+            return frame_buffer_size
+        if cfg_type == "initialize":
+            return (denoising_steps_num + 1) * frame_buffer_size
+        if cfg_type == "full":
+            return 2 * denoising_steps_num * frame_buffer_size
+        return denoising_steps_num * frame_buffer_size
+
+    @classmethod
+    def for_pipeline(
+        cls,
+        height: int,
+        width: int,
+        denoising_steps_num: int,
+        frame_buffer_range: Tuple[int, int] = (1, 1),
+        cfg_type: Literal["none", "full", "self", "initialize"] = "self",
+        use_denoising_batch: bool = True,
+        mode: Literal["img2img", "txt2img"] = "img2img",
+        **kwargs: Any,
+    ) -> "DeploymentProfile":
+        """
+        The profile serving a pipeline with any frame_buffer_size in
+        ``frame_buffer_range``.
+        """
+        unet_batch_range = tuple(
+            cls.unet_batch_size(size, denoising_steps_num, cfg_type, use_denoising_batch)
+            for size in frame_buffer_range
+        )
+        if mode == "txt2img" and use_denoising_batch:
+            # txt2img decodes the whole denoising batch
+            vae_batch_range = tuple(denoising_steps_num * size for size in frame_buffer_range)
+        else:
+            vae_batch_range = tuple(frame_buffer_range)
+        return cls(
+            height=height,
+            width=width,
+            unet_batch_range=unet_batch_range,
+            vae_batch_range=vae_batch_range,
+            **kwargs,
+        )
+
+    @classmethod
+    def from_stream(
+        cls,
+        stream: Any,
+        frame_buffer_range: Optional[Tuple[int, int]] = None,
+        mode: Literal["img2img", "txt2img"] = "img2img",
+        **kwargs: Any,
+    ) -> "DeploymentProfile":
+        """
+        The profile of a StreamDiffusion instance, by default for its
+        current frame_buffer_size only.
+        """
+        if frame_buffer_range is None:
+            frame_buffer_range = (stream.frame_bff_size, stream.frame_bff_size)
+        return cls.for_pipeline(
+            stream.height,
+            stream.width,
+            stream.denoising_steps_num,
+            frame_buffer_range,
+            cfg_type=stream.cfg_type,
+            use_denoising_batch=stream.use_denoising_batch,
+            mode=mode,
+            **kwargs,
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(vars(self))
+
+
+class BuildStep:
+    """
+    One step of a build.
+
+    Parameters
+    ----------
+    name : str
+        The unique name of the step.
+    outputs : Sequence[str]
+        The files the step produces.
+    run : Callable[[], None]
+        Produces the outputs.
+    deps : Sequence[str], optional
+        The names of the steps whose outputs this step reads, by default ().
+    resource : Optional[str], optional
+        Steps with the same resource never run concurrently, by default None.
+    intermediate : bool, optional
+        Whether the outputs are only needed to produce later artifacts, so
+        a missing one is not rebuilt while everything after it is up to
+        date, by default False.
+    force : bool, optional
+        Whether the step runs even when it is up to date, by default False.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        outputs: Sequence[str],
+        run: Callable[[], None],
+        deps: Sequence[str] = (),
+        resource: Optional[str] = None,
+        intermediate: bool = False,
+        force: bool = False,
+    ) -> None:
+        self.name = name
+        self.outputs = list(outputs)
+        self.run = run
+        self.deps = list(deps)
+        self.resource = resource
+        self.intermediate = intermediate
+        self.force = force
+
+    def __repr__(self) -> str:
+        return f"BuildStep({self.name!r}, outputs={self.outputs}, deps={self.deps})"
+
+
+def _mtime(path: str) -> Optional[float]:
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+class EnginePlan:
+    """
+    A set of build steps with dependencies.
+    """
+
+    def __init__(self, steps: Iterable[BuildStep] = ()) -> None:
+        self.steps: Dict[str, BuildStep] = {}
+        for step in steps:
+            self.add(step)
+
+    def add(self, step: BuildStep) -> None:
+        if step.name in self.steps:
+            raise ValueError(f"Duplicate build step {step.name}")
+        self.steps[step.name] = step
+
+    def order(self) -> List[BuildStep]:
+        """
+        Returns the steps in dependency order.
+        """
+        ordered: List[BuildStep] = []
+        state: Dict[str, str] = {}
+
+        def visit(name: str, path: Tuple[str, ...]) -> None:
+            if name not in self.steps:
+                raise ValueError(f"Build step {path[-1]} depends on unknown step {name}")
+            if state.get(name) == "done":
+                return
+            if state.get(name) == "visiting":
+                raise ValueError(f"Dependency cycle: {' -> '.join(path + (name,))}")
+            state[name] = "visiting"
+            for dep in self.steps[name].deps:
+                visit(dep, path + (name,))
+            state[name] = "done"
+            ordered.append(self.steps[name])
+
+        for name in self.steps:
+            visit(name, ())
+        return ordered
+
+    def _is_stale(self, step: BuildStep) -> bool:
+        if step.force:
+            return True
+        output_times = [_mtime(output) for output in step.outputs]
+        if not output_times or any(mtime is None for mtime in output_times):
+            return True
+        input_times = [
+            mtime
+            for dep in step.deps
+            for mtime in map(_mtime, self.steps[dep].outputs)
+            if mtime is not None
+        ]
+        return bool(input_times) and max(input_times) > min(output_times)
+
+    def stale_steps(self, force: bool = False) -> List[BuildStep]:
+        """
+        Returns the steps that have to run, in dependency order.
+
+        A step runs if any output is missing or older than an output of its
+        dependencies, or if a later step needs its outputs rebuilt. Missing
+        intermediate outputs are ignored when nothing after them has to run.
+        """
+        ordered = self.order()
+        if force:
+            return ordered
+        dependents: Dict[str, List[str]] = {name: [] for name in self.steps}
+        for step in ordered:
+            for dep in step.deps:
+                dependents[dep].append(step.name)
+
+        needed: Set[str] = set()
+        for step in reversed(ordered):
+            if step.intermediate and dependents[step.name] and not step.force:
+                needed_by_dependent = any(
+                    dependent in needed for dependent in dependents[step.name]
+                )
+                if needed_by_dependent and self._is_stale(step):
+                    needed.add(step.name)
+            elif self._is_stale(step):
+                needed.add(step.name)
+
+        # a rebuilt step makes everything after it stale
+        for step in ordered:
+            if any(dep in needed for dep in step.deps):
+                needed.add(step.name)
+        return [step for step in ordered if step.name in needed]
+
+    def execute(
+        self,
+        max_workers: int = 1,
+        force: bool = False,
+        on_step: Optional[Callable[[BuildStep], None]] = None,
+    ) -> List[str]:
+        """
+        Runs the stale steps, up to ``max_workers`` at a time, and returns
+        their names in the order they finished.
+        """
+        pending = {step.name: step for step in self.stale_steps(force)}
+        # steps that are not scheduled at all were up to date
+        scheduled = set(pending)
+        finished: List[str] = []
+        done: Set[str] = set()
+        busy_resources: Set[str] = set()
+
+        def run(step: BuildStep) -> BuildStep:
+            if on_step is not None:
+                on_step(step)
+            for output in step.outputs:
+                os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+            step.run()
+            return step
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            running: Dict[Future, BuildStep] = {}
+            while pending or running:
+                for name, step in list(pending.items()):
+                    if len(running) >= max_workers:
+                        break
+                    ready = all(dep in done or dep not in scheduled for dep in step.deps)
+                    if not ready or step.resource in busy_resources:
+                        continue
+                    del pending[name]
+                    if step.resource is not None:
+                        busy_resources.add(step.resource)
+                    running[executor.submit(run, step)] = step
+                if not running:
+                    raise RuntimeError(f"Build steps cannot make progress: {list(pending)}")
+                completed, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    step = running.pop(future)
+                    busy_resources.discard(step.resource)
+                    # raises the step's error, after which the running steps are awaited
+                    future.result()
+                    done.add(step.name)
+                    finished.append(step.name)
+        return finished
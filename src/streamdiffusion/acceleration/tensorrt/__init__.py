@@ -1,5 +1,6 @@
 import gc
 import os
+from typing import Dict, Optional
 
 import torch
 from diffusers import AutoencoderKL, UNet2DConditionModel
@@ -9,9 +10,32 @@ from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion_img2img impo
 from polygraphy import cuda
 
 from ...pipeline import StreamDiffusion
+from ..engine_plan import BuildStep, DeploymentProfile, EnginePlan
 from .builder import EngineBuilder, create_onnx_path
 from .engine import AutoencoderKLEngine, UNet2DConditionModelEngine
 from .models import VAE, BaseModel, UNet, VAEEncoder
+from .utilities import build_engine, export_onnx, optimize_onnx
+
+
+# the options of plan_engines that change the built engine, and their defaults
+ENGINE_BUILD_DEFAULTS = {
+    "onnx_opset": 17,
+    "build_static_batch": False,
+    "build_all_tactics": False,
+    "build_enable_refit": False,
+}
+
+
+def engine_build_key_options(engine_build_options: dict = {}) -> dict:
+    """
+    Returns the options plan_engines builds with, defaults included, for
+    engine cache keys. The force flags only decide whether to rebuild, so
+    they are left out.
+    """
+    return {
+        name: engine_build_options.get(name, default)
+        for name, default in ENGINE_BUILD_DEFAULTS.items()
+    }
 
 
 class TorchVAEEncoder(torch.nn.Module):
@@ -82,6 +106,177 @@ def compile_unet(
     )
 
 
+def plan_engines(
+    engine_paths: Dict[str, str],
+    profile: DeploymentProfile,
+    unet: Optional[UNet2DConditionModel] = None,
+    vae: Optional[AutoencoderKL] = None,
+    embedding_dim: int = 768,
+    device: torch.device = torch.device("cuda"),
+    onnx_dir: Optional[str] = None,
+    engine_build_options: dict = {},
+) -> EnginePlan:
+    """
+    Plans the export, optimization and build of a set of engines.
+
+    Parameters
+    ----------
+    engine_paths : Dict[str, str]
+        The engine files to build by kind: "unet", "vae_decoder" and/or
+        "vae_encoder".
+    profile : DeploymentProfile
+        The resolution and batch ranges the engines have to serve.
+    unet : Optional[UNet2DConditionModel], optional
+        The UNet, needed for the "unet" engine.
+    vae : Optional[AutoencoderKL], optional
+        The VAE, needed for the VAE engines.
+    embedding_dim : int, optional
+        The text encoder hidden size, by default 768.
+    device : torch.device, optional
+        The device the models are exported on, by default cuda.
+    onnx_dir : Optional[str], optional
+        Where the ONNX files go, by default next to each engine.
+    engine_build_options : dict, optional
+        build_enable_refit, build_static_batch, build_all_tactics,
+        onnx_opset and the force_onnx_export, force_onnx_optimize and
+        force_engine_build flags of EngineBuilder.build.
+    """
+    options = dict(engine_build_options)
+    build_options = engine_build_key_options(options)
+    onnx_opset = build_options["onnx_opset"]
+    plan = EnginePlan()
+
+    def add_engine(name, model_data, load_network, cleanup=None):
+        engine_path = engine_paths[name]
+        if onnx_dir is None:
+            onnx_path, onnx_opt_path = engine_path + ".onnx", engine_path + ".opt.onnx"
+        else:
+            onnx_path = create_onnx_path(name, onnx_dir, opt=False)
+            onnx_opt_path = create_onnx_path(name, onnx_dir, opt=True)
+
+        def export():
+            try:
+                export_onnx(
+                    load_network(),
+                    onnx_path=onnx_path,
+                    model_data=model_data,
+                    opt_image_height=profile.height,
+                    opt_image_width=profile.width,
+                    opt_batch_size=profile.opt_unet_batch_size
+                    if name == "unet"
+                    else profile.opt_vae_batch_size,
+                    onnx_opset=onnx_opset,
+                )
+            finally:
+                if cleanup is not None:
+                    cleanup()
+
+        def optimize():
+            optimize_onnx(
+                onnx_path=onnx_path,
+                onnx_opt_path=onnx_opt_path,
+                model_data=model_data,
+            )
+
+        def build():
+            model_data.min_image_shape = profile.min_image_resolution
+            model_data.max_image_shape = profile.max_image_resolution
+            model_data.min_latent_shape = profile.min_image_resolution // 8
+            model_data.max_latent_shape = profile.max_image_resolution // 8
+            build_engine(
+                engine_path=engine_path,
+                onnx_opt_path=onnx_opt_path,
+                model_data=model_data,
+                opt_image_height=profile.height,
+                opt_image_width=profile.width,
+                opt_batch_size=profile.opt_unet_batch_size
+                if name == "unet"
+                else profile.opt_vae_batch_size,
+                build_static_batch=build_options["build_static_batch"],
+                build_dynamic_shape=profile.dynamic_shape,
+                build_all_tactics=build_options["build_all_tactics"],
+                build_enable_refit=build_options["build_enable_refit"],
+                image_sizes=profile.resolutions,
+            )
+            gc.collect()
+            torch.cuda.empty_cache()
+
+        # the torch exporter and the TensorRT builder are not safe to run concurrently
+        plan.add(
+            BuildStep(
+                f"{name}:onnx",
+                [onnx_path],
+                export,
+                resource="torch_export",
+                intermediate=True,
+                force=options.get("force_onnx_export", False),
+            )
+        )
+        plan.add(
+            BuildStep(
+                f"{name}:onnx_opt",
+                [onnx_opt_path],
+                optimize,
+                deps=[f"{name}:onnx"],
+                intermediate=True,
+                force=options.get("force_onnx_optimize", False),
+            )
+        )
+        plan.add(
+            BuildStep(
+                f"{name}:engine",
+                [engine_path],
+                build,
+                deps=[f"{name}:onnx_opt"],
+                resource="tensorrt",
+                force=options.get("force_engine_build", False),
+            )
+        )
+
+    unet_batch_range = profile.unet_batch_range
+    vae_batch_range = profile.vae_batch_range
+    if "unet" in engine_paths:
+        add_engine(
+            "unet",
+            UNet(
+                fp16=True,
+                device=device,
+                max_batch_size=unet_batch_range[1],
+                min_batch_size=unet_batch_range[0],
+                embedding_dim=embedding_dim,
+                unet_dim=unet.config.in_channels,
+            ),
+            lambda: unet.to(device, dtype=torch.float16),
+        )
+    if "vae_decoder" in engine_paths:
+
+        def load_vae_decoder():
+            vae.forward = vae.decode
+            return vae.to(device)
+
+        add_engine(
+            "vae_decoder",
+            VAE(
+                device=device,
+                max_batch_size=vae_batch_range[1],
+                min_batch_size=vae_batch_range[0],
+            ),
+            load_vae_decoder,
+            cleanup=lambda: delattr(vae, "forward") if "forward" in vars(vae) else None,
+        )
+    if "vae_encoder" in engine_paths:
+        add_engine(
+            "vae_encoder",
+            VAEEncoder(
+                device=device,
+                max_batch_size=vae_batch_range[1],
+                min_batch_size=vae_batch_range[0],
+            ),
+            lambda: TorchVAEEncoder(vae).to(device),
+        )
+    return plan
+
+
 def accelerate_with_tensorrt(
     stream: StreamDiffusion,
     engine_dir: str,
@@ -89,9 +284,31 @@ def accelerate_with_tensorrt(
     min_batch_size: int = 1,
     use_cuda_graph: bool = False,
     engine_build_options: dict = {},
+    profile: Optional[DeploymentProfile] = None,
+    max_workers: int = 2,
 ):
-    if "opt_batch_size" not in engine_build_options or engine_build_options["opt_batch_size"] is None:
-        engine_build_options["opt_batch_size"] = max_batch_size
+    """
+    Replaces the UNet and VAE of a StreamDiffusion instance with TensorRT
+    engines, building the ones that are missing or out of date.
+
+    The engines serve ``profile``, by default the stream resolution with
+    batch sizes from ``min_batch_size`` to ``max_batch_size`` for both the
+    UNet and the VAE. ``max_workers`` steps of the build run concurrently.
+    """
+    engine_build_options = dict(engine_build_options)
+    if profile is None:
+        batch_range = (min_batch_size, max_batch_size)
+        profile = DeploymentProfile(
+            height=stream.height,
+            width=stream.width,
+            unet_batch_range=batch_range,
+            vae_batch_range=batch_range,
+            opt_unet_batch_size=engine_build_options.get("opt_batch_size"),
+            opt_vae_batch_size=engine_build_options.get("opt_batch_size"),
+            min_image_resolution=engine_build_options.get("min_image_resolution", 256),
+            max_image_resolution=engine_build_options.get("max_image_resolution", 1024),
+            dynamic_shape=engine_build_options.get("build_dynamic_shape", False),
+        )
     text_encoder = stream.text_encoder
     unet = stream.unet
     vae = stream.vae
@@ -114,60 +331,26 @@ def accelerate_with_tensorrt(
     vae_encoder_engine_path = f"{engine_dir}/vae_encoder.engine"
     vae_decoder_engine_path = f"{engine_dir}/vae_decoder.engine"
 
-    unet_model = UNet(
-        fp16=True,
-        device=stream.device,
-        max_batch_size=max_batch_size,
-        min_batch_size=min_batch_size,
+    plan = plan_engines(
+        {
+            "unet": unet_engine_path,
+            "vae_decoder": vae_decoder_engine_path,
+            "vae_encoder": vae_encoder_engine_path,
+        },
+        profile,
+        unet=unet,
+        vae=vae,
         embedding_dim=text_encoder.config.hidden_size,
-        unet_dim=unet.config.in_channels,
-    )
-    vae_decoder_model = VAE(
-        device=stream.device,
-        max_batch_size=max_batch_size,
-        min_batch_size=min_batch_size,
+        device=torch.device("cuda"),
+        onnx_dir=onnx_dir,
+        engine_build_options=engine_build_options,
     )
-    vae_encoder_model = VAEEncoder(
-        device=stream.device,
-        max_batch_size=max_batch_size,
-        min_batch_size=min_batch_size,
+    plan.execute(
+        max_workers=max_workers,
+        on_step=lambda step: print(f"Building {step.outputs[0]}"),
     )
 
-    if not os.path.exists(unet_engine_path):
-        compile_unet(
-            unet,
-            unet_model,
-            create_onnx_path("unet", onnx_dir, opt=False),
-            create_onnx_path("unet", onnx_dir, opt=True),
-            unet_engine_path,
-            **engine_build_options,
-        )
-    else:
-        del unet
-
-    if not os.path.exists(vae_decoder_engine_path):
-        vae.forward = vae.decode
-        compile_vae_decoder(
-            vae,
-            vae_decoder_model,
-            create_onnx_path("vae_decoder", onnx_dir, opt=False),
-            create_onnx_path("vae_decoder", onnx_dir, opt=True),
-            vae_decoder_engine_path,
-            **engine_build_options,
-        )
-
-    if not os.path.exists(vae_encoder_engine_path):
-        vae_encoder = TorchVAEEncoder(vae).to(torch.device("cuda"))
-        compile_vae_encoder(
-            vae_encoder,
-            vae_encoder_model,
-            create_onnx_path("vae_encoder", onnx_dir, opt=False),
-            create_onnx_path("vae_encoder", onnx_dir, opt=True),
-            vae_encoder_engine_path,
-            **engine_build_options,
-        )
-
-    del vae
+    del unet, vae, plan
 
     cuda_stream = cuda.Stream()
 
@@ -10,14 +10,26 @@ from .utilities import Engine
 
 
 class UNet2DConditionModelEngine:
-    def __init__(self, filepath: str, stream: cuda.Stream, use_cuda_graph: bool = False):
+    def __init__(
+        self,
+        filepath: str,
+        stream: cuda.Stream,
+        use_cuda_graph: bool = False,
+        zero_copy: bool = True,
+    ):
         self.engine = Engine(filepath)
         self.stream = stream
         self.use_cuda_graph = use_cuda_graph
+        # bind matching input tensors directly instead of copying them
+        self.zero_copy = zero_copy
 
         self.engine.load()
         self.engine.activate()
 
+        min_shape, _, max_shape = self.engine.get_profile_shape("sample")
+        self.min_batch_size = min_shape[0]
+        self.max_batch_size = max_shape[0]
+
     def __call__(
         self,
         latent_model_input: torch.Tensor,
@@ -28,15 +40,14 @@ class UNet2DConditionModelEngine:
         if timestep.dtype != torch.float32:
             timestep = timestep.float()
 
-        self.engine.allocate_buffers(
-            shape_dict={
-                "sample": latent_model_input.shape,
-                "timestep": timestep.shape,
-                "encoder_hidden_states": encoder_hidden_states.shape,
-                "latent": latent_model_input.shape,
-            },
-            device=latent_model_input.device,
-        )
+        shape_dict = {
+            "sample": latent_model_input.shape,
+            "timestep": timestep.shape,
+            "encoder_hidden_states": encoder_hidden_states.shape,
+            "latent": latent_model_input.shape,
+        }
+        self.engine.select_profile(shape_dict, self.stream)
+        self.engine.allocate_buffers(shape_dict=shape_dict, device=latent_model_input.device)
 
         noise_pred = self.engine.infer(
             {
@@ -46,6 +57,7 @@ class UNet2DConditionModelEngine:
             },
             self.stream,
             use_cuda_graph=self.use_cuda_graph,
+            bind_inputs=self.zero_copy,
         )["latent"]
         return UNet2DConditionOutput(sample=noise_pred)
 
@@ -64,12 +76,14 @@ class AutoencoderKLEngine:
         stream: cuda.Stream,
         scaling_factor: int,
         use_cuda_graph: bool = False,
+        zero_copy: bool = True,
     ):
         self.encoder = Engine(encoder_path)
         self.decoder = Engine(decoder_path)
         self.stream = stream
         self.vae_scale_factor = scaling_factor
         self.use_cuda_graph = use_cuda_graph
+        self.zero_copy = zero_copy
 
         self.encoder.load()
         self.decoder.load()
@@ -77,42 +91,42 @@ class AutoencoderKLEngine:
         self.decoder.activate()
 
     def encode(self, images: torch.Tensor, **kwargs):
-        self.encoder.allocate_buffers(
-            shape_dict={
-                "images": images.shape,
-                "latent": (
-                    images.shape[0],
-                    4,
-                    images.shape[2] // self.vae_scale_factor,
-                    images.shape[3] // self.vae_scale_factor,
-                ),
-            },
-            device=images.device,
-        )
+        shape_dict = {
+            "images": images.shape,
+            "latent": (
+                images.shape[0],
+                4,
+                images.shape[2] // self.vae_scale_factor,
+                images.shape[3] // self.vae_scale_factor,
+            ),
+        }
+        self.encoder.select_profile(shape_dict, self.stream)
+        self.encoder.allocate_buffers(shape_dict=shape_dict, device=images.device)
         latents = self.encoder.infer(
             {"images": images},
             self.stream,
             use_cuda_graph=self.use_cuda_graph,
+            bind_inputs=self.zero_copy,
         )["latent"]
         return AutoencoderTinyOutput(latents=latents)
 
     def decode(self, latent: torch.Tensor, **kwargs):
-        self.decoder.allocate_buffers(
-            shape_dict={
-                "latent": latent.shape,
-                "images": (
-                    latent.shape[0],
-                    3,
-                    latent.shape[2] * self.vae_scale_factor,
-                    latent.shape[3] * self.vae_scale_factor,
-                ),
-            },
-            device=latent.device,
-        )
+        shape_dict = {
+            "latent": latent.shape,
+            "images": (
+                latent.shape[0],
+                3,
+                latent.shape[2] * self.vae_scale_factor,
+                latent.shape[3] * self.vae_scale_factor,
+            ),
+        }
+        self.decoder.select_profile(shape_dict, self.stream)
+        self.decoder.allocate_buffers(shape_dict=shape_dict, device=latent.device)
         images = self.decoder.infer(
             {"latent": latent},
             self.stream,
             use_cuda_graph=self.use_cuda_graph,
+            bind_inputs=self.zero_copy,
         )["images"]
         return DecoderOutput(sample=images)
 
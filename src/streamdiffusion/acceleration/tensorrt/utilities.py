@@ -83,6 +83,7 @@ class Engine:
     def __init__(
         self,
         engine_path,
+        max_buffer_pools=4,
     ):
         self.engine_path = engine_path
         self.engine = None
@@ -90,6 +91,15 @@ class Engine:
         self.buffers = OrderedDict()
         self.tensors = OrderedDict()
         self.cuda_graph_instance = None  # cuda graph
+        self.profile_index = 0
+        # bound buffers by (profile, device, shapes), most recently used last
+        self.buffer_pools = OrderedDict()
+        self.max_buffer_pools = max_buffer_pools
+        self.active_buffers = None
+        # the device address each binding is currently set to
+        self.bound_addresses = {}
+        # torch's handle on the stream the engine runs on, by stream pointer
+        self.torch_stream = None
 
     def __del__(self):
         [buf.free() for buf in self.buffers.values() if isinstance(buf, cuda.DeviceArray)]
@@ -212,11 +222,17 @@ class Engine:
         workspace_size=0,
     ):
         print(f"Building TensorRT engine for {onnx_path}: {self.engine_path}")
-        p = Profile()
-        if input_profile:
-            for name, dims in input_profile.items():
-                assert len(dims) == 3
-                p.add(name, min=dims[0], opt=dims[1], max=dims[2])
+        # a list of input profiles builds one optimization profile each
+        if not isinstance(input_profile, list):
+            input_profile = [input_profile]
+        profiles = []
+        for profile_dims in input_profile:
+            p = Profile()
+            if profile_dims:
+                for name, dims in profile_dims.items():
+                    assert len(dims) == 3
+                    p.add(name, min=dims[0], opt=dims[1], max=dims[2])
+            profiles.append(p)
 
         config_kwargs = {}
 
@@ -228,7 +244,7 @@ class Engine:
         engine = engine_from_network(
             network_from_onnx_path(onnx_path, flags=[trt.OnnxParserFlag.NATIVE_INSTANCENORM]),
             config=CreateConfig(
-                fp16=fp16, refittable=enable_refit, profiles=[p], load_timing_cache=timing_cache, **config_kwargs
+                fp16=fp16, refittable=enable_refit, profiles=profiles, load_timing_cache=timing_cache, **config_kwargs
             ),
             save_timing_cache=timing_cache,
         )
@@ -237,6 +253,28 @@ class Engine:
     def load(self):
         print(f"Loading TensorRT engine: {self.engine_path}")
         self.engine = engine_from_bytes(bytes_from_path(self.engine_path))
+        self._resolve_bindings()
+
+    def _resolve_bindings(self):
+        # TensorRT 8.5+ addresses I/O tensors by name, older versions by binding index;
+        # the variant is resolved once here instead of on every call
+        self.use_tensor_api = hasattr(self.engine, "get_tensor_name")
+        self.bindings = []
+        if self.use_tensor_api:
+            for idx in range(self.engine.num_io_tensors):
+                name = self.engine.get_tensor_name(idx)
+                dtype = trt.nptype(self.engine.get_tensor_dtype(name))
+                is_input = self.engine.get_tensor_mode(name) == trt.TensorIOMode.INPUT
+                self.bindings.append((idx, name, dtype, is_input))
+        else:
+            # binding indices are those of profile 0, see _binding_index
+            for idx in range(trt_util.get_bindings_per_profile(self.engine)):
+                name = self.engine[idx]
+                dtype = trt.nptype(self.engine.get_binding_dtype(name))
+                self.bindings.append((idx, name, dtype, self.engine.binding_is_input(name)))
+        self.input_names = {name for _, name, _, is_input in self.bindings if is_input}
+        self.output_names = [name for _, name, _, is_input in self.bindings if not is_input]
+        self.binding_indices = {name: idx for idx, name, _, _ in self.bindings}
 
     def activate(self, reuse_device_memory=None):
         if reuse_device_memory:
@@ -245,78 +283,155 @@ class Engine:
         else:
             self.context = self.engine.create_execution_context()
 
+    def select_profile(self, shape_dict, stream):
+        """
+        Switches to the first optimization profile accepting the input
+        shapes, for engines built with one profile per resolution bucket.
+        """
+        num_profiles = self.engine.num_optimization_profiles
+        if num_profiles == 1:
+            return
+        input_shapes = {
+            name: tuple(shape) for name, shape in shape_dict.items() if name in self.input_names
+        }
+        for index in range(num_profiles):
+            fits = True
+            for name, shape in input_shapes.items():
+                min_shape, _, max_shape = self.get_profile_shape(name, index)
+                if not all(lo <= dim <= hi for lo, dim, hi in zip(min_shape, shape, max_shape)):
+                    fits = False
+                    break
+            if fits:
+                if index != self.profile_index:
+                    self.context.set_optimization_profile_async(index, stream.ptr)
+                    self.profile_index = index
+                    # a captured graph is only valid for the shapes it was captured with
+                    self.cuda_graph_instance = None
+                    # the legacy API binds every profile under its own indices
+                    self.active_buffers = None
+                    self.bound_addresses = {}
+                return
+        raise ValueError(f"No optimization profile of {self.engine_path} accepts the shapes {input_shapes}")
+
+    def get_profile_shape(self, name, profile_index=0):
+        # returns the (min, opt, max) shapes of an input binding
+        if hasattr(self.engine, "get_tensor_profile_shape"):
+            return self.engine.get_tensor_profile_shape(name, profile_index)
+        return self.engine.get_profile_shape(profile_index, name)
+
+    def _default_shape(self, name):
+        if self.use_tensor_api:
+            return tuple(self.engine.get_tensor_shape(name))
+        return tuple(self.engine.get_binding_shape(name))
+
     def allocate_buffers(self, shape_dict=None, device="cuda"):
-        # 兼容不同版本的 polygraphy 和 TensorRT
-        # TensorRT 9.x 使用新的 API (num_io_tensors, get_tensor_name)
-        # TensorRT 8.x 使用旧的 API (num_bindings, binding_by_index)
-        try:
-            # 尝试使用 polygraphy 的工具函数（TensorRT 10.x）
-            num_bindings = trt_util.get_bindings_per_profile(self.engine)
-            use_new_api = False
-        except AttributeError:
-            # TensorRT 9.x 使用新的 API
-            num_bindings = self.engine.num_io_tensors
-            use_new_api = True
-        
-        for idx in range(num_bindings):
-            # TensorRT 9.x 使用 get_tensor_name，旧版本使用索引
-            if use_new_api or hasattr(self.engine, 'get_tensor_name'):
-                binding = self.engine.get_tensor_name(idx)
-            else:
-                binding = self.engine[idx]
-            
-            if shape_dict and binding in shape_dict:
-                shape = shape_dict[binding]
-            else:
-                if use_new_api or hasattr(self.engine, 'get_tensor_shape'):
-                    shape = self.engine.get_tensor_shape(binding)
-                else:
-                    shape = self.engine.get_binding_shape(binding)
-            
-            if use_new_api or hasattr(self.engine, 'get_tensor_dtype'):
-                dtype = trt.nptype(self.engine.get_tensor_dtype(binding))
-            else:
-                dtype = trt.nptype(self.engine.get_binding_dtype(binding))
-            
-            if use_new_api or hasattr(self.engine, 'get_tensor_mode'):
-                is_input = self.engine.get_tensor_mode(binding) == trt.TensorIOMode.INPUT
-            else:
-                is_input = self.engine.binding_is_input(binding)
-            
+        """
+        Binds I/O buffers for the given shapes. Buffers are pooled by shape,
+        so a shape seen before reuses its tensors, and while the shapes stay
+        the same nothing is reallocated or rebound at all.
+        """
+        shapes = tuple(
+            tuple(shape_dict[name]) if shape_dict and name in shape_dict else self._default_shape(name)
+            for _, name, _, _ in self.bindings
+        )
+        key = (self.profile_index, str(device), shapes)
+        if key == self.active_buffers:
+            return
+
+        tensors = self.buffer_pools.pop(key, None)
+        if tensors is None:
+            tensors = OrderedDict(
+                (name, torch.empty(shape, dtype=numpy_to_torch_dtype_dict[dtype], device=device))
+                for (_, name, dtype, _), shape in zip(self.bindings, shapes)
+            )
+        # least recently used pools are dropped first
+        self.buffer_pools[key] = tensors
+        while len(self.buffer_pools) > self.max_buffer_pools:
+            self.buffer_pools.popitem(last=False)
+        self.tensors = tensors
+
+        self.bound_addresses = {}
+        for (idx, name, _, is_input), shape in zip(self.bindings, shapes):
             if is_input:
-                if use_new_api or hasattr(self.context, 'set_input_shape'):
-                    self.context.set_input_shape(binding, shape)
+                if self.use_tensor_api:
+                    self.context.set_input_shape(name, shape)
                 else:
-                    self.context.set_binding_shape(idx, shape)
-            
-            tensor = torch.empty(tuple(shape), dtype=numpy_to_torch_dtype_dict[dtype]).to(device=device)
-            self.tensors[binding] = tensor
+                    self.context.set_binding_shape(self._binding_index(name), shape)
+            self._bind(name, tensors[name])
+        self.active_buffers = key
+
+    def _binding_index(self, name):
+        # each optimization profile has its own copy of the bindings, in profile order
+        return self.binding_indices[name] + self.profile_index * len(self.bindings)
+
+    def _bind(self, name, tensor):
+        address = tensor.data_ptr()
+        if self.bound_addresses.get(name) == address:
+            return
+        if self.use_tensor_api:
+            self.context.set_tensor_address(name, address)
+        else:
+            self.context.set_binding_address(self._binding_index(name), address)
+        self.bound_addresses[name] = address
+        # a captured graph is only valid for the addresses it was captured with
+        self.cuda_graph_instance = None
+
+    def _bind_mismatch(self, name, tensor):
+        # returns why a tensor cannot stand in for an engine buffer, or None
+        buffer = self.tensors[name]
+        if tensor.shape != buffer.shape:
+            raise ValueError(f"{name} has shape {tuple(tensor.shape)}, the engine expects {tuple(buffer.shape)}")
+        if tensor.dtype != buffer.dtype:
+            return f"dtype {tensor.dtype} instead of {buffer.dtype}"
+        if tensor.device != buffer.device:
+            return f"device {tensor.device} instead of {buffer.device}"
+        if not tensor.is_contiguous():
+            return "it is not contiguous"
+        # TensorRT requires 256-byte aligned I/O addresses, views into a larger tensor may not be
+        if tensor.data_ptr() % 256:
+            return "it is not 256-byte aligned"
+        return None
+
+    def infer(self, feed_dict, stream, use_cuda_graph=False, bind_inputs=False, outputs=None):
+        """
+        Runs the engine on the buffers set up by allocate_buffers.
+
+        With ``bind_inputs`` each feed tensor whose dtype, device and layout
+        match the engine's is bound directly instead of being copied into
+        the engine buffer; the others are still copied, which also casts
+        them. ``outputs`` maps output names to caller tensors the engine
+        writes into instead of its own buffers, they have to match exactly.
+        Bound tensors must stay unchanged until the engine is done with them;
+        their memory is not handed out again before then, even if the caller
+        drops them. CUDA graphs replay fixed addresses, so with
+        ``use_cuda_graph`` inputs are always copied and ``outputs`` is not
+        supported.
+        """
+        if use_cuda_graph and outputs:
+            raise ValueError("Caller-provided outputs cannot be used with CUDA graphs.")
+        bind_inputs = bind_inputs and not use_cuda_graph
 
-    def infer(self, feed_dict, stream, use_cuda_graph=False):
         for name, buf in feed_dict.items():
-            self.tensors[name].copy_(buf)
-
-        for name, tensor in self.tensors.items():
-            # TensorRT 9.x 使用 set_tensor_address，旧版本可能使用 set_binding_address
-            if hasattr(self.context, 'set_tensor_address'):
-                self.context.set_tensor_address(name, tensor.data_ptr())
-            elif hasattr(self.context, 'set_binding_address'):
-                # 对于旧版本，需要找到绑定的索引
-                binding_idx = None
-                if hasattr(self.engine, 'get_tensor_name'):
-                    for idx in range(self.engine.num_io_tensors):
-                        if self.engine.get_tensor_name(idx) == name:
-                            binding_idx = idx
-                            break
-                else:
-                    for idx in range(self.engine.num_bindings):
-                        if self.engine.get_binding_name(idx) == name:
-                            binding_idx = idx
-                            break
-                if binding_idx is not None:
-                    self.context.set_binding_address(binding_idx, tensor.data_ptr())
-                else:
-                    raise ValueError(f"Could not find binding index for tensor: {name}")
+            if bind_inputs and self._bind_mismatch(name, buf) is None:
+                self._bind(name, buf)
+                self._use_on_stream(buf, stream)
+            else:
+                self._bind(name, self.tensors[name])
+                self.tensors[name].copy_(buf)
+
+        for name in self.output_names:
+            tensor = self.tensors[name]
+            if outputs and name in outputs:
+                tensor = outputs[name]
+                mismatch = self._bind_mismatch(name, tensor)
+                if mismatch is not None:
+                    raise ValueError(f"Cannot write {name} into the given tensor: {mismatch}.")
+                self._use_on_stream(tensor, stream)
+            self._bind(name, tensor)
+        result = self.tensors
+        if outputs:
+            result = OrderedDict(self.tensors)
+            result.update(outputs)
 
         if use_cuda_graph:
             if self.cuda_graph_instance is not None:
@@ -339,7 +454,13 @@ class Engine:
             if not noerror:
                 raise ValueError("ERROR: inference failed.")
 
-        return self.tensors
+        return result
+
+    def _use_on_stream(self, tensor, stream):
+        # keeps the caching allocator from reusing a caller's tensor before the engine is done with it
+        if self.torch_stream is None or self.torch_stream.cuda_stream != stream.ptr:
+            self.torch_stream = torch.cuda.ExternalStream(stream.ptr, device=tensor.device)
+        tensor.record_stream(self.torch_stream)
 
 
 def decode_images(images: torch.Tensor):
@@ -427,6 +548,7 @@ def build_engine(
     build_dynamic_shape: bool = False,
     build_all_tactics: bool = False,
     build_enable_refit: bool = False,
+    image_sizes: Optional[List[Tuple[int, int]]] = None,
 ):
     _, free_mem, _ = cudart.cudaMemGetInfo()
     GiB = 2**30
@@ -436,13 +558,26 @@ def build_engine(
     else:
         max_workspace_size = 0
     engine = Engine(engine_path)
-    input_profile = model_data.get_input_profile(
-        opt_batch_size,
-        opt_image_height,
-        opt_image_width,
-        static_batch=build_static_batch,
-        static_shape=not build_dynamic_shape,
-    )
+    if image_sizes:
+        # one static-shape optimization profile per (width, height) bucket
+        input_profile = [
+            model_data.get_input_profile(
+                opt_batch_size,
+                image_height,
+                image_width,
+                static_batch=build_static_batch,
+                static_shape=True,
+            )
+            for image_width, image_height in image_sizes
+        ]
+    else:
+        input_profile = model_data.get_input_profile(
+            opt_batch_size,
+            opt_image_height,
+            opt_image_width,
+            static_batch=build_static_batch,
+            static_shape=not build_dynamic_shape,
+        )
     engine.build(
         onnx_opt_path,
         fp16=True,
@@ -1,45 +1,278 @@
-from typing import Optional
+import inspect
 import random
+import time
+from typing import Callable, Literal, Optional, Union
 
 import torch
+import torch.nn.functional as F
+
+
+# ITU-R BT.601 luma weights
+LUMA_WEIGHTS = (0.299, 0.587, 0.114)
+
+
+class SkipPolicy:
+    """
+    Decides whether the filter skips a frame, given its cosine similarity
+    to the last processed frame and the filter threshold.
+
+    ``update`` is told whether the frame was finally skipped, which can
+    differ from the decision when ``max_skip_frame`` forces a frame through.
+    ``similarity`` is a 0-dim tensor on the frame's device, converting it to
+    a Python number waits for the device.
+    """
+
+    # policies that ignore the similarity save the comparison entirely
+    needs_similarity = True
+
+    def should_skip(self, similarity: Optional[torch.Tensor], threshold: float) -> bool:
+        raise NotImplementedError
+
+    def update(self, skipped: bool) -> None:
+        pass
+
+    def reset(self) -> None:
+        pass
+
+
+class StochasticSkipPolicy(SkipPolicy):
+    """
+    Skips with a probability that rises from 0 at ``threshold`` to 1 for
+    identical frames. This is the original filter behaviour; pass a seed to
+    make the skipped frames reproducible.
+    """
+
+    def __init__(self, seed: Optional[int] = None) -> None:
+        self.seed = seed
+        self.random = random.Random(seed)
+
+    def should_skip(self, similarity: Optional[torch.Tensor], threshold: float) -> bool:
+        sample = self.random.uniform(0, 1)
+        if threshold >= 1:
+            return False
+        skip_prob = (1 - (1 - similarity) / (1 - threshold)).clamp(min=0)
+        return bool(skip_prob >= sample)
+
+    def reset(self) -> None:
+        self.random = random.Random(self.seed)
+
+
+class HysteresisSkipPolicy(SkipPolicy):
+    """
+    Starts skipping once the similarity reaches ``threshold`` and keeps
+    skipping until it drops below ``threshold - margin``, so frames hovering
+    around the threshold do not flicker between skipped and processed.
+    """
+
+    def __init__(self, margin: float = 0.01) -> None:
+        self.margin = margin
+        self.skipping = False
+
+    def should_skip(self, similarity: Optional[torch.Tensor], threshold: float) -> bool:
+        similarity = float(similarity)
+        if self.skipping:
+            self.skipping = similarity >= threshold - self.margin
+        else:
+            self.skipping = similarity >= threshold
+        return self.skipping
+
+    def reset(self) -> None:
+        self.skipping = False
+
+
+class MotionEMASkipPolicy(SkipPolicy):
+    """
+    Tracks an exponential moving average of the motion energy, one minus the
+    similarity, and skips while it stays below ``1 - threshold``. A single
+    changed frame after a static stretch does not end the skipping, a
+    sustained change does within a few frames.
+    """
+
+    def __init__(self, alpha: float = 0.5) -> None:
+        self.alpha = alpha
+        self.motion = None
+
+    def should_skip(self, similarity: Optional[torch.Tensor], threshold: float) -> bool:
+        motion = 1 - float(similarity)
+        if self.motion is None:
+            self.motion = motion
+        else:
+            self.motion = self.alpha * motion + (1 - self.alpha) * self.motion
+        return self.motion < 1 - threshold
+
+    def reset(self) -> None:
+        self.motion = None
+
+
+class TargetFPSSkipPolicy(SkipPolicy):
+    """
+    Skips just enough frames to hold ``target_fps`` processed frames per
+    second, regardless of similarity, with a token bucket of ``burst``
+    frames. ``clock`` returns seconds and can be replaced for testing or for
+    replaying recorded video at its own timestamps.
+    """
+
+    needs_similarity = False
+
+    def __init__(
+        self,
+        target_fps: float,
+        burst: float = 1,
+        clock: Callable[[], float] = time.perf_counter,
+    ) -> None:
+        self.target_fps = target_fps
+        self.burst = burst
+        self.clock = clock
+        self.reset()
+
+    def should_skip(self, similarity: Optional[torch.Tensor], threshold: float) -> bool:
+        now = self.clock()
+        if self.last_time is not None:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.last_time) * self.target_fps
+            )
+        self.last_time = now
+        return self.tokens < 1
+
+    def update(self, skipped: bool) -> None:
+        if not skipped:
+            self.tokens -= 1
+
+    def reset(self) -> None:
+        self.tokens = self.burst
+        self.last_time = None
+
+
+SKIP_POLICIES = {
+    "stochastic": StochasticSkipPolicy,
+    "hysteresis": HysteresisSkipPolicy,
+    "motion_ema": MotionEMASkipPolicy,
+    "target_fps": TargetFPSSkipPolicy,
+}
+
+
+def create_skip_policy(name: str = "stochastic", **kwargs) -> SkipPolicy:
+    """
+    Creates a skip policy by name: ``stochastic``, ``hysteresis``,
+    ``motion_ema`` or ``target_fps``, passing ``kwargs`` to its constructor.
+    ``target_fps`` needs a ``target_fps`` argument.
+    """
+    if name not in SKIP_POLICIES:
+        raise ValueError(
+            f"Unknown skip policy {name}, expected one of {list(SKIP_POLICIES)}"
+        )
+    policy_class = SKIP_POLICIES[name]
+    try:
+        signature = inspect.signature(policy_class).bind(**kwargs)
+    except TypeError as e:
+        raise ValueError(f"Invalid arguments for skip policy {name}: {e}") from None
+    return policy_class(*signature.args, **signature.kwargs)
 
 
 class SimilarImageFilter:
-    def __init__(self, threshold: float = 0.98, max_skip_frame: float = 10) -> None:
+    """
+    Skips frames that are similar to the last processed frame.
+
+    In ``full`` mode the frames are compared pixel by pixel. In ``thumbnail``
+    mode only a ``thumbnail_size`` x ``thumbnail_size`` luma thumbnail of each
+    frame is compared and kept, which is far cheaper at high resolutions.
+    Thumbnails smooth out fine detail, so the same threshold skips somewhat
+    more frames than in ``full`` mode. Either way the previous frame lives in
+    a buffer that is reused between frames.
+
+    Whether a frame is skipped is up to the skip ``policy``, by default the
+    original stochastic one. The policies that use the similarity read it
+    back to the host, a single element but a device sync on every frame;
+    only ``target_fps`` avoids it. At most ``max_skip_frame + 1`` frames in
+    a row are skipped whatever the policy decides, the next one is always
+    processed.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.98,
+        max_skip_frame: float = 10,
+        mode: Literal["full", "thumbnail"] = "full",
+        thumbnail_size: int = 32,
+        policy: Optional[SkipPolicy] = None,
+    ) -> None:
         self.threshold = threshold
         self.prev_tensor = None
         self.cos = torch.nn.CosineSimilarity(dim=0, eps=1e-6)
         self.max_skip_frame = max_skip_frame
         self.skip_count = 0
+        self.mode = mode
+        self.thumbnail_size = thumbnail_size
+        self._luma_weights = None
+        self.policy = policy if policy is not None else StochasticSkipPolicy()
 
     def __call__(self, x: torch.Tensor) -> Optional[torch.Tensor]:
-        if self.prev_tensor is None:
-            self.prev_tensor = x.detach().clone()
+        features = self._features(x)
+        if self.prev_tensor is None or self.prev_tensor.shape != features.shape:
+            self._store(features)
             return x
+
+        similarity = None
+        if self.policy.needs_similarity:
+            similarity = self.cos(self.prev_tensor, features)
+        skip = self.policy.should_skip(similarity, self.threshold)
+        if skip and self.skip_count > self.max_skip_frame:
+            skip = False
+        self.policy.update(skip)
+
+        # skip frame
+        if skip:
+            self.skip_count += 1
+            return None
+        # not skip frame
+        self.skip_count = 0
+        self._store(features)
+        return x
+
+    def _features(self, x: torch.Tensor) -> torch.Tensor:
+        if self.mode == "full":
+            return x.detach().reshape(-1)
+        if self.mode != "thumbnail":
+            raise ValueError(f"Unknown similar image filter mode {self.mode}")
+        x = x.detach()
+        if x.ndim == 3:
+            x = x[None]
+        if x.shape[1] == 3:
+            if self._luma_weights is None or self._luma_weights.device != x.device:
+                self._luma_weights = torch.tensor(
+                    LUMA_WEIGHTS, device=x.device, dtype=torch.float32
+                ).view(1, 3, 1, 1)
+            x = (x.float() * self._luma_weights).sum(dim=1, keepdim=True)
+        else:
+            x = x.float()
+        return F.adaptive_avg_pool2d(x, self.thumbnail_size).reshape(-1)
+
+    def _store(self, features: torch.Tensor) -> None:
+        if self.prev_tensor is None or self.prev_tensor.shape != features.shape:
+            self.prev_tensor = features.clone()
         else:
-            cos_sim = self.cos(self.prev_tensor.reshape(-1), x.reshape(-1)).item()
-            sample = random.uniform(0, 1)
-            if self.threshold >= 1:
-                skip_prob = 0
-            else:
-                skip_prob = max(0, 1 - (1 - cos_sim) / (1 - self.threshold))
-
-            # not skip frame
-            if skip_prob < sample:
-                self.prev_tensor = x.detach().clone()
-                return x
-            # skip frame
-            else:
-                if self.skip_count > self.max_skip_frame:
-                    self.skip_count = 0
-                    self.prev_tensor = x.detach().clone()
-                    return x
-                else:
-                    self.skip_count += 1
-                    return None
+            self.prev_tensor.copy_(features)
 
     def set_threshold(self, threshold: float) -> None:
         self.threshold = threshold
-    
+
     def set_max_skip_frame(self, max_skip_frame: float) -> None:
         self.max_skip_frame = max_skip_frame
+
+    def set_policy(self, policy: Union[str, SkipPolicy], **kwargs) -> None:
+        if isinstance(policy, str):
+            policy = create_skip_policy(policy, **kwargs)
+        elif kwargs:
+            raise ValueError("Policy arguments are only used with a policy name")
+        self.policy = policy
+        self.reset()
+
+    def reset(self) -> None:
+        self.prev_tensor = None
+        self.skip_count = 0
+        self.policy.reset()
+
+    def set_mode(self, mode: Literal["full", "thumbnail"]) -> None:
+        if mode != self.mode:
+            self.mode = mode
+            self.prev_tensor = None
@@ -1,4 +1,5 @@
-from typing import List, Optional, Tuple, Union
+import threading
+from typing import Dict, List, Optional, Tuple, Union
 
 import numpy as np
 import PIL.Image
@@ -24,13 +25,113 @@ def pt_to_numpy(images: torch.Tensor) -> np.ndarray:
     return images
 
 
+def denormalize_to_uint8(images: torch.Tensor) -> torch.Tensor:
+    """
+    Convert a [-1, 1] NCHW batch to uint8 NHWC on the same device, in a
+    single pass over the data.
+    """
+    # work in float32 so half precision inputs round the same way
+    if images.dtype == torch.float32:
+        images = images.mul(127.5)
+    else:
+        images = images.float().mul_(127.5)
+    images = images.add_(127.5).clamp_(0, 255).round_().to(torch.uint8)
+    return images.permute(0, 2, 3, 1).contiguous()
+
+
+class PinnedBufferPool:
+    """
+    Pinned host buffers for copies between host and device, reused by shape
+    and dtype instead of pinning fresh memory for every frame, which is
+    slow. Each shape gets a ring of ``depth`` buffers handed out in turn, so
+    a buffer is only handed out again ``depth`` requests of its shape later,
+    and not before the device has finished the copy recorded for it.
+    """
+
+    def __init__(self, depth: int = 1, max_shapes: int = 8) -> None:
+        self.depth = depth
+        self.max_shapes = max_shapes
+        self._rings: Dict[Tuple, List[torch.Tensor]] = {}
+        self._next: Dict[Tuple, int] = {}
+        self._events: Dict[int, "torch.cuda.Event"] = {}
+        self._lock = threading.Lock()
+
+    def get(self, shape: Tuple[int, ...], dtype: torch.dtype) -> torch.Tensor:
+        key = (tuple(shape), dtype)
+        with self._lock:
+            ring = self._rings.get(key)
+            if ring is None:
+                if len(self._rings) >= self.max_shapes:
+                    # the host allocator keeps dropped buffers alive until their copies finish
+                    self._rings.clear()
+                    self._next.clear()
+                    self._events.clear()
+                ring = self._rings[key] = []
+                self._next[key] = 0
+            index = self._next[key]
+            self._next[key] = (index + 1) % self.depth
+            if index == len(ring):
+                ring.append(torch.empty(shape, dtype=dtype, pin_memory=True))
+            buffer = ring[index]
+            event = self._events.pop(buffer.data_ptr(), None)
+        if event is not None:
+            event.synchronize()
+        return buffer
+
+    def record(self, buffer: torch.Tensor, event: "torch.cuda.Event") -> None:
+        """
+        Marks a buffer as in use by a copy until ``event`` completes.
+        """
+        with self._lock:
+            self._events[buffer.data_ptr()] = event
+
+
+# the pool of to_host calls without one, per thread
+_host_buffers = threading.local()
+
+
+def to_host(
+    images: torch.Tensor,
+    event: Optional["torch.cuda.Event"] = None,
+    pool: Optional[PinnedBufferPool] = None,
+) -> torch.Tensor:
+    """
+    Copy a tensor to the CPU through a pinned buffer from ``pool``. The
+    result is overwritten once the pool hands its buffer out again, after
+    ``pool.depth`` more copies of the same shape. Without a pool, a pool of
+    depth 1 per thread is used, so the result is only valid until the next
+    copy of that shape on the same thread.
+
+    Without ``event`` the copy is waited for before returning. Otherwise the
+    event is recorded after the copy, and the caller synchronizes on it
+    before reading the result.
+    """
+    if not images.is_cuda:
+        return images
+    if pool is None:
+        pool = getattr(_host_buffers, "pool", None)
+        if pool is None:
+            pool = _host_buffers.pool = PinnedBufferPool()
+    host_images = pool.get(images.shape, images.dtype)
+    host_images.copy_(images, non_blocking=True)
+    if event is not None:
+        event.record(torch.cuda.current_stream(images.device))
+        pool.record(host_images, event)
+    else:
+        copied = torch.cuda.Event()
+        copied.record(torch.cuda.current_stream(images.device))
+        copied.synchronize()
+    return host_images
+
+
 def numpy_to_pil(images: np.ndarray) -> PIL.Image.Image:
     """
     Convert a NumPy image or a batch of images to a PIL image.
     """
     if images.ndim == 3:
         images = images[None, ...]
-    images = (images * 255).round().astype("uint8")
+    if images.dtype != np.uint8:
+        images = (images * 255).round().astype("uint8")
     if images.shape[-1] == 1:
         # special case for grayscale (single channel) images
         pil_images = [
@@ -59,12 +160,22 @@ def postprocess_image(
     if do_denormalize is None:
         do_denormalize = [do_normalize_flg] * image.shape[0]
 
-    image = torch.stack(
-        [
-            denormalize(image[i]) if do_denormalize[i] else image[i]
-            for i in range(image.shape[0])
-        ]
-    )
+    if output_type in ("pil", "uint8") and all(do_denormalize):
+        # only the final uint8 pixels leave the device
+        image = denormalize_to_uint8(image).cpu().numpy()
+        if output_type == "uint8":
+            return image
+        return numpy_to_pil(image)
+
+    if all(do_denormalize):
+        image = denormalize(image)
+    else:
+        image = torch.stack(
+            [
+                denormalize(image[i]) if do_denormalize[i] else image[i]
+                for i in range(image.shape[0])
+            ]
+        )
 
     if output_type == "pt":
         return image
@@ -74,9 +185,14 @@ def postprocess_image(
     if output_type == "np":
         return image
 
+    if output_type == "uint8":
+        return (image * 255).round().clip(0, 255).astype("uint8")
+
     if output_type == "pil":
         return numpy_to_pil(image)
 
+    raise ValueError(f"Unknown output type {output_type}")
+
 
 def process_image(
     image_pil: PIL.Image.Image, range: Tuple[int, int] = (-1, 1)
@@ -99,3 +215,29 @@ def pil2tensor(image_pil: PIL.Image.Image) -> torch.Tensor:
     )
     image_tensors = images.to(torch.float16)
     return image_tensors
+
+
+def nearest_resolution_bucket(
+    buckets: List[Tuple[int, int]], width: int, height: int
+) -> Tuple[int, int]:
+    """
+    Returns the smallest (width, height) bucket that contains the given
+    resolution, so padding to it wastes the least compute.
+    """
+    fitting = [bucket for bucket in buckets if bucket[0] >= width and bucket[1] >= height]
+    if not fitting:
+        raise ValueError(f"No resolution bucket in {list(buckets)} fits {width}x{height}.")
+    return min(fitting, key=lambda bucket: bucket[0] * bucket[1])
+
+
+def pad_to_size(x: torch.Tensor, height: int, width: int) -> torch.Tensor:
+    """
+    Pads an NCHW batch at the bottom and right to height x width by
+    repeating the edge, which disturbs the convolutions near the border
+    less than zeros.
+    """
+    pad_height = height - x.shape[-2]
+    pad_width = width - x.shape[-1]
+    if pad_height == 0 and pad_width == 0:
+        return x
+    return torch.nn.functional.pad(x, (0, pad_width, 0, pad_height), mode="replicate")
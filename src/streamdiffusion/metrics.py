@@ -0,0 +1,246 @@
+import bisect
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+import torch
+
+from streamdiffusion.timer import Timer, create_timer
+
+
+# upper bounds in seconds
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.02,
+    0.035,
+    0.05,
+    0.075,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class _Family:
+    def __init__(
+        self, kind: str, help: str, buckets: Optional[Sequence[float]] = None
+    ) -> None:
+        self.kind = kind
+        self.help = help
+        self.buckets = buckets
+        self.values: Dict[Labels, Union[float, Histogram]] = OrderedDict()
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and histograms of a StreamDiffusion pipeline, rendered
+    in the Prometheus text exposition format.
+
+    Stage durations are measured with the device timer and resolved lazily,
+    so timing a stage never forces a device synchronization; durations show
+    up once the device has finished the work. Timers are recycled per stage
+    once their duration is recorded, so steady-state timing creates no new
+    events. The registry may be shared by the threads of a staged stream.
+    """
+
+    def __init__(
+        self,
+        device: Optional[Union[str, torch.device]] = None,
+        prefix: str = "streamdiffusion",
+        enabled: bool = True,
+    ) -> None:
+        self.device = device
+        self.prefix = prefix
+        self.enabled = enabled
+        self._families: Dict[str, _Family] = OrderedDict()
+        # stages whose timers the device has not finished yet
+        self._pending: List[Tuple[str, Timer]] = []
+        self._timer_pool: Dict[str, List[Timer]] = {}
+        self._lock = threading.RLock()
+
+        self.describe(
+            "stage_seconds", "histogram", "Duration of a pipeline stage in seconds."
+        )
+        self.describe("frames_total", "counter", "Frames processed.")
+        self.describe(
+            "similar_filter_skipped_total",
+            "counter",
+            "Frames skipped by the similar image filter.",
+        )
+        self.describe(
+            "prompt_encodes_total", "counter", "Prompts run through the text encoder."
+        )
+        self.describe(
+            "prompt_cache_hits_total", "counter", "Prompts served from the prompt cache."
+        )
+        self.describe(
+            "inference_time_ema_seconds",
+            "gauge",
+            "Exponential moving average of the inference time in seconds.",
+        )
+        self.describe(
+            "memory_allocated_bytes", "gauge", "Device memory currently allocated."
+        )
+        self.describe(
+            "memory_peak_bytes", "gauge", "High-water mark of allocated device memory."
+        )
+
+    def describe(
+        self,
+        name: str,
+        kind: str,
+        help: str,
+        buckets: Optional[Sequence[float]] = None,
+    ) -> None:
+        if name not in self._families:
+            self._families[name] = _Family(
+                kind, help, buckets if buckets is not None else DEFAULT_BUCKETS
+            )
+
+    def inc(self, name: str, amount: float = 1, **labels: str) -> None:
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._family(name, "counter")
+            family.values[key] = family.values.get(key, 0) + amount
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            family = self._family(name, "gauge")
+            family.values[tuple(sorted(labels.items()))] = value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._family(name, "histogram")
+            histogram = family.values.get(key)
+            if histogram is None:
+                histogram = family.values[key] = Histogram(family.buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def time_stage(self, stage: str) -> Iterator[None]:
+        """
+        Times the enclosed block as ``stage_seconds{stage=...}``.
+        """
+        if not self.enabled:
+            yield
+            return
+        with self._lock:
+            pool = self._timer_pool.setdefault(stage, [])
+            timer = pool.pop() if pool else create_timer(self.device)
+        timer.start()
+        try:
+            yield
+        finally:
+            timer.stop()
+            with self._lock:
+                self._pending.append((stage, timer))
+            self.flush(block=False)
+
+    def flush(self, block: bool = True) -> None:
+        """
+        Records the durations of finished stages. With ``block=False``,
+        stages whose device work is still running are left pending.
+        """
+        with self._lock:
+            while self._pending:
+                stage, timer = self._pending[0]
+                if not block and not timer.ready():
+                    break
+                self._pending.pop(0)
+                self.observe("stage_seconds", timer.elapsed(), stage=stage)
+                self._timer_pool.setdefault(stage, []).append(timer)
+
+    def update_memory(self) -> None:
+        if self.device is None or torch.device(self.device).type != "cuda":
+            return
+        self.set("memory_allocated_bytes", torch.cuda.memory_allocated(self.device))
+        self.set("memory_peak_bytes", torch.cuda.max_memory_allocated(self.device))
+
+    def get(self, name: str, **labels: str) -> Optional[Union[float, Histogram]]:
+        family = self._families.get(name)
+        if family is None:
+            return None
+        return family.values.get(tuple(sorted(labels.items())))
+
+    def reset(self) -> None:
+        with self._lock:
+            self._pending.clear()
+            for family in self._families.values():
+                family.values.clear()
+
+    def render(self) -> str:
+        """
+        Returns all metrics in the Prometheus text exposition format. Stages
+        whose device work is still running are left for the next render
+        instead of waiting for the device.
+        """
+        self.flush(block=False)
+        self.update_memory()
+        with self._lock:
+            return self._render()
+
+    def _render(self) -> str:
+        lines = []
+        for name, family in self._families.items():
+            full_name = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {full_name} {family.help}")
+            lines.append(f"# TYPE {full_name} {family.kind}")
+            for labels, value in family.values.items():
+                if isinstance(value, Histogram):
+                    cumulative = 0
+                    for bound, count in zip(value.buckets + ["+Inf"], value.counts):
+                        cumulative += count
+                        bucket_labels = labels + (("le", str(bound)),)
+                        lines.append(
+                            f"{full_name}_bucket{_format_labels(bucket_labels)} {cumulative}"
+                        )
+                    lines.append(f"{full_name}_sum{_format_labels(labels)} {value.sum}")
+                    lines.append(f"{full_name}_count{_format_labels(labels)} {value.count}")
+                else:
+                    lines.append(f"{full_name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def _family(self, name: str, kind: str) -> _Family:
+        family = self._families.get(name)
+        if family is None:
+            self.describe(name, kind, name)
+            family = self._families[name]
+        return family
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in labels
+    )
+    return "{" + pairs + "}"
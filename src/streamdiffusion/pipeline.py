@@ -1,5 +1,6 @@
 import os
 
+
 # 设置 Hugging Face 镜像源为国内镜像
 # 使用环境变量 HF_ENDPOINT 设置镜像地址
 if "HF_ENDPOINT" not in os.environ:
@@ -9,7 +10,8 @@ if "HF_HUB_ENDPOINT" not in os.environ:
     os.environ["HF_HUB_ENDPOINT"] = "https://hf-mirror.com"
 
 import time
-from typing import List, Optional, Union, Any, Dict, Tuple, Literal
+import warnings
+from typing import Any, Dict, List, Literal, Optional, Tuple, Union
 
 import numpy as np
 import PIL.Image
@@ -20,7 +22,14 @@ from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion_img2img impo
     retrieve_latents,
 )
 
-from streamdiffusion.image_filter import SimilarImageFilter
+from streamdiffusion.image_filter import SimilarImageFilter, SkipPolicy
+from streamdiffusion.image_utils import nearest_resolution_bucket, pad_to_size
+from streamdiffusion.metrics import MetricsRegistry
+from streamdiffusion.prompt_cache import PromptEmbeddingCache
+from streamdiffusion.schedule import StreamScheduleCache
+from streamdiffusion.stream_state import StreamState
+from streamdiffusion.timer import Timer, create_timer
+from streamdiffusion.tracing import Tracer, create_tracer_from_env, traced
 
 
 class StreamDiffusion:
@@ -35,6 +44,7 @@ class StreamDiffusion:
         use_denoising_batch: bool = True,
         frame_buffer_size: int = 1,
         cfg_type: Literal["none", "full", "self", "initialize"] = "self",
+        prompt_cache_size: int = 16,
     ) -> None:
         self.device = pipe.device
         self.dtype = torch_dtype
@@ -45,46 +55,60 @@ class StreamDiffusion:
 
         self.latent_height = int(height // pipe.vae_scale_factor)
         self.latent_width = int(width // pipe.vae_scale_factor)
+        self.resolution_buckets = None
+        self.resolution_bucket = None
 
         self.frame_bff_size = frame_buffer_size
         self.denoising_steps_num = len(t_index_list)
 
         self.cfg_type = cfg_type
-
-        if use_denoising_batch:
-            self.batch_size = self.denoising_steps_num * frame_buffer_size
-            if self.cfg_type == "initialize":
-                self.trt_unet_batch_size = (
-                    self.denoising_steps_num + 1
-                ) * self.frame_bff_size
-            elif self.cfg_type == "full":
-                self.trt_unet_batch_size = (
-                    2 * self.denoising_steps_num * self.frame_bff_size
-                )
-            else:
-                self.trt_unet_batch_size = self.denoising_steps_num * frame_buffer_size
-        else:
-            self.trt_unet_batch_size = self.frame_bff_size
-            self.batch_size = frame_buffer_size
+        self.use_denoising_batch = use_denoising_batch
+        self._update_batch_size()
 
         self.t_list = t_index_list
 
         self.do_add_noise = do_add_noise
-        self.use_denoising_batch = use_denoising_batch
+
+        self.guidance_scale = 1.0
+        self.delta = 1.0
+        self.num_inference_steps = 50
+        self.prompt = ""
+        self.negative_prompt = ""
+        self.prompt_cache = PromptEmbeddingCache(prompt_cache_size)
 
         self.similar_image_filter = False
         self.similar_filter = SimilarImageFilter()
         self.prev_image_result = None
+        self.skip_mode = "sleep"
+        self.last_skipped = False
+        self.last_x_t_latent = None
 
         self.pipe = pipe
         self.image_processor = VaeImageProcessor(pipe.vae_scale_factor)
 
         self.scheduler = LCMScheduler.from_config(self.pipe.scheduler.config)
+        self.schedule_cache = StreamScheduleCache(self.scheduler)
         self.text_encoder = pipe.text_encoder
         self.unet = pipe.unet
         self.vae = pipe.vae
 
+        self.latent_buffer = None
+        self.x_t_latent_buffer = None
+        self.stock_noise = None
+        self.unet_input_buffer = None
+        # scratch space of the scheduler step, so a frame writes into existing tensors
+        self.model_pred_buffer = None
+        self.noise_buffer = None
+        self.f_theta_buffer = None
+        self.denoised_buffer = None
+        self.delta_x_buffer = None
+        # counts latent and noise buffer allocations in prepare, not per-frame allocations
+        self.latent_buffer_allocations = 0
+
+        self.timer = create_timer(self.device)
         self.inference_time_ema = 0
+        self.metrics = MetricsRegistry(self.device)
+        self.tracer = create_tracer_from_env()
 
     def load_lcm_lora(
         self,
@@ -97,6 +121,7 @@ class StreamDiffusion:
         self.pipe.load_lora_weights(
             pretrained_model_name_or_path_or_dict, adapter_name, **kwargs
         )
+        self.prompt_cache.clear()
 
     def load_lora(
         self,
@@ -107,6 +132,7 @@ class StreamDiffusion:
         self.pipe.load_lora_weights(
             pretrained_lora_model_name_or_path_or_dict, adapter_name, **kwargs
         )
+        self.prompt_cache.clear()
 
     def fuse_lora(
         self,
@@ -121,15 +147,140 @@ class StreamDiffusion:
             lora_scale=lora_scale,
             safe_fusing=safe_fusing,
         )
+        self.prompt_cache.clear()
 
-    def enable_similar_image_filter(self, threshold: float = 0.98, max_skip_frame: float = 10) -> None:
+    def enable_similar_image_filter(
+        self,
+        threshold: float = 0.98,
+        max_skip_frame: float = 10,
+        mode: Literal["full", "thumbnail"] = "full",
+        policy: Optional[Union[str, SkipPolicy]] = None,
+        skip_mode: Literal["sleep", "return", "advance"] = "sleep",
+        policy_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """
+        policy is a SkipPolicy or the name of one, created with policy_kwargs,
+        e.g. policy="target_fps" with policy_kwargs={"target_fps": 15}.
+
+        skip_mode decides what a call does when the filter skips its frame:
+        "sleep" waits for the average inference time before returning the
+        previous output, "return" returns it immediately and "advance" uses
+        the slot to move the in-flight latents one step forward with the last
+        input latent standing in for the skipped frame. In "advance" mode the
+        earlier frame that step finishes is decoded and returned, so every
+        call still returns the output due for it; in the other modes the
+        previous output is returned. last_skipped is set in every mode.
+        """
+        if skip_mode not in ("sleep", "return", "advance"):
+            raise ValueError(f"Unknown skip mode {skip_mode}")
+        self.skip_mode = skip_mode
         self.similar_image_filter = True
         self.similar_filter.set_threshold(threshold)
         self.similar_filter.set_max_skip_frame(max_skip_frame)
+        self.similar_filter.set_mode(mode)
+        if policy is not None:
+            self.similar_filter.set_policy(policy, **(policy_kwargs or {}))
+        elif policy_kwargs:
+            raise ValueError("policy_kwargs needs a policy name")
 
     def disable_similar_image_filter(self) -> None:
         self.similar_image_filter = False
 
+    def set_resolution_buckets(self, buckets: Optional[List[Tuple[int, int]]]) -> None:
+        """
+        Runs the UNet and VAE at the smallest of the (width, height) buckets
+        containing the stream resolution, e.g. for engines built with one
+        profile per bucket. Inputs are padded to the bucket and outputs
+        cropped back, so only the models see the bucket size. None runs
+        them at the stream resolution.
+        """
+        self.resolution_buckets = [tuple(bucket) for bucket in buckets] if buckets else None
+        self.resolution_bucket = None
+        if self.resolution_buckets:
+            for bucket_width, bucket_height in self.resolution_buckets:
+                if bucket_width % 8 or bucket_height % 8:
+                    raise ValueError(
+                        f"Resolution buckets must be multiples of 8, got {bucket_width}x{bucket_height}."
+                    )
+            bucket = nearest_resolution_bucket(
+                self.resolution_buckets, self.width, self.height
+            )
+            if bucket != (self.width, self.height):
+                self.resolution_bucket = bucket
+
+    def set_tracer(self, tracer: Tracer) -> None:
+        self.tracer = tracer
+
+    def set_timer(self, timer: Timer) -> None:
+        self.timer = timer
+
+    def _update_batch_size(self) -> None:
+        if self.use_denoising_batch:
+            self.batch_size = self.denoising_steps_num * self.frame_bff_size
+            if self.cfg_type == "initialize":
+                self.trt_unet_batch_size = (
+                    self.denoising_steps_num + 1
+                ) * self.frame_bff_size
+            elif self.cfg_type == "full":
+                self.trt_unet_batch_size = (
+                    2 * self.denoising_steps_num * self.frame_bff_size
+                )
+            else:
+                self.trt_unet_batch_size = self.denoising_steps_num * self.frame_bff_size
+        else:
+            self.trt_unet_batch_size = self.frame_bff_size
+            self.batch_size = self.frame_bff_size
+
+    def _check_unet_batch_size(self) -> None:
+        # only set for compiled unets, e.g. UNet2DConditionModelEngine
+        min_batch_size = getattr(self.unet, "min_batch_size", None)
+        max_batch_size = getattr(self.unet, "max_batch_size", None)
+        if min_batch_size is None or max_batch_size is None:
+            return
+        if not min_batch_size <= self.trt_unet_batch_size <= max_batch_size:
+            warnings.warn(
+                f"The unet batch size {self.trt_unet_batch_size} for t_index_list {self.t_list} is outside "
+                f"the batch range [{min_batch_size}, {max_batch_size}] the engine was built for; "
+                "inference will fail until the engine is rebuilt for this batch size."
+            )
+
+    @torch.no_grad()
+    def set_timesteps(self, t_index_list: List[int]) -> None:
+        """
+        Switches to a new t_index_list without reloading the models.
+        Must be called after ``prepare``.
+
+        The schedule tensors are recomputed and the latent buffers resized
+        for the new number of denoising steps. In-flight latents are reset,
+        so the next ``len(t_index_list) - 1`` outputs are warm-up frames.
+        """
+        self.t_list = list(t_index_list)
+        self.denoising_steps_num = len(self.t_list)
+        self._resize_batch()
+
+    @torch.no_grad()
+    def set_frame_buffer_size(self, frame_buffer_size: int) -> None:
+        """
+        Changes the number of frames (lanes) in the denoising batch without
+        reloading the models. Must be called after ``prepare``.
+
+        In-flight latents are reset; use ``load_states`` to restore them.
+        """
+        self.frame_bff_size = frame_buffer_size
+        self._resize_batch()
+
+    def _resize_batch(self) -> None:
+        self._update_batch_size()
+        self._check_unet_batch_size()
+
+        self.prompt_embeds = self._get_prompt_embeds(self.prompt, self.negative_prompt)
+        self._prepare_schedule()
+        if self.init_noise.shape[0] != self.batch_size:
+            self.init_noise = self._randn(
+                (self.batch_size, 4, self.latent_height, self.latent_width)
+            )
+        self._prepare_buffers()
+
     @torch.no_grad()
     def prepare(
         self,
@@ -138,25 +289,14 @@ class StreamDiffusion:
         num_inference_steps: int = 50,
         guidance_scale: float = 1.2,
         delta: float = 1.0,
-        generator: Optional[torch.Generator] = torch.Generator(),
+        generator: Optional[torch.Generator] = None,
         seed: int = 2,
     ) -> None:
+        # noise is sampled directly on the target device, so the generator has to live there too
+        if generator is None or generator.device.type != self.device.type:
+            generator = torch.Generator(device=self.device)
         self.generator = generator
         self.generator.manual_seed(seed)
-        # initialize x_t_latent (it can be any random tensor)
-        if self.denoising_steps_num > 1:
-            self.x_t_latent_buffer = torch.zeros(
-                (
-                    (self.denoising_steps_num - 1) * self.frame_bff_size,
-                    4,
-                    self.latent_height,
-                    self.latent_width,
-                ),
-                dtype=self.dtype,
-                device=self.device,
-            )
-        else:
-            self.x_t_latent_buffer = None
 
         if self.cfg_type == "none":
             self.guidance_scale = 1.0
@@ -164,112 +304,271 @@ class StreamDiffusion:
             self.guidance_scale = guidance_scale
         self.delta = delta
 
-        do_classifier_free_guidance = False
-        if self.guidance_scale > 1.0:
-            do_classifier_free_guidance = True
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.prompt_embeds = self._get_prompt_embeds(prompt, negative_prompt)
 
-        encoder_output = self.pipe.encode_prompt(
-            prompt=prompt,
+        self.num_inference_steps = num_inference_steps
+        self._prepare_schedule()
+
+        self.init_noise = self._randn(
+            (self.batch_size, 4, self.latent_height, self.latent_width)
+        )
+
+        self._prepare_buffers()
+
+    def _prepare_schedule(self) -> None:
+        schedule = self.schedule_cache.get(
+            self.num_inference_steps,
+            self.t_list,
+            self.frame_bff_size if self.use_denoising_batch else 1,
+            self.device,
+            self.dtype,
+        )
+        self.timesteps = schedule.timesteps
+        self.sub_timesteps = schedule.sub_timesteps
+        self.sub_timesteps_tensor = schedule.sub_timesteps_tensor
+        self.c_skip = schedule.c_skip
+        self.c_out = schedule.c_out
+        self.alpha_prod_t_sqrt = schedule.alpha_prod_t_sqrt
+        self.beta_prod_t_sqrt = schedule.beta_prod_t_sqrt
+        self.alpha_next = schedule.alpha_next
+        self.beta_next = schedule.beta_next
+
+    def _allocate_buffer(
+        self, num_latents: int, reuse: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        # buffers of the right size are cleared and reused rather than reallocated
+        if reuse is not None and reuse.shape[0] == num_latents:
+            return reuse.zero_()
+        self.latent_buffer_allocations += 1
+        return torch.zeros(
+            (num_latents, 4, self.latent_height, self.latent_width),
+            dtype=self.dtype,
             device=self.device,
-            num_images_per_prompt=1,
-            do_classifier_free_guidance=do_classifier_free_guidance,
-            negative_prompt=negative_prompt,
         )
-        self.prompt_embeds = encoder_output[0].repeat(self.batch_size, 1, 1)
 
-        if self.use_denoising_batch and self.cfg_type == "full":
-            uncond_prompt_embeds = encoder_output[1].repeat(self.batch_size, 1, 1)
-        elif self.cfg_type == "initialize":
-            uncond_prompt_embeds = encoder_output[1].repeat(self.frame_bff_size, 1, 1)
+    def _prepare_buffers(self) -> None:
+        """
+        Allocates the persistent latent and noise buffers and precomputes the
+        noise terms used by the denoising batch, so the per-frame path only
+        writes into existing tensors.
 
-        if self.guidance_scale > 1.0 and (
-            self.cfg_type == "initialize" or self.cfg_type == "full"
-        ):
-            self.prompt_embeds = torch.cat(
-                [uncond_prompt_embeds, self.prompt_embeds], dim=0
-            )
+        Rows are laid out step-major: rows ``[k * frame_buffer_size, (k + 1) * frame_buffer_size)``
+        hold the latents currently at step ``k`` of ``t_index_list``.
+        """
+        frame_size = self.frame_bff_size
+
+        self.stock_noise = self._allocate_buffer(self.batch_size, self.stock_noise)
+        if not self.use_denoising_batch:
+            self.latent_buffer = None
+            self.x_t_latent_buffer = None
+            self.unet_input_buffer = None
+            self.model_pred_buffer = None
+            self.noise_buffer = None
+            self.f_theta_buffer = None
+            self.denoised_buffer = None
+            self.delta_x_buffer = None
+            return
+
+        self.model_pred_buffer = self._allocate_buffer(self.batch_size, self.model_pred_buffer)
+        self.noise_buffer = self._allocate_buffer(self.batch_size, self.noise_buffer)
+        self.f_theta_buffer = self._allocate_buffer(self.batch_size, self.f_theta_buffer)
+        self.denoised_buffer = self._allocate_buffer(self.batch_size, self.denoised_buffer)
+        self.delta_x_buffer = self._allocate_buffer(self.batch_size, self.delta_x_buffer)
+
+        # rows in front of the latents that are fed to the unet with the uncond embeddings
+        if self.guidance_scale > 1.0 and self.cfg_type == "full":
+            num_uncond_rows = self.batch_size
+        elif self.guidance_scale > 1.0 and self.cfg_type == "initialize":
+            num_uncond_rows = frame_size
+        else:
+            num_uncond_rows = 0
 
-        self.scheduler.set_timesteps(num_inference_steps, self.device)
-        self.timesteps = self.scheduler.timesteps.to(self.device)
+        if num_uncond_rows > 0:
+            self.unet_input_buffer = self._allocate_buffer(
+                num_uncond_rows + self.batch_size, self.unet_input_buffer
+            )
+            self.latent_buffer = self.unet_input_buffer[num_uncond_rows:]
+            self.unet_timesteps = torch.cat(
+                [self.sub_timesteps_tensor[:num_uncond_rows], self.sub_timesteps_tensor], dim=0
+            )
+        else:
+            # a view into a previous unet input buffer cannot be reused on its own
+            reuse = self.latent_buffer if self.unet_input_buffer is None else None
+            self.unet_input_buffer = None
+            self.latent_buffer = self._allocate_buffer(self.batch_size, reuse)
+            self.unet_timesteps = self.sub_timesteps_tensor
 
-        # make sub timesteps list based on the indices in the t_list list and the values in the timesteps list
-        self.sub_timesteps = []
-        for t in self.t_list:
-            self.sub_timesteps.append(self.timesteps[t])
+        if self.denoising_steps_num > 1:
+            self.x_t_latent_buffer = self.latent_buffer[frame_size:]
+            self.x_t_latent_buffer_noise = (
+                self.beta_prod_t_sqrt[frame_size:] * self.init_noise[frame_size:]
+            )
+            # the stock noise buffer is kept already shifted by one step for the next frame
+            self.stock_noise[:frame_size].copy_(self.init_noise[:frame_size])
+        else:
+            self.x_t_latent_buffer = None
+            self.x_t_latent_buffer_noise = None
 
-        sub_timesteps_tensor = torch.tensor(
-            self.sub_timesteps, dtype=torch.long, device=self.device
+        self.init_noise_rolled = torch.cat(
+            [self.init_noise[frame_size:], self.init_noise[:frame_size]], dim=0
         )
-        self.sub_timesteps_tensor = torch.repeat_interleave(
-            sub_timesteps_tensor,
-            repeats=self.frame_bff_size if self.use_denoising_batch else 1,
-            dim=0,
-        )
-
-        self.init_noise = torch.randn(
-            (self.batch_size, 4, self.latent_height, self.latent_width),
-            generator=generator,
-        ).to(device=self.device, dtype=self.dtype)
 
-        self.stock_noise = torch.zeros_like(self.init_noise)
+    @torch.no_grad()
+    def update_prompt(self, prompt: str) -> None:
+        self.prompt = prompt
+        self.prompt_embeds = self._get_prompt_embeds(prompt, self.negative_prompt)
 
-        c_skip_list = []
-        c_out_list = []
-        for timestep in self.sub_timesteps:
-            c_skip, c_out = self.scheduler.get_scalings_for_boundary_condition_discrete(
-                timestep
+    @torch.no_grad()
+    def set_lane_prompts(self, prompts: List[str]) -> None:
+        """
+        Sets one prompt per lane of the denoising batch, so sessions sharing
+        a batch can each use their own prompt.
+        """
+        if len(prompts) != self.frame_bff_size:
+            raise ValueError(
+                f"Expected {self.frame_bff_size} prompts, got {len(prompts)}."
+            )
+        if len(set(prompts)) == 1:
+            self.update_prompt(prompts[0])
+            return
+
+        key = self._prompt_cache_key(tuple(prompts), self.negative_prompt)
+        prompt_embeds = self.prompt_cache.get(key)
+        if prompt_embeds is None:
+            lane_embeds = [
+                self._get_prompt_embeds(prompt, self.negative_prompt)
+                for prompt in prompts
+            ]
+            num_uncond_rows = lane_embeds[0].shape[0] - self.batch_size
+            # cached entries are shared, so the lanes are written into a copy
+            prompt_embeds = lane_embeds[0].clone()
+            lanes = prompt_embeds[num_uncond_rows:].view(
+                self.denoising_steps_num, self.frame_bff_size, *prompt_embeds.shape[1:]
             )
-            c_skip_list.append(c_skip)
-            c_out_list.append(c_out)
+            for lane, embeds in enumerate(lane_embeds):
+                lanes[:, lane] = embeds[num_uncond_rows]
+            self.prompt_cache.put(key, prompt_embeds)
+        self.prompt_embeds = prompt_embeds
 
-        self.c_skip = (
-            torch.stack(c_skip_list)
-            .view(len(self.t_list), 1, 1, 1)
-            .to(dtype=self.dtype, device=self.device)
-        )
-        self.c_out = (
-            torch.stack(c_out_list)
-            .view(len(self.t_list), 1, 1, 1)
-            .to(dtype=self.dtype, device=self.device)
+    def _use_uncond_embeds(self) -> bool:
+        return self.guidance_scale > 1.0 and (
+            self.cfg_type == "initialize" or self.cfg_type == "full"
         )
 
-        alpha_prod_t_sqrt_list = []
-        beta_prod_t_sqrt_list = []
-        for timestep in self.sub_timesteps:
-            alpha_prod_t_sqrt = self.scheduler.alphas_cumprod[timestep].sqrt()
-            beta_prod_t_sqrt = (1 - self.scheduler.alphas_cumprod[timestep]).sqrt()
-            alpha_prod_t_sqrt_list.append(alpha_prod_t_sqrt)
-            beta_prod_t_sqrt_list.append(beta_prod_t_sqrt)
-        alpha_prod_t_sqrt = (
-            torch.stack(alpha_prod_t_sqrt_list)
-            .view(len(self.t_list), 1, 1, 1)
-            .to(dtype=self.dtype, device=self.device)
-        )
-        beta_prod_t_sqrt = (
-            torch.stack(beta_prod_t_sqrt_list)
-            .view(len(self.t_list), 1, 1, 1)
-            .to(dtype=self.dtype, device=self.device)
-        )
-        self.alpha_prod_t_sqrt = torch.repeat_interleave(
-            alpha_prod_t_sqrt,
-            repeats=self.frame_bff_size if self.use_denoising_batch else 1,
-            dim=0,
-        )
-        self.beta_prod_t_sqrt = torch.repeat_interleave(
-            beta_prod_t_sqrt,
-            repeats=self.frame_bff_size if self.use_denoising_batch else 1,
-            dim=0,
+    def _prompt_cache_key(
+        self, prompt: Union[str, Tuple[str, ...]], negative_prompt: str
+    ) -> Tuple:
+        use_uncond_embeds = self._use_uncond_embeds()
+        return (
+            prompt,
+            negative_prompt if use_uncond_embeds else None,
+            self.cfg_type if use_uncond_embeds else "none",
+            # the uncond rows follow frame_bff_size, which can vary at a fixed batch size
+            self.batch_size,
+            self.frame_bff_size,
         )
 
-    @torch.no_grad()
-    def update_prompt(self, prompt: str) -> None:
+    def _get_prompt_embeds(self, prompt: str, negative_prompt: str = "") -> torch.Tensor:
+        """
+        Returns the batched prompt embeddings for the current cfg settings,
+        running the text encoder only on a prompt cache miss.
+        """
+        use_uncond_embeds = self._use_uncond_embeds()
+        key = self._prompt_cache_key(prompt, negative_prompt)
+        prompt_embeds = self.prompt_cache.get(key)
+        if prompt_embeds is not None:
+            self.metrics.inc("prompt_cache_hits_total")
+            return prompt_embeds
+
+        self.metrics.inc("prompt_encodes_total")
         encoder_output = self.pipe.encode_prompt(
             prompt=prompt,
             device=self.device,
             num_images_per_prompt=1,
-            do_classifier_free_guidance=False,
+            do_classifier_free_guidance=use_uncond_embeds,
+            negative_prompt=negative_prompt if use_uncond_embeds else None,
         )
-        self.prompt_embeds = encoder_output[0].repeat(self.batch_size, 1, 1)
+        prompt_embeds = encoder_output[0].repeat(self.batch_size, 1, 1)
+
+        if use_uncond_embeds:
+            uncond_prompt_embeds = encoder_output[1].repeat(
+                self.batch_size if self.cfg_type == "full" else self.frame_bff_size,
+                1,
+                1,
+            )
+            prompt_embeds = torch.cat([uncond_prompt_embeds, prompt_embeds], dim=0)
+
+        self.prompt_cache.put(key, prompt_embeds)
+        return prompt_embeds
+
+    def create_state(self, prompt: Optional[str] = None) -> StreamState:
+        """
+        Returns an empty lane state for a new session, using the current
+        prompt when none is given.
+        """
+        shape = (self.denoising_steps_num, 4, self.latent_height, self.latent_width)
+        return StreamState(
+            latents=torch.zeros(shape, dtype=self.dtype, device=self.device),
+            stock_noise=torch.zeros(shape, dtype=self.dtype, device=self.device),
+            prompt=self.prompt if prompt is None else prompt,
+        )
+
+    def _lane_views(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        if not self.use_denoising_batch:
+            raise ValueError("Stream states require use_denoising_batch=True.")
+        shape = (
+            self.denoising_steps_num,
+            self.frame_bff_size,
+            4,
+            self.latent_height,
+            self.latent_width,
+        )
+        return self.latent_buffer.view(shape), self.stock_noise.view(shape)
+
+    @torch.no_grad()
+    def load_states(self, states: List[StreamState]) -> None:
+        """
+        Copies one session state into each lane of the denoising batch.
+        States created for a different t_index_list start over empty.
+        """
+        if len(states) != self.frame_bff_size:
+            raise ValueError(
+                f"Expected {self.frame_bff_size} states, got {len(states)}."
+            )
+        latents, stock_noise = self._lane_views()
+        for lane, state in enumerate(states):
+            if state.num_steps != self.denoising_steps_num:
+                fresh = self.create_state(state.prompt)
+                state.latents = fresh.latents
+                state.stock_noise = fresh.stock_noise
+            latents[:, lane].copy_(state.latents)
+            stock_noise[:, lane].copy_(state.stock_noise)
+        if self.denoising_steps_num > 1:
+            self.stock_noise[: self.frame_bff_size].copy_(
+                self.init_noise[: self.frame_bff_size]
+            )
+
+    @torch.no_grad()
+    def save_states(self, states: List[StreamState]) -> None:
+        """
+        Copies each lane of the denoising batch back into its session state.
+        """
+        if len(states) != self.frame_bff_size:
+            raise ValueError(
+                f"Expected {self.frame_bff_size} states, got {len(states)}."
+            )
+        latents, stock_noise = self._lane_views()
+        for lane, state in enumerate(states):
+            state.latents.copy_(latents[:, lane])
+            state.stock_noise.copy_(stock_noise[:, lane])
+
+    def _randn(self, shape: Tuple[int, ...]) -> torch.Tensor:
+        # sample in float32 so the values do not depend on self.dtype
+        return torch.randn(
+            shape, generator=self.generator, device=self.device, dtype=torch.float32
+        ).to(dtype=self.dtype)
 
     def add_noise(
         self,
@@ -283,96 +582,128 @@ class StreamDiffusion:
         )
         return noisy_samples
 
+    @traced("scheduler_step_batch")
     def scheduler_step_batch(
         self,
         model_pred_batch: torch.Tensor,
         x_t_latent_batch: torch.Tensor,
         idx: Optional[int] = None,
+        out: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
         # TODO: use t_list to select beta_prod_t_sqrt
         if idx is None:
-            F_theta = (
-                x_t_latent_batch - self.beta_prod_t_sqrt * model_pred_batch
-            ) / self.alpha_prod_t_sqrt
-            denoised_batch = self.c_out * F_theta + self.c_skip * x_t_latent_batch
+            alpha_prod_t_sqrt, beta_prod_t_sqrt = self.alpha_prod_t_sqrt, self.beta_prod_t_sqrt
+            c_out, c_skip = self.c_out, self.c_skip
         else:
-            F_theta = (
-                x_t_latent_batch - self.beta_prod_t_sqrt[idx] * model_pred_batch
-            ) / self.alpha_prod_t_sqrt[idx]
-            denoised_batch = (
-                self.c_out[idx] * F_theta + self.c_skip[idx] * x_t_latent_batch
-            )
+            alpha_prod_t_sqrt, beta_prod_t_sqrt = self.alpha_prod_t_sqrt[idx], self.beta_prod_t_sqrt[idx]
+            c_out, c_skip = self.c_out[idx], self.c_skip[idx]
 
-        return denoised_batch
+        # F_theta = (x_t - beta * model_pred) / alpha, computed in place in the scratch buffer
+        F_theta = torch.mul(beta_prod_t_sqrt, model_pred_batch, out=self.f_theta_buffer)
+        F_theta.neg_().add_(x_t_latent_batch).div_(alpha_prod_t_sqrt)
+        denoised_batch = torch.mul(c_out, F_theta, out=out)
+        return denoised_batch.addcmul_(c_skip, x_t_latent_batch)
 
+    @traced("unet_step")
     def unet_step(
         self,
         x_t_latent: torch.Tensor,
         t_list: Union[torch.Tensor, list[int]],
         idx: Optional[int] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
-        if self.guidance_scale > 1.0 and (self.cfg_type == "initialize"):
-            x_t_latent_plus_uc = torch.concat([x_t_latent[0:1], x_t_latent], dim=0)
-            t_list = torch.concat([t_list[0:1], t_list], dim=0)
+        if x_t_latent is self.latent_buffer and self.unet_input_buffer is not None:
+            # the latents already sit behind the uncond rows, only those need refreshing
+            num_uncond_rows = self.unet_input_buffer.shape[0] - self.batch_size
+            self.unet_input_buffer[:num_uncond_rows].copy_(x_t_latent[:num_uncond_rows])
+            x_t_latent_plus_uc = self.unet_input_buffer
+            t_list = self.unet_timesteps
+        elif self.guidance_scale > 1.0 and (self.cfg_type == "initialize"):
+            x_t_latent_plus_uc = torch.concat(
+                [x_t_latent[: self.frame_bff_size], x_t_latent], dim=0
+            )
+            t_list = torch.concat([t_list[: self.frame_bff_size], t_list], dim=0)
         elif self.guidance_scale > 1.0 and (self.cfg_type == "full"):
             x_t_latent_plus_uc = torch.concat([x_t_latent, x_t_latent], dim=0)
             t_list = torch.concat([t_list, t_list], dim=0)
         else:
             x_t_latent_plus_uc = x_t_latent
 
+        with self.metrics.time_stage("unet"):
+            model_pred = self._run_unet(x_t_latent_plus_uc, t_list)
+
+        with self.metrics.time_stage("scheduler_step"):
+            return self._guided_scheduler_step(model_pred, x_t_latent, idx)
+
+    def _run_unet(self, x_t_latent: torch.Tensor, t_list: torch.Tensor) -> torch.Tensor:
+        if self.resolution_bucket is not None:
+            bucket_width, bucket_height = self.resolution_bucket
+            scale = self.pipe.vae_scale_factor
+            x_t_latent = pad_to_size(x_t_latent, bucket_height // scale, bucket_width // scale)
         model_pred = self.unet(
-            x_t_latent_plus_uc,
+            x_t_latent,
             t_list,
             encoder_hidden_states=self.prompt_embeds,
             return_dict=False,
         )[0]
+        if self.resolution_bucket is not None:
+            model_pred = model_pred[..., : self.latent_height, : self.latent_width]
+        return model_pred
 
+    def _guided_scheduler_step(
+        self,
+        model_pred: torch.Tensor,
+        x_t_latent: torch.Tensor,
+        idx: Optional[int] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
         if self.guidance_scale > 1.0 and (self.cfg_type == "initialize"):
-            noise_pred_text = model_pred[1:]
-            self.stock_noise = torch.concat(
-                [model_pred[0:1], self.stock_noise[1:]], dim=0
+            noise_pred_text = model_pred[self.frame_bff_size :]
+            self.stock_noise[: self.frame_bff_size].copy_(
+                model_pred[: self.frame_bff_size]
             )  # ここコメントアウトでself out cfg
         elif self.guidance_scale > 1.0 and (self.cfg_type == "full"):
             noise_pred_uncond, noise_pred_text = model_pred.chunk(2)
         else:
             noise_pred_text = model_pred
+        # with the denoising batch every temporary goes into a buffer from prepare
         if self.guidance_scale > 1.0 and (
             self.cfg_type == "self" or self.cfg_type == "initialize"
         ):
-            noise_pred_uncond = self.stock_noise * self.delta
+            noise_pred_uncond = torch.mul(self.stock_noise, self.delta, out=self.noise_buffer)
         if self.guidance_scale > 1.0 and self.cfg_type != "none":
-            model_pred = noise_pred_uncond + self.guidance_scale * (
-                noise_pred_text - noise_pred_uncond
+            # uncond + guidance_scale * (text - uncond)
+            model_pred = torch.sub(
+                noise_pred_text, noise_pred_uncond, out=self.model_pred_buffer
             )
+            model_pred.mul_(self.guidance_scale).add_(noise_pred_uncond)
         else:
             model_pred = noise_pred_text
 
         # compute the previous noisy sample x_t -> x_t-1
         if self.use_denoising_batch:
-            denoised_batch = self.scheduler_step_batch(model_pred, x_t_latent, idx)
+            denoised_batch = self.scheduler_step_batch(
+                model_pred, x_t_latent, idx, out=self.denoised_buffer
+            )
             if self.cfg_type == "self" or self.cfg_type == "initialize":
-                scaled_noise = self.beta_prod_t_sqrt * self.stock_noise
-                delta_x = self.scheduler_step_batch(model_pred, scaled_noise, idx)
-                alpha_next = torch.concat(
-                    [
-                        self.alpha_prod_t_sqrt[1:],
-                        torch.ones_like(self.alpha_prod_t_sqrt[0:1]),
-                    ],
-                    dim=0,
+                # the uncond prediction is used up, so its buffer holds the scaled noise
+                scaled_noise = torch.mul(
+                    self.beta_prod_t_sqrt, self.stock_noise, out=self.noise_buffer
                 )
-                delta_x = alpha_next * delta_x
-                beta_next = torch.concat(
-                    [
-                        self.beta_prod_t_sqrt[1:],
-                        torch.ones_like(self.beta_prod_t_sqrt[0:1]),
-                    ],
-                    dim=0,
+                delta_x = self.scheduler_step_batch(
+                    model_pred, scaled_noise, idx, out=self.delta_x_buffer
                 )
-                delta_x = delta_x / beta_next
-                init_noise = torch.concat(
-                    [self.init_noise[1:], self.init_noise[0:1]], dim=0
-                )
-                self.stock_noise = init_noise + delta_x
+                delta_x.mul_(self.alpha_next).div_(self.beta_next)
+                if self.denoising_steps_num > 1:
+                    # write the next stock noise shifted by one step, ready for the next frame
+                    torch.add(
+                        self.init_noise_rolled[: -self.frame_bff_size],
+                        delta_x[: -self.frame_bff_size],
+                        out=self.stock_noise[self.frame_bff_size :],
+                    )
+                    self.stock_noise[: self.frame_bff_size].copy_(
+                        self.init_noise[: self.frame_bff_size]
+                    )
+                else:
+                    torch.add(self.init_noise_rolled, delta_x, out=self.stock_noise)
 
         else:
             # denoised_batch = self.scheduler.step(model_pred, t_list[0], x_t_latent).denoised
@@ -380,48 +711,65 @@ class StreamDiffusion:
 
         return denoised_batch, model_pred
 
+    @traced("encode_image")
     def encode_image(self, image_tensors: torch.Tensor) -> torch.Tensor:
         image_tensors = image_tensors.to(
             device=self.device,
             dtype=self.vae.dtype,
         )
-        img_latent = retrieve_latents(self.vae.encode(image_tensors), self.generator)
-        img_latent = img_latent * self.vae.config.scaling_factor
+        with self.metrics.time_stage("vae_encode"):
+            if self.resolution_bucket is not None:
+                bucket_width, bucket_height = self.resolution_bucket
+                image_tensors = pad_to_size(image_tensors, bucket_height, bucket_width)
+            img_latent = retrieve_latents(
+                self.vae.encode(image_tensors), self.generator
+            )
+            if self.resolution_bucket is not None:
+                img_latent = img_latent[..., : self.latent_height, : self.latent_width]
+            img_latent = img_latent * self.vae.config.scaling_factor
         x_t_latent = self.add_noise(img_latent, self.init_noise[0], 0)
         return x_t_latent
 
+    @traced("decode_image")
     def decode_image(self, x_0_pred_out: torch.Tensor) -> torch.Tensor:
-        output_latent = self.vae.decode(
-            x_0_pred_out / self.vae.config.scaling_factor, return_dict=False
-        )[0]
+        with self.metrics.time_stage("vae_decode"):
+            latent = x_0_pred_out / self.vae.config.scaling_factor
+            if self.resolution_bucket is not None:
+                bucket_width, bucket_height = self.resolution_bucket
+                scale = self.pipe.vae_scale_factor
+                latent = pad_to_size(latent, bucket_height // scale, bucket_width // scale)
+            output_latent = self.vae.decode(latent, return_dict=False)[0]
+            if self.resolution_bucket is not None:
+                output_latent = output_latent[
+                    ..., : self.latent_height * scale, : self.latent_width * scale
+                ]
         return output_latent
 
+    @traced("predict_x0_batch")
     def predict_x0_batch(self, x_t_latent: torch.Tensor) -> torch.Tensor:
-        prev_latent_batch = self.x_t_latent_buffer
-
         if self.use_denoising_batch:
-            t_list = self.sub_timesteps_tensor
-            if self.denoising_steps_num > 1:
-                x_t_latent = torch.cat((x_t_latent, prev_latent_batch), dim=0)
-                self.stock_noise = torch.cat(
-                    (self.init_noise[0:1], self.stock_noise[:-1]), dim=0
-                )
-            x_0_pred_batch, model_pred = self.unet_step(x_t_latent, t_list)
+            frame_size = self.frame_bff_size
+            self.latent_buffer[:frame_size].copy_(x_t_latent)
+            x_0_pred_batch, model_pred = self.unet_step(
+                self.latent_buffer, self.sub_timesteps_tensor
+            )
 
+            x_0_pred_out = x_0_pred_batch[-frame_size:]
             if self.denoising_steps_num > 1:
-                x_0_pred_out = x_0_pred_batch[-1].unsqueeze(0)
+                # advance every in-flight latent by one step, writing straight into the buffer
                 if self.do_add_noise:
-                    self.x_t_latent_buffer = (
-                        self.alpha_prod_t_sqrt[1:] * x_0_pred_batch[:-1]
-                        + self.beta_prod_t_sqrt[1:] * self.init_noise[1:]
+                    torch.addcmul(
+                        self.x_t_latent_buffer_noise,
+                        self.alpha_prod_t_sqrt[frame_size:],
+                        x_0_pred_batch[:-frame_size],
+                        out=self.x_t_latent_buffer,
                     )
                 else:
-                    self.x_t_latent_buffer = (
-                        self.alpha_prod_t_sqrt[1:] * x_0_pred_batch[:-1]
+                    torch.mul(
+                        self.alpha_prod_t_sqrt[frame_size:],
+                        x_0_pred_batch[:-frame_size],
+                        out=self.x_t_latent_buffer,
                     )
-            else:
-                x_0_pred_out = x_0_pred_batch
-                self.x_t_latent_buffer = None
         else:
             self.init_noise = x_t_latent
             for idx, t in enumerate(self.sub_timesteps_tensor):
@@ -437,9 +785,7 @@ class StreamDiffusion:
                             idx + 1
                         ] * x_0_pred + self.beta_prod_t_sqrt[
                             idx + 1
-                        ] * torch.randn_like(
-                            x_0_pred, device=self.device, dtype=self.dtype
-                        )
+                        ] * self._randn(x_0_pred.shape)
                     else:
                         x_t_latent = self.alpha_prod_t_sqrt[idx + 1] * x_0_pred
             x_0_pred_out = x_0_pred
@@ -447,60 +793,74 @@ class StreamDiffusion:
         return x_0_pred_out
 
     @torch.no_grad()
+    @traced("frame")
     def __call__(
         self, x: Union[torch.Tensor, PIL.Image.Image, np.ndarray] = None
     ) -> torch.Tensor:
-        start = torch.cuda.Event(enable_timing=True)
-        end = torch.cuda.Event(enable_timing=True)
-        start.record()
+        self.timer.start()
+        self.last_skipped = False
         if x is not None:
-            x = self.image_processor.preprocess(x, self.height, self.width).to(
-                device=self.device, dtype=self.dtype
-            )
+            with self.metrics.time_stage("image_processor"):
+                x = self.image_processor.preprocess(x, self.height, self.width).to(
+                    device=self.device, dtype=self.dtype
+                )
             if self.similar_image_filter:
                 x = self.similar_filter(x)
                 if x is None:
-                    time.sleep(self.inference_time_ema)
+                    self.last_skipped = True
+                    self.metrics.inc("similar_filter_skipped_total")
+                    x_output = self._skip_frame()
+                    # skipped frames are left out of the inference time
+                    self.timer.stop()
+                    if x_output is not None:
+                        self.prev_image_result = x_output
                     return self.prev_image_result
             x_t_latent = self.encode_image(x)
+            self.last_x_t_latent = x_t_latent
         else:
             # TODO: check the dimension of x_t_latent
-            x_t_latent = torch.randn((1, 4, self.latent_height, self.latent_width)).to(
-                device=self.device, dtype=self.dtype
-            )
+            x_t_latent = self._randn((1, 4, self.latent_height, self.latent_width))
         x_0_pred_out = self.predict_x0_batch(x_t_latent)
         x_output = self.decode_image(x_0_pred_out).detach().clone()
 
         self.prev_image_result = x_output
-        end.record()
-        torch.cuda.synchronize()
-        inference_time = start.elapsed_time(end) / 1000
+        self.timer.stop()
+        inference_time = self.timer.elapsed()
         self.inference_time_ema = 0.9 * self.inference_time_ema + 0.1 * inference_time
+        self.metrics.observe("stage_seconds", inference_time, stage="inference")
+        self.metrics.set("inference_time_ema_seconds", self.inference_time_ema)
+        self.metrics.inc("frames_total")
         return x_output
 
+    def _skip_frame(self) -> Optional[torch.Tensor]:
+        # returns a new output, or None to repeat the previous one
+        if self.skip_mode == "sleep":
+            time.sleep(self.inference_time_ema)
+        elif (
+            self.skip_mode == "advance"
+            and self.use_denoising_batch
+            and self.denoising_steps_num > 1
+            and self.last_x_t_latent is not None
+        ):
+            # the skipped frame is close to the last one, so its latent stands in for it.
+            # The step finishes the frame that entered denoising_steps_num - 1 calls ago,
+            # which is the output due now
+            x_0_pred_out = self.predict_x0_batch(self.last_x_t_latent)
+            return self.decode_image(x_0_pred_out).detach().clone()
+        return None
+
     @torch.no_grad()
     def txt2img(self, batch_size: int = 1) -> torch.Tensor:
         x_0_pred_out = self.predict_x0_batch(
-            torch.randn((batch_size, 4, self.latent_height, self.latent_width)).to(
-                device=self.device, dtype=self.dtype
-            )
+            self._randn((batch_size, 4, self.latent_height, self.latent_width))
         )
         x_output = self.decode_image(x_0_pred_out).detach().clone()
         return x_output
 
     def txt2img_sd_turbo(self, batch_size: int = 1) -> torch.Tensor:
-        x_t_latent = torch.randn(
-            (batch_size, 4, self.latent_height, self.latent_width),
-            device=self.device,
-            dtype=self.dtype,
-        )
-        model_pred = self.unet(
-            x_t_latent,
-            self.sub_timesteps_tensor,
-            encoder_hidden_states=self.prompt_embeds,
-            return_dict=False,
-        )[0]
+        x_t_latent = self._randn((batch_size, 4, self.latent_height, self.latent_width))
+        model_pred = self._run_unet(x_t_latent, self.sub_timesteps_tensor)
         x_0_pred_out = (
             x_t_latent - self.beta_prod_t_sqrt * model_pred
         ) / self.alpha_prod_t_sqrt
-        return self.decode_image(x_0_pred_out)
+        return self.decode_image(x_0_pred_out).detach().clone()
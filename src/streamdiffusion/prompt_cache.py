@@ -0,0 +1,51 @@
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+import torch
+
+
+class PromptEmbeddingCache:
+    """
+    LRU cache of text encoder outputs.
+
+    Entries are keyed by everything that affects the final embedding tensor
+    (prompt, negative prompt, cfg mode, batch size and frame buffer size), so
+    a hit can be used as ``prompt_embeds`` directly without running the text
+    encoder again.
+    """
+
+    def __init__(self, max_size: int = 16) -> None:
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, torch.Tensor]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable) -> Optional[torch.Tensor]:
+        embeds = self._entries.get(key)
+        if embeds is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return embeds
+
+    def put(self, key: Hashable, embeds: torch.Tensor) -> None:
+        if self.max_size <= 0:
+            return
+        self._entries[key] = embeds
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def reset_stats(self) -> None:
+        self.hits = 0
+        self.misses = 0
@@ -0,0 +1,132 @@
+import json
+from collections import OrderedDict
+from typing import Hashable, List, Optional, Union
+
+import torch
+from diffusers import LCMScheduler
+
+
+class StreamSchedule:
+    """
+    Per-step constants of the LCM schedule for a t_index_list.
+
+    ``sub_timesteps`` holds one entry per denoising step. All other per-step
+    tensors are repeated ``repeats`` times along the batch dimension to
+    match the step-major layout of the denoising batch. ``alpha_next`` and
+    ``beta_next`` are the values of the following step, with ones for the
+    last step.
+    """
+
+    def __init__(
+        self,
+        timesteps: torch.Tensor,
+        sub_timesteps: torch.Tensor,
+        sub_timesteps_tensor: torch.Tensor,
+        c_skip: torch.Tensor,
+        c_out: torch.Tensor,
+        alpha_prod_t_sqrt: torch.Tensor,
+        beta_prod_t_sqrt: torch.Tensor,
+        alpha_next: torch.Tensor,
+        beta_next: torch.Tensor,
+    ) -> None:
+        self.timesteps = timesteps
+        self.sub_timesteps = sub_timesteps
+        self.sub_timesteps_tensor = sub_timesteps_tensor
+        self.c_skip = c_skip
+        self.c_out = c_out
+        self.alpha_prod_t_sqrt = alpha_prod_t_sqrt
+        self.beta_prod_t_sqrt = beta_prod_t_sqrt
+        self.alpha_next = alpha_next
+        self.beta_next = beta_next
+
+
+def compute_stream_schedule(
+    scheduler: LCMScheduler,
+    num_inference_steps: int,
+    t_index_list: List[int],
+    repeats: int,
+    device: Union[str, torch.device],
+    dtype: torch.dtype,
+) -> StreamSchedule:
+    scheduler.set_timesteps(num_inference_steps, device)
+    timesteps = scheduler.timesteps.to(device)
+
+    t_index = torch.tensor(t_index_list, dtype=torch.long, device=timesteps.device)
+    sub_timesteps = timesteps[t_index].long()
+
+    c_skip, c_out = scheduler.get_scalings_for_boundary_condition_discrete(sub_timesteps)
+    alphas_cumprod = scheduler.alphas_cumprod[sub_timesteps.to(scheduler.alphas_cumprod.device)]
+
+    def expand(values: torch.Tensor) -> torch.Tensor:
+        values = values.view(len(t_index_list), 1, 1, 1).to(dtype=dtype, device=device)
+        return torch.repeat_interleave(values, repeats=repeats, dim=0)
+
+    def shift(values: torch.Tensor) -> torch.Tensor:
+        return torch.cat([values[repeats:], torch.ones_like(values[:repeats])], dim=0)
+
+    alpha_prod_t_sqrt = expand(alphas_cumprod.sqrt())
+    beta_prod_t_sqrt = expand((1 - alphas_cumprod).sqrt())
+    return StreamSchedule(
+        timesteps=timesteps,
+        sub_timesteps=sub_timesteps,
+        sub_timesteps_tensor=torch.repeat_interleave(sub_timesteps, repeats=repeats, dim=0),
+        c_skip=expand(c_skip),
+        c_out=expand(c_out),
+        alpha_prod_t_sqrt=alpha_prod_t_sqrt,
+        beta_prod_t_sqrt=beta_prod_t_sqrt,
+        alpha_next=shift(alpha_prod_t_sqrt),
+        beta_next=shift(beta_prod_t_sqrt),
+    )
+
+
+class StreamScheduleCache:
+    """
+    LRU cache of StreamSchedule objects, so re-preparing with an unchanged
+    schedule (e.g. after a prompt or cfg change) skips the computation.
+    """
+
+    def __init__(self, scheduler: LCMScheduler, max_size: int = 32) -> None:
+        self.scheduler = scheduler
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # the scheduler config is frozen, so its key only needs to be built once
+        self._config_key = json.dumps(dict(scheduler.config), sort_keys=True, default=str)
+        self._entries: "OrderedDict[Hashable, StreamSchedule]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(
+        self,
+        num_inference_steps: int,
+        t_index_list: List[int],
+        repeats: int,
+        device: Union[str, torch.device],
+        dtype: torch.dtype,
+    ) -> StreamSchedule:
+        key = (
+            self._config_key,
+            num_inference_steps,
+            tuple(t_index_list),
+            repeats,
+            str(device),
+            dtype,
+        )
+        schedule: Optional[StreamSchedule] = self._entries.get(key)
+        if schedule is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return schedule
+
+        self.misses += 1
+        schedule = compute_stream_schedule(
+            self.scheduler, num_inference_steps, t_index_list, repeats, device, dtype
+        )
+        self._entries[key] = schedule
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return schedule
+
+    def clear(self) -> None:
+        self._entries.clear()
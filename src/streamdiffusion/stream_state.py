@@ -0,0 +1,32 @@
+from typing import Optional
+
+import torch
+
+
+class StreamState:
+    """
+    Per-session state of one lane of the denoising batch.
+
+    A lane is one of the ``frame_buffer_size`` columns of the step-major
+    denoising batch. ``latents`` and ``stock_noise`` hold one row per
+    denoising step, so a session can be swapped in and out of any lane
+    between calls without disturbing its in-flight latents.
+    """
+
+    def __init__(
+        self,
+        latents: torch.Tensor,
+        stock_noise: torch.Tensor,
+        prompt: Optional[str] = None,
+    ) -> None:
+        self.latents = latents
+        self.stock_noise = stock_noise
+        self.prompt = prompt
+
+    @property
+    def num_steps(self) -> int:
+        return self.latents.shape[0]
+
+    def reset(self) -> None:
+        self.latents.zero_()
+        self.stock_noise.zero_()
@@ -0,0 +1,70 @@
+import time
+from typing import Optional, Union
+
+import torch
+
+
+class Timer:
+    """
+    Measures the wall time of a region of pipeline work.
+
+    ``start`` and ``stop`` bracket the region and ``elapsed`` returns the
+    duration in seconds, waiting for any outstanding device work if needed.
+    """
+
+    def start(self) -> None:
+        raise NotImplementedError
+
+    def stop(self) -> None:
+        raise NotImplementedError
+
+    def elapsed(self) -> float:
+        raise NotImplementedError
+
+    def ready(self) -> bool:
+        """Whether ``elapsed`` can return without waiting on the device."""
+        return True
+
+
+class PerfCounterTimer(Timer):
+    def __init__(self) -> None:
+        self._start = 0
+        self._end = 0
+
+    def start(self) -> None:
+        self._start = time.perf_counter_ns()
+
+    def stop(self) -> None:
+        self._end = time.perf_counter_ns()
+
+    def elapsed(self) -> float:
+        return (self._end - self._start) / 1e9
+
+
+class CUDAEventTimer(Timer):
+    def __init__(self) -> None:
+        self._start = torch.cuda.Event(enable_timing=True)
+        self._end = torch.cuda.Event(enable_timing=True)
+
+    def start(self) -> None:
+        self._start.record()
+
+    def stop(self) -> None:
+        self._end.record()
+
+    def ready(self) -> bool:
+        return self._end.query()
+
+    def elapsed(self) -> float:
+        self._end.synchronize()
+        return self._start.elapsed_time(self._end) / 1000
+
+
+def create_timer(device: Optional[Union[str, torch.device]] = None) -> Timer:
+    """
+    Returns a CUDA event timer for CUDA devices and a ``perf_counter_ns``
+    based timer otherwise.
+    """
+    if device is not None and torch.device(device).type == "cuda":
+        return CUDAEventTimer()
+    return PerfCounterTimer()
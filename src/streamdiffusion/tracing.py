@@ -0,0 +1,152 @@
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Optional, TypeVar
+
+import torch
+
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+_NULL_RANGE = nullcontext()
+
+
+class Tracer:
+    """
+    Marks named ranges of pipeline work for an external profiler.
+
+    The base tracer does nothing, so tracing points left in the hot path
+    cost a single method call unless a real tracer is bound.
+    """
+
+    def trace(self, name: str) -> ContextManager:
+        return _NULL_RANGE
+
+    def close(self) -> None:
+        pass
+
+
+class ProfilerTracer(Tracer):
+    """Emits ``torch.profiler.record_function`` ranges."""
+
+    def trace(self, name: str) -> ContextManager:
+        return torch.profiler.record_function(name)
+
+
+class NVTXTracer(Tracer):
+    """Emits NVTX ranges, visible in Nsight Systems."""
+
+    def trace(self, name: str) -> ContextManager:
+        return torch.cuda.nvtx.range(name)
+
+
+class ChromeTraceTracer(Tracer):
+    """
+    Records ranges as complete events of the Chrome trace event format,
+    which can be loaded in Perfetto or chrome://tracing.
+
+    Ranges are timed on the host. Device work is asynchronous, so a range
+    only covers the time spent launching it unless ``synchronize`` is set,
+    which waits for the device at the end of every range at the cost of
+    throughput.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_events: int = 1_000_000,
+        synchronize: bool = False,
+    ) -> None:
+        self.path = path
+        self.max_events = max_events
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.events: List[Dict[str, Any]] = []
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def trace(self, name: str) -> Iterator[None]:
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            if self.synchronize:
+                torch.cuda.synchronize()
+            end = time.perf_counter_ns()
+            if len(self.events) < self.max_events:
+                event = {
+                    "name": name,
+                    "ph": "X",
+                    "ts": start / 1000,
+                    "dur": (end - start) / 1000,
+                    "pid": self._pid,
+                    "tid": threading.get_ident(),
+                }
+                with self._lock:
+                    self.events.append(event)
+
+    def save(self, path: Optional[str] = None) -> None:
+        with self._lock:
+            events = list(self.events)
+        with open(path or self.path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def close(self) -> None:
+        self.save()
+
+
+TRACERS = {
+    "none": Tracer,
+    "profiler": ProfilerTracer,
+    "nvtx": NVTXTracer,
+    "chrome": ChromeTraceTracer,
+}
+
+
+def create_tracer(name: str = "none", **kwargs: Any) -> Tracer:
+    """
+    Creates a tracer by name: ``none``, ``profiler``, ``nvtx`` or ``chrome``.
+    The chrome tracer needs a ``path`` to write the trace to.
+    """
+    if name not in TRACERS:
+        raise ValueError(f"Unknown tracer {name}, expected one of {list(TRACERS)}")
+    return TRACERS[name](**kwargs)
+
+
+def create_tracer_from_env() -> Tracer:
+    """
+    Creates the tracer selected by ``STREAMDIFFUSION_TRACER``, so a running
+    deployment can be traced without code changes. A chrome trace is written
+    to ``STREAMDIFFUSION_TRACE_FILE`` when the process exits.
+    """
+    name = os.environ.get("STREAMDIFFUSION_TRACER", "none")
+    if name != "chrome":
+        return create_tracer(name)
+    tracer = create_tracer(
+        name,
+        path=os.environ.get("STREAMDIFFUSION_TRACE_FILE", "streamdiffusion_trace.json"),
+        max_events=int(os.environ.get("STREAMDIFFUSION_TRACE_MAX_EVENTS", 1_000_000)),
+    )
+    atexit.register(tracer.close)
+    return tracer
+
+
+def traced(name: str) -> Callable[[F], F]:
+    """
+    Wraps a method in a range of ``self.tracer``, looked up on every call so
+    the tracer can be swapped at runtime.
+    """
+
+    def decorator(fn: F) -> F:
+        @functools.wraps(fn)
+        def wrapper(self, *args: Any, **kwargs: Any) -> Any:
+            with self.tracer.trace(name):
+                return fn(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,190 @@
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from streamdiffusion.acceleration.engine_cache import (
+    EngineCache,
+    engine_key,
+    fingerprint_weights,
+    hash_weights,
+)
+
+
+TOOLCHAIN = {"tensorrt": "10.0", "torch": "2.4", "cuda": "12.4", "gpu_arch": "sm_89"}
+PROFILE = {"min_batch_size": 1, "max_batch_size": 4, "height": 512, "width": 512}
+OPTIONS = {"fp16": True}
+
+
+def build_engine(cache, key, name="unet", size=16):
+    path = cache.path_for(key, name)
+    with open(os.path.join(path, f"{name}.engine"), "wb") as f:
+        f.write(key.encode()[:1] * size)
+    return cache.register(key, name, [f"{name}.engine"])
+
+
+def test_engine_key_is_stable():
+    key = engine_key("unet", "abc", PROFILE, OPTIONS, TOOLCHAIN)
+    reordered = dict(reversed(list(PROFILE.items())))
+    assert engine_key("unet", "abc", reordered, OPTIONS, TOOLCHAIN) == key
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        {"name": "vae_decoder"},
+        {"weights_hash": "abd"},
+        {"profile": {**PROFILE, "max_batch_size": 8}},
+        {"build_options": {"fp16": False}},
+        {"toolchain": {**TOOLCHAIN, "gpu_arch": "sm_86"}},
+    ],
+)
+def test_engine_key_changes_with_every_input(change):
+    inputs = {
+        "name": "unet",
+        "weights_hash": "abc",
+        "profile": PROFILE,
+        "build_options": OPTIONS,
+        "toolchain": TOOLCHAIN,
+    }
+    assert engine_key(**{**inputs, **change}) != engine_key(**inputs)
+
+
+def test_hash_weights_follows_content_and_layout():
+    np = pytest.importorskip("numpy")
+    weights = {"a": np.arange(6, dtype=np.float32), "b": np.ones(2, dtype=np.float16)}
+    assert hash_weights(weights) == hash_weights(dict(reversed(list(weights.items()))))
+    assert hash_weights(weights) != hash_weights({**weights, "a": weights["a"] + 1})
+    assert hash_weights(weights) != hash_weights({**weights, "a": weights["a"].reshape(2, 3)})
+    assert hash_weights(weights) != hash_weights({**weights, "b": weights["b"].astype(np.float32)})
+
+
+def test_fingerprint_follows_local_files(tmp_path):
+    checkpoint = tmp_path / "model.safetensors"
+    checkpoint.write_bytes(b"weights")
+    sources = {"model": str(checkpoint), "lora_dict": {"lora": 0.5}}
+    fingerprint = fingerprint_weights(sources)
+    assert fingerprint_weights(dict(reversed(list(sources.items())))) == fingerprint
+    assert fingerprint_weights({**sources, "lora_dict": {"lora": 0.7}}) != fingerprint
+
+    checkpoint.write_bytes(b"new weights")
+    assert fingerprint_weights(sources) != fingerprint
+
+
+def test_weights_hash_is_computed_once(tmp_path):
+    calls = []
+
+    def compute():
+        calls.append(None)
+        return "abc"
+
+    assert EngineCache(str(tmp_path)).weights_hash("f1", compute) == "abc"
+    assert EngineCache(str(tmp_path)).weights_hash("f1", compute) == "abc"
+    assert len(calls) == 1
+
+
+def test_register_then_lookup(tmp_path):
+    cache = EngineCache(str(tmp_path))
+    assert cache.lookup("k1") is None
+    path = build_engine(cache, "k1")
+    assert cache.lookup("k1") == path
+    assert cache.verify("k1")
+
+    # a new instance reads the same manifest
+    entries = EngineCache(str(tmp_path)).entries()
+    assert [entry["key"] for entry in entries] == ["k1"]
+    assert entries[0]["files"]["unet.engine"]["size"] == 16
+
+
+def test_lookup_drops_missing_and_truncated_engines(tmp_path):
+    cache = EngineCache(str(tmp_path))
+    path = build_engine(cache, "k1")
+    os.remove(os.path.join(path, "unet.engine"))
+    assert cache.lookup("k1") is None
+    assert cache.entries() == []
+
+    path = build_engine(cache, "k2")
+    with open(os.path.join(path, "unet.engine"), "wb") as f:
+        f.write(b"x")
+    assert cache.lookup("k2") is None
+    assert not os.path.exists(path)
+
+
+def test_verify_detects_corruption_of_the_same_size(tmp_path):
+    cache = EngineCache(str(tmp_path))
+    path = build_engine(cache, "k1")
+    with open(os.path.join(path, "unet.engine"), "r+b") as f:
+        f.write(b"z")
+    assert cache.verify("k1", full=False)
+    assert not cache.verify("k1")
+    assert cache.verify_all() == ["k1"]
+    assert cache.lookup("k1", verify=True) is None
+
+
+def test_gc_evicts_least_recently_used(tmp_path):
+    cache = EngineCache(str(tmp_path))
+    for key in ("k1", "k2", "k3"):
+        build_engine(cache, key)
+    cache.lookup("k1")
+
+    assert cache.gc(max_entries=2) == ["k2"]
+    assert cache.gc(max_bytes=16) == ["k3"]
+    assert [entry["key"] for entry in cache.entries()] == ["k1"]
+
+
+def test_gc_never_evicts_kept_engines(tmp_path):
+    cache = EngineCache(str(tmp_path), max_entries=1)
+    build_engine(cache, "k1")
+    build_engine(cache, "k2")
+    assert [entry["key"] for entry in cache.entries()] == ["k2"]
+    assert cache.gc(max_entries=0, keep=["k2"]) == []
+
+
+def register_many(root, worker, count):
+    cache = EngineCache(root)
+    for i in range(count):
+        build_engine(cache, f"{worker}-{i}")
+
+
+def build_once(root, key, log_path):
+    cache = EngineCache(root)
+    if cache.lookup(key) is None:
+        with cache.lock_key(key, "unet"):
+            if cache.lookup(key) is None:
+                with open(log_path, "a") as f:
+                    f.write("built\n")
+                # give the other workers time to find the key missing
+                time.sleep(0.2)
+                build_engine(cache, key)
+
+
+@pytest.fixture
+def fork_context():
+    if "fork" not in multiprocessing.get_all_start_methods():
+        pytest.skip("needs the fork start method")
+    return multiprocessing.get_context("fork")
+
+
+def run_processes(context, target, args_list):
+    processes = [context.Process(target=target, args=args) for args in args_list]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+
+def test_concurrent_registers_keep_every_entry(tmp_path, fork_context):
+    run_processes(fork_context, register_many, [(str(tmp_path), worker, 10) for worker in range(4)])
+    keys = {entry["key"] for entry in EngineCache(str(tmp_path)).entries()}
+    assert keys == {f"{worker}-{i}" for worker in range(4) for i in range(10)}
+
+
+def test_concurrent_builds_of_one_key_build_once(tmp_path, fork_context):
+    root = str(tmp_path / "cache")
+    log_path = str(tmp_path / "builds.log")
+    run_processes(fork_context, build_once, [(root, "k1", log_path)] * 4)
+    with open(log_path) as f:
+        assert f.read().splitlines() == ["built"]
+    assert EngineCache(root).verify("k1")
@@ -0,0 +1,203 @@
+import os
+import threading
+import time
+
+import pytest
+
+from streamdiffusion.acceleration.engine_plan import BuildStep, DeploymentProfile, EnginePlan
+
+
+class Recorder:
+    """
+    Stand-in build steps that write their outputs and record what ran,
+    checking that every input exists when a step starts.
+    """
+
+    def __init__(self, delay: float = 0.0) -> None:
+        self.delay = delay
+        self.ran = []
+        self.lock = threading.Lock()
+        self.active_resources = {}
+        self.max_active_resources = {}
+
+    def step(self, name, outputs, inputs=(), resource=None, **kwargs):
+        def run():
+            for path in inputs:
+                assert os.path.exists(path), f"{name} started before {path} existed"
+            with self.lock:
+                if resource is not None:
+                    self.active_resources[resource] = self.active_resources.get(resource, 0) + 1
+                    self.max_active_resources[resource] = max(
+                        self.max_active_resources.get(resource, 0), self.active_resources[resource]
+                    )
+            time.sleep(self.delay)
+            for path in outputs:
+                with open(path, "w") as f:
+                    f.write(name)
+            with self.lock:
+                self.ran.append(name)
+                if resource is not None:
+                    self.active_resources[resource] -= 1
+
+        return BuildStep(name, outputs, run, resource=resource, **kwargs)
+
+
+def engine_plan(recorder, root, names=("unet", "vae_decoder", "vae_encoder")):
+    plan = EnginePlan()
+    for name in names:
+        onnx_path = os.path.join(root, f"{name}.onnx")
+        onnx_opt_path = os.path.join(root, f"{name}.opt.onnx")
+        engine_path = os.path.join(root, f"{name}.engine")
+        plan.add(recorder.step(f"{name}:onnx", [onnx_path], resource="torch_export", intermediate=True))
+        plan.add(
+            recorder.step(
+                f"{name}:onnx_opt",
+                [onnx_opt_path],
+                inputs=[onnx_path],
+                deps=[f"{name}:onnx"],
+                intermediate=True,
+            )
+        )
+        plan.add(
+            recorder.step(
+                f"{name}:engine",
+                [engine_path],
+                inputs=[onnx_opt_path],
+                deps=[f"{name}:onnx_opt"],
+                resource="tensorrt",
+            )
+        )
+    return plan
+
+
+def set_mtime(path, mtime):
+    os.utime(path, (mtime, mtime))
+
+
+def test_order_puts_dependencies_first():
+    plan = EnginePlan(
+        [
+            BuildStep("c", ["c"], lambda: None, deps=["b"]),
+            BuildStep("b", ["b"], lambda: None, deps=["a"]),
+            BuildStep("a", ["a"], lambda: None),
+        ]
+    )
+    assert [step.name for step in plan.order()] == ["a", "b", "c"]
+
+
+def test_order_rejects_cycles_unknown_and_duplicate_steps():
+    cyclic = EnginePlan(
+        [
+            BuildStep("a", ["a"], lambda: None, deps=["b"]),
+            BuildStep("b", ["b"], lambda: None, deps=["a"]),
+        ]
+    )
+    with pytest.raises(ValueError, match="cycle"):
+        cyclic.order()
+    with pytest.raises(ValueError, match="unknown"):
+        EnginePlan([BuildStep("a", ["a"], lambda: None, deps=["missing"])]).order()
+    with pytest.raises(ValueError, match="Duplicate"):
+        EnginePlan([BuildStep("a", ["a"], lambda: None), BuildStep("a", ["b"], lambda: None)])
+
+
+def test_execute_builds_everything_once(tmp_path):
+    recorder = Recorder()
+    finished = engine_plan(recorder, str(tmp_path)).execute()
+    assert sorted(finished) == sorted(recorder.ran)
+    assert len(finished) == 9
+
+    recorder = Recorder()
+    assert engine_plan(recorder, str(tmp_path)).stale_steps() == []
+    assert engine_plan(recorder, str(tmp_path)).execute() == []
+    assert recorder.ran == []
+
+
+def test_newer_input_rebuilds_only_what_follows(tmp_path):
+    engine_plan(Recorder(), str(tmp_path)).execute()
+    for path in tmp_path.iterdir():
+        set_mtime(path, 1000)
+    set_mtime(tmp_path / "vae_decoder.opt.onnx", 2000)
+
+    recorder = Recorder()
+    engine_plan(recorder, str(tmp_path)).execute()
+    assert recorder.ran == ["vae_decoder:engine"]
+
+
+def test_missing_intermediates_are_only_regenerated_when_needed(tmp_path):
+    engine_plan(Recorder(), str(tmp_path)).execute()
+    os.remove(tmp_path / "unet.onnx")
+    os.remove(tmp_path / "unet.opt.onnx")
+
+    recorder = Recorder()
+    engine_plan(recorder, str(tmp_path)).execute()
+    assert recorder.ran == []
+
+    os.remove(tmp_path / "unet.engine")
+    recorder = Recorder()
+    engine_plan(recorder, str(tmp_path)).execute()
+    assert recorder.ran == ["unet:onnx", "unet:onnx_opt", "unet:engine"]
+
+
+def test_existing_intermediates_are_reused(tmp_path):
+    engine_plan(Recorder(), str(tmp_path)).execute()
+    os.remove(tmp_path / "vae_encoder.engine")
+
+    recorder = Recorder()
+    engine_plan(recorder, str(tmp_path)).execute()
+    assert recorder.ran == ["vae_encoder:engine"]
+
+
+def test_forced_step_and_its_dependents_run(tmp_path):
+    engine_plan(Recorder(), str(tmp_path)).execute()
+    recorder = Recorder()
+    plan = engine_plan(recorder, str(tmp_path))
+    plan.steps["unet:onnx_opt"].force = True
+    plan.execute()
+    assert recorder.ran == ["unet:onnx_opt", "unet:engine"]
+
+
+@pytest.mark.parametrize("max_workers", [2, 4])
+def test_parallel_execution_waits_for_dependencies(tmp_path, max_workers):
+    recorder = Recorder(delay=0.02)
+    finished = engine_plan(recorder, str(tmp_path)).execute(max_workers=max_workers)
+
+    assert len(finished) == 9
+    for name in ("unet", "vae_decoder", "vae_encoder"):
+        assert finished.index(f"{name}:onnx") < finished.index(f"{name}:onnx_opt")
+        assert finished.index(f"{name}:onnx_opt") < finished.index(f"{name}:engine")
+    # steps sharing a resource never overlap
+    assert recorder.max_active_resources == {"torch_export": 1, "tensorrt": 1}
+
+
+def test_failing_step_raises(tmp_path):
+    def fail():
+        raise RuntimeError("export failed")
+
+    plan = EnginePlan(
+        [
+            BuildStep("a", [str(tmp_path / "a")], fail),
+            BuildStep("b", [str(tmp_path / "b")], lambda: None, deps=["a"]),
+        ]
+    )
+    with pytest.raises(RuntimeError, match="export failed"):
+        plan.execute(max_workers=2)
+
+
+def test_deployment_profile_batch_sizes():
+    profile = DeploymentProfile.for_pipeline(512, 512, 2, (1, 4), cfg_type="initialize")
+    assert profile.unet_batch_range == (3, 12)
+    assert profile.vae_batch_range == (1, 4)
+    assert profile.opt_unet_batch_size == 12
+
+    full = DeploymentProfile.for_pipeline(512, 512, 3, (2, 2), cfg_type="full")
+    assert full.unet_batch_range == (12, 12)
+
+    txt2img = DeploymentProfile.for_pipeline(512, 512, 4, (1, 1), cfg_type="none", mode="txt2img")
+    assert txt2img.vae_batch_range == (4, 4)
+
+
+def test_deployment_profile_resolution_buckets():
+    profile = DeploymentProfile(resolutions=[(768, 448), (1280, 720), (512, 512)])
+    assert (profile.width, profile.height) == (768, 448)
+    assert profile.max_image_resolution == 1280
+    assert not profile.dynamic_shape
@@ -0,0 +1,110 @@
+import pytest
+
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+
+from streamdiffusion.image_filter import (  # noqa: E402
+    HysteresisSkipPolicy,
+    MotionEMASkipPolicy,
+    SimilarImageFilter,
+    StochasticSkipPolicy,
+    TargetFPSSkipPolicy,
+    create_skip_policy,
+)
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def decisions(policy, similarities, threshold):
+    skipped = []
+    for similarity in similarities:
+        skip = policy.should_skip(torch.tensor(similarity), threshold)
+        policy.update(skip)
+        skipped.append(skip)
+    return skipped
+
+
+def test_hysteresis_holds_skipping_within_the_margin():
+    policy = HysteresisSkipPolicy(margin=0.05)
+    similarities = [0.95, 0.87, 0.84, 0.88, 0.9]
+    assert decisions(policy, similarities, 0.9) == [True, True, False, False, True]
+
+    policy.reset()
+    assert decisions(policy, [0.87], 0.9) == [False]
+
+
+def test_motion_ema_ignores_a_single_changed_frame():
+    policy = MotionEMASkipPolicy(alpha=0.5)
+    similarities = [1.0, 0.85, 1.0, 0.85, 0.85]
+    assert decisions(policy, similarities, 0.9) == [True, True, True, True, False]
+
+    policy.reset()
+    assert decisions(policy, [0.85], 0.9) == [False]
+
+
+def test_target_fps_refills_tokens_with_time():
+    clock = FakeClock()
+    policy = TargetFPSSkipPolicy(target_fps=4, clock=clock)
+    skipped = []
+    for now in [0, 0.125, 0.25, 0.5, 0.5]:
+        clock.now = now
+        skipped.extend(decisions(policy, [0.0], 0.98))
+    assert skipped == [False, True, False, False, True]
+
+
+def test_target_fps_caps_the_burst():
+    clock = FakeClock()
+    policy = TargetFPSSkipPolicy(target_fps=4, burst=3, clock=clock)
+    decisions(policy, [0.0] * 3, 0.98)
+    clock.now = 10
+    assert decisions(policy, [0.0] * 4, 0.98) == [False, False, False, True]
+
+    policy.reset()
+    assert decisions(policy, [0.0] * 4, 0.98) == [False, False, False, True]
+
+
+def test_stochastic_reset_replays_the_seeded_decisions():
+    policy = StochasticSkipPolicy(seed=0)
+    first = decisions(policy, [0.99] * 32, 0.98)
+    assert True in first and False in first
+    policy.reset()
+    assert decisions(policy, [0.99] * 32, 0.98) == first
+
+
+def test_create_skip_policy_passes_arguments():
+    policy = create_skip_policy("target_fps", target_fps=15, burst=2)
+    assert isinstance(policy, TargetFPSSkipPolicy)
+    assert (policy.target_fps, policy.burst) == (15, 2)
+    assert create_skip_policy("hysteresis", margin=0.1).margin == 0.1
+
+
+@pytest.mark.parametrize(
+    "name, kwargs",
+    [("target_fps", {}), ("hysteresis", {"target_fps": 15}), ("unknown", {})],
+)
+def test_create_skip_policy_rejects_bad_arguments(name, kwargs):
+    with pytest.raises(ValueError):
+        create_skip_policy(name, **kwargs)
+
+
+def test_filter_set_policy_by_name():
+    clock = FakeClock()
+    image_filter = SimilarImageFilter(max_skip_frame=10)
+    image_filter.set_policy("target_fps", target_fps=4, clock=clock)
+    frame = torch.zeros(3, 8, 8)
+    # the first frame is stored, the second spends the only token
+    assert image_filter(frame) is frame
+    assert image_filter(frame) is frame
+    assert image_filter(frame) is None
+    clock.now = 0.25
+    assert image_filter(frame) is frame
+
+    with pytest.raises(ValueError):
+        image_filter.set_policy(HysteresisSkipPolicy(), margin=0.1)
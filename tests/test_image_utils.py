@@ -0,0 +1,64 @@
+import pytest
+
+
+torch = pytest.importorskip("torch")
+np = pytest.importorskip("numpy")
+pytest.importorskip("diffusers")
+
+from streamdiffusion.image_utils import PinnedBufferPool, postprocess_image, to_host  # noqa: E402
+
+
+def test_uint8_output_with_mixed_denormalize():
+    image = torch.stack([torch.full((3, 2, 2), -1.0), torch.full((3, 2, 2), 0.5)])
+    output = postprocess_image(image, output_type="uint8", do_denormalize=[True, False])
+    assert output.dtype == np.uint8
+    assert output.shape == (2, 2, 2, 3)
+    assert (output[0] == 0).all()
+    assert (output[1] == 128).all()
+
+
+def test_uint8_output_matches_pil_output():
+    image = torch.rand(1, 3, 4, 4) * 2 - 1
+    pixels = postprocess_image(image, output_type="uint8")
+    pil_image = postprocess_image(image, output_type="pil")[0]
+    assert np.array_equal(np.asarray(pil_image), pixels[0])
+
+
+def test_unknown_output_type_raises():
+    with pytest.raises(ValueError):
+        postprocess_image(torch.zeros(1, 3, 2, 2), output_type="bmp")
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="needs CUDA")
+def test_to_host_reuses_pinned_buffers():
+    images = torch.rand(1, 4, 4, 3, device="cuda")
+    first = to_host(images)
+    assert first.is_pinned()
+    assert torch.equal(first, images.cpu())
+
+    event = torch.cuda.Event()
+    second = to_host(images * 2, event=event)
+    event.synchronize()
+    assert second.data_ptr() == first.data_ptr()
+    assert torch.equal(second, (images * 2).cpu())
+
+    # a different shape gets its own buffer
+    assert to_host(images[:, :2]).data_ptr() != first.data_ptr()
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="needs CUDA")
+def test_pinned_buffer_pool_hands_out_a_ring_per_shape():
+    pool = PinnedBufferPool(depth=3)
+    ring = [pool.get((2, 3), torch.uint8).data_ptr() for _ in range(3)]
+    assert len(set(ring)) == 3
+    assert [pool.get((2, 3), torch.uint8).data_ptr() for _ in range(3)] == ring
+    assert pool.get((2, 3), torch.float32).data_ptr() not in ring
+
+    images = torch.rand(2, 3, device="cuda")
+    event = torch.cuda.Event()
+    host_images = to_host(images, event=event, pool=pool)
+    # the buffer is handed out again only after the recorded copy finished
+    for _ in range(pool.depth - 1):
+        pool.get((2, 3), torch.float32)
+    assert pool.get((2, 3), torch.float32).data_ptr() == host_images.data_ptr()
+    assert event.query()
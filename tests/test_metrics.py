@@ -0,0 +1,83 @@
+import pytest
+
+
+pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+
+from streamdiffusion import metrics  # noqa: E402
+from streamdiffusion.metrics import MetricsRegistry  # noqa: E402
+from streamdiffusion.timer import Timer, create_timer  # noqa: E402
+
+
+class PendingTimer(Timer):
+    """A timer whose device work finishes only when told to."""
+
+    def __init__(self) -> None:
+        self.finished = False
+
+    def start(self) -> None:
+        self.finished = False
+
+    def stop(self) -> None:
+        pass
+
+    def ready(self) -> bool:
+        return self.finished
+
+    def elapsed(self) -> float:
+        return 0.001
+
+
+def count_timers(monkeypatch, factory=create_timer):
+    created = []
+
+    def create(device=None):
+        created.append(factory())
+        return created[-1]
+
+    monkeypatch.setattr(metrics, "create_timer", create)
+    return created
+
+
+def test_time_stage_reuses_finished_timers(monkeypatch):
+    created = count_timers(monkeypatch)
+    registry = MetricsRegistry()
+    for _ in range(10):
+        with registry.time_stage("unet"):
+            pass
+        with registry.time_stage("vae_decode"):
+            pass
+    assert len(created) == 2
+    assert registry.get("stage_seconds", stage="unet").count == 10
+    assert registry.get("stage_seconds", stage="vae_decode").count == 10
+
+
+def test_time_stage_does_not_reuse_pending_timers(monkeypatch):
+    created = count_timers(monkeypatch, PendingTimer)
+    registry = MetricsRegistry()
+    for _ in range(3):
+        with registry.time_stage("unet"):
+            pass
+    assert len(created) == 3
+    assert registry.get("stage_seconds", stage="unet") is None
+
+    for timer in created:
+        timer.finished = True
+    registry.flush(block=False)
+    assert registry.get("stage_seconds", stage="unet").count == 3
+
+    for _ in range(3):
+        with registry.time_stage("unet"):
+            pass
+    assert len(created) == 3
+
+
+def test_render_leaves_running_stages_pending(monkeypatch):
+    created = count_timers(monkeypatch, PendingTimer)
+    registry = MetricsRegistry()
+    with registry.time_stage("unet"):
+        pass
+    assert "stage_seconds_count" not in registry.render()
+
+    created[0].finished = True
+    assert 'stage_seconds_count{stage="unet"} 1' in registry.render()
@@ -0,0 +1,97 @@
+import pytest
+
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+pytest.importorskip("transformers")
+
+from torch.profiler import ProfilerActivity, profile  # noqa: E402
+
+from utils.wrapper import StreamDiffusionWrapper  # noqa: E402
+
+
+SIZE = 64
+BUFFERS = (
+    "stock_noise",
+    "latent_buffer",
+    "unet_input_buffer",
+    "model_pred_buffer",
+    "noise_buffer",
+    "f_theta_buffer",
+    "denoised_buffer",
+    "delta_x_buffer",
+)
+
+
+def buffer_pointers(stream):
+    buffers = [getattr(stream, name) for name in BUFFERS]
+    return tuple(None if buffer is None else buffer.data_ptr() for buffer in buffers)
+
+
+def create_wrapper(model_dir, cfg_type):
+    wrapper = StreamDiffusionWrapper(
+        model_id_or_path=model_dir,
+        t_index_list=[10, 20, 30],
+        mode="img2img",
+        output_type="pt",
+        device="cpu",
+        dtype=torch.float32,
+        width=SIZE,
+        height=SIZE,
+        acceleration="none",
+        use_lcm_lora=False,
+        use_tiny_vae=False,
+        cfg_type=cfg_type,
+    )
+    wrapper.prepare(prompt="a cat", num_inference_steps=50, guidance_scale=1.2)
+    return wrapper
+
+
+def run_frames(wrapper, count):
+    generator = torch.Generator().manual_seed(0)
+    for _ in range(count):
+        wrapper(torch.randint(0, 256, (SIZE, SIZE, 3), dtype=torch.uint8, generator=generator))
+
+
+@pytest.mark.parametrize("cfg_type", ["none", "self", "initialize", "full"])
+def test_latent_buffers_are_reused_across_frames(tiny_model, cfg_type):
+    wrapper = create_wrapper(tiny_model, cfg_type)
+    stream = wrapper.stream
+    allocations = stream.latent_buffer_allocations
+    pointers = buffer_pointers(stream)
+
+    run_frames(wrapper, 5)
+    assert stream.latent_buffer_allocations == allocations
+    assert buffer_pointers(stream) == pointers
+
+    # preparing again with the same shapes clears the buffers in place
+    wrapper.prepare(prompt="a cat", num_inference_steps=50, guidance_scale=1.2)
+    assert stream.latent_buffer_allocations == allocations
+    assert buffer_pointers(stream) == pointers
+
+
+@pytest.mark.parametrize("cfg_type", ["none", "self", "initialize", "full"])
+def test_scheduler_step_allocates_no_latents(tiny_model, cfg_type):
+    wrapper = create_wrapper(tiny_model, cfg_type)
+    stream = wrapper.stream
+    run_frames(wrapper, 2)
+
+    num_unet_rows = stream.batch_size
+    if cfg_type == "initialize":
+        num_unet_rows += stream.frame_bff_size
+    elif cfg_type == "full":
+        num_unet_rows *= 2
+    model_pred = torch.randn(num_unet_rows, 4, stream.latent_height, stream.latent_width)
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as profiler:
+        denoised_batch, _ = stream._guided_scheduler_step(model_pred, stream.latent_buffer)
+    assert denoised_batch.data_ptr() == stream.denoised_buffer.data_ptr()
+
+    # python scalars become tiny tensors, anything the size of a latent is a real allocation
+    latent_bytes = 4 * stream.latent_height * stream.latent_width * model_pred.element_size()
+    allocations = [
+        event.self_cpu_memory_usage
+        for event in profiler.events()
+        if event.self_cpu_memory_usage >= latent_bytes
+    ]
+    assert allocations == []
@@ -0,0 +1,91 @@
+import pytest
+
+
+torch = pytest.importorskip("torch")
+np = pytest.importorskip("numpy")
+pytest.importorskip("av")
+pytest.importorskip("diffusers")
+pytest.importorskip("transformers")
+
+from utils.sharded_video import process_video_sharded  # noqa: E402
+from utils.video_processor import (  # noqa: E402
+    VideoWriter,
+    iter_video_frames,
+    process_video,
+    video_frame_timestamps,
+)
+from utils.wrapper import StreamDiffusionWrapper  # noqa: E402
+
+
+SIZE = 64
+NUM_FRAMES = 13
+
+
+@pytest.fixture(scope="module")
+def input_video(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("video") / "input.mp4")
+    rng = np.random.default_rng(0)
+    base = rng.integers(0, 256, (SIZE, SIZE, 3), dtype=np.uint8)
+    # short keyframe intervals so chunks seek instead of decoding from the start
+    with VideoWriter(path, SIZE, SIZE, 10, options={"g": "4", "bf": "2"}) as writer:
+        for index in range(NUM_FRAMES):
+            writer.write(np.roll(base, 4 * index, axis=1))
+    return path
+
+
+def test_seeking_matches_decoding_from_the_start(input_video):
+    frames = list(iter_video_frames(input_video))
+    timestamps = video_frame_timestamps(input_video)
+    assert len(timestamps) == len(frames) == NUM_FRAMES
+    for start in (1, 5, 8, NUM_FRAMES - 1):
+        seeked = list(iter_video_frames(input_video, start_pts=timestamps[start]))
+        assert len(seeked) == NUM_FRAMES - start
+        for expected, frame in zip(frames[start:], seeked):
+            assert np.array_equal(expected, frame)
+
+
+def wrapper_kwargs(model_dir, cfg_type):
+    return {
+        "model_id_or_path": model_dir,
+        "t_index_list": [10, 30],
+        "mode": "img2img",
+        "output_type": "uint8",
+        "device": "cpu",
+        "dtype": torch.float32,
+        "width": SIZE,
+        "height": SIZE,
+        "acceleration": "none",
+        "use_lcm_lora": False,
+        "use_tiny_vae": False,
+        "cfg_type": cfg_type,
+    }
+
+
+@pytest.mark.parametrize("cfg_type", ["none", "self"])
+def test_sharded_output_matches_serial(tmp_path, tiny_model, input_video, cfg_type):
+    kwargs = wrapper_kwargs(tiny_model, cfg_type)
+    prepare_kwargs = {"prompt": "a cat", "num_inference_steps": 50, "guidance_scale": 1.2}
+
+    wrapper = StreamDiffusionWrapper(**kwargs)
+    wrapper.prepare(**prepare_kwargs)
+    serial_path = str(tmp_path / "serial.mp4")
+    serial_stats = process_video(wrapper, input_video, serial_path, seed=7)
+
+    sharded_path = str(tmp_path / "sharded.mp4")
+    # chunks of 4 frames put several chunk boundaries inside the clip
+    sharded_stats = process_video_sharded(
+        input_video,
+        sharded_path,
+        kwargs,
+        prepare_kwargs,
+        num_workers=2,
+        chunk_size=4,
+        seed=7,
+    )
+
+    assert serial_stats.frames == sharded_stats.frames == NUM_FRAMES
+    serial_frames = list(iter_video_frames(serial_path))
+    sharded_frames = list(iter_video_frames(sharded_path))
+    assert len(serial_frames) == len(sharded_frames) == NUM_FRAMES
+    for index, (serial, sharded) in enumerate(zip(serial_frames, sharded_frames)):
+        assert np.array_equal(serial, sharded), f"frame {index} differs"
@@ -0,0 +1,48 @@
+import asyncio
+import itertools
+
+import pytest
+
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+
+from utils.stream_pipeline import StagedStream  # noqa: E402
+
+
+class FakeWrapper:
+    mode = "img2img"
+    frame_buffer_size = 1
+    device = "cpu"
+    dtype = torch.float32
+    output_type = "pt"
+
+    def stream(self, image):
+        return image
+
+    def apply_safety_checker(self, image, image_tensor):
+        return image
+
+
+def test_async_with_stops_the_stages_when_the_loop_breaks():
+    frames = itertools.repeat(torch.zeros(1, 3, 8, 8))
+
+    async def consume():
+        async with StagedStream(FakeWrapper(), frames) as outputs:
+            async for _ in outputs:
+                break
+        return outputs
+
+    outputs = asyncio.run(consume())
+    assert not any(thread.is_alive() for thread in outputs._threads)
+
+
+def test_stage_errors_reach_the_consumer():
+    def frames():
+        yield torch.zeros(1, 3, 8, 8)
+        raise RuntimeError("decoding failed")
+
+    with pytest.raises(RuntimeError, match="decoding failed"):
+        with StagedStream(FakeWrapper(), frames()) as outputs:
+            list(outputs)
+    assert not any(thread.is_alive() for thread in outputs._threads)
@@ -0,0 +1,229 @@
+import multiprocessing
+import os
+import tempfile
+import time
+import warnings
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import islice
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from utils.video_processor import (
+    ProgressCallback,
+    VideoProcessingStats,
+    VideoWriter,
+    check_wrapper,
+    count_video_frames,
+    iter_batches,
+    iter_video_frames,
+    probe_video,
+    run_batches,
+    video_frame_timestamps,
+)
+
+
+if TYPE_CHECKING:
+    from utils.wrapper import StreamDiffusionWrapper
+
+
+# the wrapper of a worker process, loaded once and reused for all its chunks
+_worker_wrapper: Optional["StreamDiffusionWrapper"] = None
+_worker_prepare_kwargs: Dict[str, Any] = {}
+
+
+def _init_worker(wrapper_kwargs: Dict[str, Any], prepare_kwargs: Dict[str, Any]) -> None:
+    global _worker_wrapper, _worker_prepare_kwargs
+    from utils.wrapper import StreamDiffusionWrapper
+
+    _worker_wrapper = StreamDiffusionWrapper(**wrapper_kwargs)
+    _worker_prepare_kwargs = prepare_kwargs
+    check_wrapper(_worker_wrapper)
+
+    # the in-flight latents and stock noise stay with their frame and are rebuilt
+    # by the warm-up batches, only the filter compares a frame with earlier ones
+    if _worker_wrapper.stream.similar_image_filter:
+        warnings.warn(
+            "The similar image filter depends on earlier frames, so sharded output "
+            "will differ from serial processing around chunk boundaries."
+        )
+
+
+def _process_chunk(
+    input: str,
+    chunk_path: str,
+    start: int,
+    end: int,
+    warmup_start: int,
+    warmup_start_pts: Optional[int],
+    seed: int,
+) -> Tuple[int, float]:
+    wrapper = _worker_wrapper
+    # reset the in-flight latents so every chunk starts from the same state
+    wrapper.prepare(**_worker_prepare_kwargs)
+    batch_size = wrapper.frame_buffer_size
+
+    outputs = np.lib.format.open_memmap(
+        chunk_path,
+        mode="w+",
+        dtype=np.uint8,
+        shape=(end - start, wrapper.height, wrapper.width, 3),
+    )
+    written = 0
+
+    def write(frames: List[np.ndarray]) -> None:
+        nonlocal written
+        for frame in frames:
+            outputs[written] = frame
+            written += 1
+
+    if warmup_start_pts is None:
+        # without timestamps the frames can only be counted from the start
+        frames = islice(
+            iter_video_frames(input, wrapper.width, wrapper.height), warmup_start, end
+        )
+    else:
+        frames = islice(
+            iter_video_frames(input, wrapper.width, wrapper.height, warmup_start_pts),
+            end - warmup_start,
+        )
+
+    start_time = time.perf_counter()
+    run_batches(
+        wrapper,
+        iter_batches(frames, batch_size),
+        write,
+        skip_batches=(start - warmup_start) // batch_size,
+        seed=seed,
+        first_batch=warmup_start // batch_size,
+    )
+    outputs.flush()
+    if written != end - start:
+        raise RuntimeError(
+            f"Chunk {start}-{end} produced {written} frames, expected {end - start}."
+        )
+    return written, time.perf_counter() - start_time
+
+
+def process_video_sharded(
+    input: str,
+    output: str,
+    wrapper_kwargs: Dict[str, Any],
+    prepare_kwargs: Dict[str, Any],
+    num_workers: int = 2,
+    chunk_size: int = 256,
+    warmup_batches: Optional[int] = None,
+    seed: int = 2,
+    tmp_dir: Optional[str] = None,
+    progress: Optional[ProgressCallback] = None,
+) -> VideoProcessingStats:
+    """
+    Runs img2img over a video file in chunks on a pool of worker processes
+    and stitches the outputs in order.
+
+    Every worker loads its own StreamDiffusionWrapper from
+    ``wrapper_kwargs`` once and calls ``prepare(**prepare_kwargs)`` before
+    each chunk. A chunk starts with ``warmup_batches`` batches of the frames
+    before it, whose outputs are dropped, to refill the denoising batch. The
+    generator is reseeded per batch. Every in-flight latent, and with
+    ``cfg_type`` "self" or "initialize" its stock noise, only depends on its
+    own frame, so without the similar image filter the output is
+    frame-identical to ``process_video(..., seed=seed)`` with the same
+    settings for every cfg_type. Chunk outputs are kept losslessly as .npy
+    files until they are stitched.
+
+    Parameters
+    ----------
+    input : str
+        The input video file.
+    output : str
+        The output video file.
+    wrapper_kwargs : Dict[str, Any]
+        The StreamDiffusionWrapper arguments, with mode "img2img" and
+        output_type "uint8".
+    prepare_kwargs : Dict[str, Any]
+        The arguments of StreamDiffusionWrapper.prepare.
+    num_workers : int, optional
+        The number of worker processes, by default 2.
+    chunk_size : int, optional
+        The number of frames per chunk, rounded up to a multiple of
+        frame_buffer_size, by default 256.
+    warmup_batches : Optional[int], optional
+        The number of batches before each chunk that are run to refill the
+        denoising batch, by default len(t_index_list) - 1.
+    seed : int, optional
+        The base seed of the per-batch reseeding, by default 2.
+    tmp_dir : Optional[str], optional
+        Where chunk outputs are kept, by default a new temporary directory.
+    progress : Optional[ProgressCallback], optional
+        Called with the stats after each stitched chunk, by default None.
+
+    Returns
+    -------
+    VideoProcessingStats
+        The number of frames written and the throughput. model_time sums
+        the time of all workers.
+    """
+    batch_size = wrapper_kwargs.get("frame_buffer_size", 1)
+    if warmup_batches is None:
+        use_denoising_batch = wrapper_kwargs.get("use_denoising_batch", True)
+        warmup_batches = (
+            len(wrapper_kwargs["t_index_list"]) - 1 if use_denoising_batch else 0
+        )
+    chunk_size = -(-chunk_size // batch_size) * batch_size
+
+    _, _, fps, _ = probe_video(input)
+    # the container's frame count can be missing or off, chunks need the exact one
+    timestamps = video_frame_timestamps(input)
+    total_frames = count_video_frames(input) if timestamps is None else len(timestamps)
+    stats = VideoProcessingStats(total_frames)
+
+    own_tmp_dir = tmp_dir is None
+    if own_tmp_dir:
+        tmp_dir = tempfile.mkdtemp(prefix="streamdiffusion_chunks_")
+
+    chunks = []
+    for start in range(0, total_frames, chunk_size):
+        end = min(start + chunk_size, total_frames)
+        warmup_start = max(0, start - warmup_batches * batch_size)
+        chunk_path = os.path.join(tmp_dir, f"chunk_{start:08d}.npy")
+        warmup_start_pts = None if timestamps is None else timestamps[warmup_start]
+        chunks.append((chunk_path, start, end, warmup_start, warmup_start_pts))
+
+    # CUDA cannot be used in forked processes
+    executor = ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(wrapper_kwargs, prepare_kwargs),
+    )
+    writer = None
+    try:
+        futures: List[Future] = [
+            executor.submit(_process_chunk, input, *chunk, seed) for chunk in chunks
+        ]
+        for (chunk_path, *_), future in zip(chunks, futures):
+            _, model_time = future.result()
+            stats.model_time += model_time
+            outputs = np.load(chunk_path, mmap_mode="r")
+            if writer is None:
+                writer = VideoWriter(output, outputs.shape[2], outputs.shape[1], fps)
+            for frame in outputs:
+                writer.write(np.ascontiguousarray(frame))
+            stats.frames += len(outputs)
+            del outputs
+            os.remove(chunk_path)
+            if progress is not None:
+                progress(stats)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        if writer is not None:
+            writer.close()
+        if own_tmp_dir:
+            for chunk_path, *_ in chunks:
+                if os.path.exists(chunk_path):
+                    os.remove(chunk_path)
+            os.rmdir(tmp_dir)
+        stats.end_time = time.perf_counter()
+
+    return stats
@@ -0,0 +1,293 @@
+import asyncio
+import queue
+import threading
+from typing import TYPE_CHECKING, Any, Iterable, Iterator, Optional, Tuple, Union
+
+import numpy as np
+import torch
+from PIL import Image
+
+from streamdiffusion.image_utils import (
+    PinnedBufferPool,
+    denormalize_to_uint8,
+    numpy_to_pil,
+    postprocess_image,
+    to_host,
+)
+
+
+if TYPE_CHECKING:
+    from utils.wrapper import StreamDiffusionWrapper
+
+
+_END = object()
+
+
+class _StageError:
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+
+
+class StagedStream:
+    """
+    Runs img2img over a sequence of frames as overlapping stages.
+
+    Three threads connected by bounded queues handle preprocessing (PIL
+    resize, normalization and upload), the model (VAE encode, UNet, VAE
+    decode) and postprocessing (download and conversion to the output
+    type). Frames flow through the stages in order, so outputs are yielded
+    in input order. On CUDA the uploads and downloads are issued on a
+    separate copy stream, so they overlap with the model on the compute
+    stream.
+
+    Iterate over the object, either with ``for`` or ``async for``, to get
+    the outputs. Use it as a context manager, ``with`` or ``async with``, so
+    the stages are shut down however the loop ends: a consumer that breaks
+    out of ``async for`` or is cancelled otherwise leaves the threads
+    running until they are garbage collected. Calling ``close``, or
+    ``aclose`` from a coroutine, shuts them down too.
+
+    Usage::
+
+        async with wrapper.process(frames) as outputs:
+            async for image in outputs:
+                ...
+    """
+
+    def __init__(
+        self,
+        wrapper: "StreamDiffusionWrapper",
+        frames: Iterable[Union[str, Image.Image, torch.Tensor]],
+        queue_size: int = 2,
+    ) -> None:
+        """
+        Starts the stage threads.
+
+        Parameters
+        ----------
+        wrapper : StreamDiffusionWrapper
+            A prepared wrapper in img2img mode with frame_buffer_size 1.
+        frames : Iterable[Union[str, Image.Image, torch.Tensor]]
+            The input frames. Float tensors are expected to be preprocessed
+            already, uint8 tensors are HWC or NHWC RGB pixels.
+        queue_size : int, optional
+            The number of frames each stage may hold ahead of the next one,
+            by default 2.
+        """
+        if wrapper.mode != "img2img":
+            raise ValueError("StagedStream only supports img2img mode.")
+        if wrapper.frame_buffer_size != 1:
+            raise ValueError("StagedStream only supports frame_buffer_size=1.")
+
+        self.wrapper = wrapper
+        self.device = torch.device(wrapper.device)
+        self.use_cuda = self.device.type == "cuda" and torch.cuda.is_available()
+        self.copy_stream = torch.cuda.Stream(self.device) if self.use_cuda else None
+        # a frame's host buffers are reused once it has left every queue and stage
+        self._host_buffers = PinnedBufferPool(depth=3 * queue_size + 4)
+
+        self._stop = threading.Event()
+        self._preprocessed: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._predicted: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._outputs: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._threads = [
+            threading.Thread(target=self._run_preprocess, args=(frames,), daemon=True),
+            threading.Thread(target=self._run_model, daemon=True),
+            threading.Thread(target=self._run_postprocess, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def __iter__(self) -> Iterator[Union[Image.Image, torch.Tensor, np.ndarray]]:
+        try:
+            while True:
+                item = self._next()
+                if item is _END:
+                    return
+                yield item
+        finally:
+            self.close()
+
+    def __enter__(self) -> "StagedStream":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def __aiter__(self) -> "StagedStream":
+        return self
+
+    async def __anext__(self) -> Union[Image.Image, torch.Tensor, np.ndarray]:
+        item = await asyncio.get_running_loop().run_in_executor(None, self._next)
+        if item is _END:
+            await self.aclose()
+            raise StopAsyncIteration
+        return item
+
+    async def __aenter__(self) -> "StagedStream":
+        return self
+
+    async def __aexit__(self, *args: Any) -> None:
+        await self.aclose()
+
+    def close(self) -> None:
+        """
+        Stops the stages and waits for their threads to exit.
+        """
+        self._stop.set()
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
+
+    async def aclose(self) -> None:
+        """
+        Stops the stages and waits for their threads to exit without blocking
+        the event loop, e.g. while the model finishes the frame in flight.
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    def _next(self) -> Any:
+        # polls, so closing the stream also frees an executor thread waiting here
+        while not self._stop.is_set():
+            try:
+                item = self._outputs.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if isinstance(item, _StageError):
+                self.close()
+                raise item.error
+            return item
+        return _END
+
+    def _put(self, target: queue.Queue, item: Any) -> bool:
+        # a bounded put that gives up once the consumer has gone away
+        while not self._stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, source: queue.Queue) -> Any:
+        while not self._stop.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _run_preprocess(self, frames: Iterable) -> None:
+        try:
+            for frame in frames:
+                if not self._put(self._preprocessed, self._preprocess(frame)):
+                    return
+            self._put(self._preprocessed, _END)
+        except BaseException as e:
+            self._put(self._preprocessed, _StageError(e))
+
+    def _run_model(self) -> None:
+        try:
+            while True:
+                item = self._get(self._preprocessed)
+                if item is _END or isinstance(item, _StageError):
+                    self._put(self._predicted, item)
+                    return
+                if not self._put(self._predicted, self._predict(*item)):
+                    return
+        except BaseException as e:
+            self._put(self._predicted, _StageError(e))
+
+    def _run_postprocess(self) -> None:
+        try:
+            while True:
+                item = self._get(self._predicted)
+                if item is _END or isinstance(item, _StageError):
+                    self._put(self._outputs, item)
+                    return
+                if not self._put(self._outputs, self._postprocess(*item)):
+                    return
+        except BaseException as e:
+            self._put(self._outputs, _StageError(e))
+
+    def _preprocess(
+        self, frame: Union[str, Image.Image, torch.Tensor]
+    ) -> Tuple[torch.Tensor, Optional["torch.cuda.Event"]]:
+        wrapper = self.wrapper
+        if isinstance(frame, str):
+            frame = Image.open(frame)
+        if isinstance(frame, Image.Image):
+            frame = frame.convert("RGB").resize((wrapper.width, wrapper.height))
+            frame = wrapper.stream.image_processor.preprocess(
+                frame, wrapper.height, wrapper.width
+            )
+
+        # raw pixels are uploaded as uint8 and normalized on the device
+        upload = wrapper.preprocess_image if frame.dtype == torch.uint8 else self._upload
+
+        if not self.use_cuda or frame.device.type == "cuda":
+            return upload(frame), None
+
+        # upload on the copy stream so it overlaps with the previous frame's model work
+        pinned_frame = self._host_buffers.get(frame.shape, frame.dtype)
+        pinned_frame.copy_(frame)
+        with torch.cuda.stream(self.copy_stream):
+            image = upload(pinned_frame)
+            uploaded = torch.cuda.Event()
+            uploaded.record(self.copy_stream)
+        self._host_buffers.record(pinned_frame, uploaded)
+        return image, uploaded
+
+    def _upload(self, frame: torch.Tensor) -> torch.Tensor:
+        return frame.to(device=self.device, dtype=self.wrapper.dtype, non_blocking=True)
+
+    @torch.no_grad()
+    def _predict(
+        self, image: torch.Tensor, uploaded: Optional[torch.cuda.Event]
+    ) -> Tuple[torch.Tensor, Optional["torch.cuda.Event"], torch.Tensor]:
+        if uploaded is not None:
+            compute_stream = torch.cuda.current_stream(self.device)
+            compute_stream.wait_event(uploaded)
+            image.record_stream(compute_stream)
+
+        image_tensor = self.wrapper.stream(image)
+        if not self.use_cuda:
+            return self._to_output_tensor(image_tensor), None, image_tensor
+
+        # download on the copy stream once the model is done with this frame
+        predicted = torch.cuda.Event()
+        predicted.record(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.copy_stream):
+            self.copy_stream.wait_event(predicted)
+            image_tensor.record_stream(self.copy_stream)
+            output_tensor = self._to_output_tensor(image_tensor)
+            downloaded = torch.cuda.Event()
+            output_tensor_cpu = to_host(output_tensor, downloaded, self._host_buffers)
+        return output_tensor_cpu, downloaded, image_tensor
+
+    def _to_output_tensor(self, image_tensor: torch.Tensor) -> torch.Tensor:
+        # PIL and uint8 outputs only need the final pixels, a quarter of the float32 bytes
+        if self.wrapper.output_type in ("pil", "uint8"):
+            return denormalize_to_uint8(image_tensor)
+        return image_tensor.float()
+
+    @torch.no_grad()
+    def _postprocess(
+        self,
+        output_tensor: torch.Tensor,
+        downloaded: Optional[torch.cuda.Event],
+        image_tensor: torch.Tensor,
+    ) -> Union[Image.Image, torch.Tensor, np.ndarray]:
+        if downloaded is not None:
+            downloaded.synchronize()
+        output_type = self.wrapper.output_type
+        if output_type == "uint8":
+            image = output_tensor.numpy()[0]
+            if downloaded is not None:
+                # the pinned buffer is reused by a later frame
+                image = image.copy()
+        elif output_type == "pil":
+            image = numpy_to_pil(output_tensor.numpy())[0]
+        else:
+            image = postprocess_image(output_tensor.cpu(), output_type=output_type)[0]
+        return self.wrapper.apply_safety_checker(image, image_tensor)
@@ -0,0 +1,410 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from fractions import Fraction
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+
+if TYPE_CHECKING:
+    from utils.wrapper import StreamDiffusionWrapper
+
+
+_END = object()
+
+ProgressCallback = Callable[["VideoProcessingStats"], None]
+
+
+class VideoProcessingStats:
+    """
+    Progress and throughput of a video processing run.
+    """
+
+    def __init__(self, total_frames: Optional[int] = None) -> None:
+        self.total_frames = total_frames
+        self.frames = 0
+        self.start_time = time.perf_counter()
+        self.end_time: Optional[float] = None
+        self.model_time = 0.0
+
+    @property
+    def elapsed(self) -> float:
+        end_time = self.end_time if self.end_time is not None else time.perf_counter()
+        return end_time - self.start_time
+
+    @property
+    def fps(self) -> float:
+        return self.frames / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __repr__(self) -> str:
+        total = f"/{self.total_frames}" if self.total_frames else ""
+        return (
+            f"{self.frames}{total} frames in {self.elapsed:.1f}s "
+            f"({self.fps:.2f} fps, {self.model_time:.1f}s in the model)"
+        )
+
+
+def probe_video(path: str) -> Tuple[int, int, Fraction, int]:
+    """
+    Reads the size, frame rate and frame count of a video without decoding it.
+
+    Parameters
+    ----------
+    path : str
+        The video file.
+
+    Returns
+    -------
+    Tuple[int, int, Fraction, int]
+        The width, height, frame rate and number of frames. The frame count
+        is 0 when the container does not record it.
+    """
+    import av
+
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        fps = stream.average_rate or Fraction(30)
+        return stream.width, stream.height, fps, stream.frames
+
+
+def iter_video_frames(
+    path: str,
+    width: Optional[int] = None,
+    height: Optional[int] = None,
+    start_pts: Optional[int] = None,
+) -> Iterator[np.ndarray]:
+    """
+    Decodes a video one frame at a time.
+
+    Parameters
+    ----------
+    path : str
+        The video file.
+    width : Optional[int], optional
+        The width to scale the frames to, by default the video width.
+    height : Optional[int], optional
+        The height to scale the frames to, by default the video height.
+    start_pts : Optional[int], optional
+        The timestamp of the first frame to yield, from
+        video_frame_timestamps, by default the first frame of the video.
+
+    Yields
+    ------
+    np.ndarray
+        uint8 HWC RGB frames.
+    """
+    import av
+
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        if start_pts is not None:
+            # lands on the keyframe at or before start_pts, the frames up to it are dropped
+            container.seek(start_pts, stream=stream, backward=True)
+        for frame in container.decode(stream):
+            if start_pts is not None and frame.pts < start_pts:
+                continue
+            yield frame.to_ndarray(
+                width=width or frame.width, height=height or frame.height, format="rgb24"
+            )
+
+
+class VideoWriter:
+    """
+    Encodes uint8 HWC RGB frames to a video file as they arrive.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        width: int,
+        height: int,
+        fps: Fraction,
+        codec: str = "libx264",
+        options: Optional[dict] = None,
+    ) -> None:
+        import av
+
+        self.av = av
+        self.container = av.open(path, mode="w")
+        self.stream = self.container.add_stream(codec, rate=fps, options=options or {})
+        self.stream.width = width
+        self.stream.height = height
+        self.stream.pix_fmt = "yuv420p"
+
+    def write(self, frame: np.ndarray) -> None:
+        video_frame = self.av.VideoFrame.from_ndarray(frame, format="rgb24")
+        for packet in self.stream.encode(video_frame):
+            self.container.mux(packet)
+
+    def close(self) -> None:
+        for packet in self.stream.encode():
+            self.container.mux(packet)
+        self.container.close()
+
+    def __enter__(self) -> "VideoWriter":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
+def _prefetch(iterable: Iterable, size: int) -> Iterator:
+    # decodes ahead on a separate thread, holding at most size items
+    items: queue.Queue = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def run() -> None:
+        try:
+            for item in iterable:
+                while not stop.is_set():
+                    try:
+                        items.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            items.put(_END)
+        except BaseException as e:
+            items.put(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def iter_batches(frames: Iterable[np.ndarray], batch_size: int) -> Iterator[List[np.ndarray]]:
+    batch = []
+    for frame in frames:
+        batch.append(frame)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def count_video_frames(path: str) -> int:
+    """
+    Counts the frames of a video by reading its packets, without decoding.
+
+    Parameters
+    ----------
+    path : str
+        The video file.
+
+    Returns
+    -------
+    int
+        The number of frames.
+    """
+    import av
+
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        return sum(1 for packet in container.demux(stream) if packet.size > 0)
+
+
+def video_frame_timestamps(path: str) -> Optional[List[int]]:
+    """
+    Reads the timestamps of the frames of a video in display order, by
+    reading its packets, without decoding.
+
+    Parameters
+    ----------
+    path : str
+        The video file.
+
+    Returns
+    -------
+    Optional[List[int]]
+        The timestamps in the time base of the video stream, or None when
+        some frames have none and frames can only be found by decoding.
+    """
+    import av
+
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        timestamps = [packet.pts for packet in container.demux(stream) if packet.size > 0]
+    if any(pts is None for pts in timestamps):
+        return None
+    return sorted(timestamps)
+
+
+def run_batches(
+    wrapper: "StreamDiffusionWrapper",
+    batches: Iterable[List[np.ndarray]],
+    write: Callable[[List[np.ndarray]], None],
+    stats: Optional[VideoProcessingStats] = None,
+    skip_batches: int = 0,
+    seed: Optional[int] = None,
+    first_batch: int = 0,
+) -> None:
+    """
+    Runs batches of frames through the wrapper and hands the outputs to
+    ``write`` in input order, flushing the denoising batch at the end.
+
+    Parameters
+    ----------
+    wrapper : StreamDiffusionWrapper
+        A prepared wrapper in img2img mode with output_type "uint8".
+    batches : Iterable[List[np.ndarray]]
+        Batches of at most frame_buffer_size uint8 HWC frames. Only the last
+        one may be short, it is padded with its last frame.
+    write : Callable[[List[np.ndarray]], None]
+        Called with the outputs of each batch.
+    stats : Optional[VideoProcessingStats], optional
+        Accumulates the time spent in the model, by default None.
+    skip_batches : int, optional
+        The number of leading warm-up batches whose outputs are dropped,
+        by default 0.
+    seed : Optional[int], optional
+        If set, the generator is reseeded with ``seed`` plus the batch index
+        before every call, so each output only depends on its own input
+        and not on where processing started, by default None.
+    first_batch : int, optional
+        The index of the first batch within the video, by default 0.
+    """
+    stream = wrapper.stream
+    batch_size = wrapper.frame_buffer_size
+    delay = stream.denoising_steps_num - 1 if stream.use_denoising_batch else 0
+    batch_index = first_batch
+
+    def predict(batch: List[np.ndarray]) -> List[np.ndarray]:
+        nonlocal batch_index
+        if seed is not None:
+            stream.generator.manual_seed(seed + batch_index)
+        batch_index += 1
+        batch = batch + [batch[-1]] * (batch_size - len(batch))
+        start = time.perf_counter()
+        images = wrapper.img2img(torch.from_numpy(np.stack(batch)))
+        if stats is not None:
+            stats.model_time += time.perf_counter() - start
+        if batch_size == 1:
+            images = [images]
+        return images
+
+    # sizes of the batches still in flight inside the denoising batch, None for warm-up
+    in_flight: List[Optional[int]] = []
+    last_batch: Optional[List[np.ndarray]] = None
+    for index, batch in enumerate(batches):
+        images = predict(batch)
+        in_flight.append(len(batch) if index >= skip_batches else None)
+        if len(in_flight) > delay:
+            num_frames = in_flight.pop(0)
+            if num_frames is not None:
+                write(images[:num_frames])
+        last_batch = batch
+
+    # flush the frames still being denoised
+    while in_flight and last_batch is not None:
+        images = predict(last_batch)
+        num_frames = in_flight.pop(0)
+        if num_frames is not None:
+            write(images[:num_frames])
+
+
+def process_video(
+    wrapper: "StreamDiffusionWrapper",
+    input: str,
+    output: str,
+    prefetch: int = 4,
+    progress: Optional[ProgressCallback] = None,
+    seed: Optional[int] = None,
+) -> VideoProcessingStats:
+    """
+    Runs img2img over a video file and writes the result to another one.
+
+    Frames are decoded, denoised and encoded incrementally, so memory use
+    does not depend on the clip length. The wrapper must be in img2img mode
+    with ``output_type="uint8"``; ``frame_buffer_size`` frames go through the
+    model per call. With the denoising batch an output leaves the pipeline
+    ``len(t_index_list) - 1`` calls after its input, so the first outputs are
+    dropped and the last batch is repeated to flush the pipeline, keeping
+    output frames aligned with input frames. With the similar image filter
+    that alignment needs its "advance" skip mode, in which a skipped call
+    still finishes and returns the frame due.
+
+    Parameters
+    ----------
+    wrapper : StreamDiffusionWrapper
+        A prepared wrapper in img2img mode with output_type "uint8".
+    input : str
+        The input video file.
+    output : str
+        The output video file.
+    prefetch : int, optional
+        The number of frames decoded ahead of the model, by default 4.
+    progress : Optional[ProgressCallback], optional
+        Called with the stats after each written batch, by default None.
+    seed : Optional[int], optional
+        Reseeds the generator per batch, see run_batches. Needed to match
+        the output of process_video_sharded, by default None.
+
+    Returns
+    -------
+    VideoProcessingStats
+        The number of frames written and the throughput.
+    """
+    check_wrapper(wrapper)
+    _, _, fps, total_frames = probe_video(input)
+    stats = VideoProcessingStats(total_frames or None)
+
+    writer = VideoWriter(output, wrapper.width, wrapper.height, fps)
+    # encoding the previous batch overlaps with the model working on the next one
+    write_executor = ThreadPoolExecutor(max_workers=1)
+    pending_write: Optional[Future] = None
+
+    def write(frames: List[np.ndarray]) -> None:
+        nonlocal pending_write
+        if pending_write is not None:
+            pending_write.result()
+
+        def run() -> None:
+            for frame in frames:
+                writer.write(frame)
+            stats.frames += len(frames)
+            if progress is not None:
+                progress(stats)
+
+        pending_write = write_executor.submit(run)
+
+    try:
+        frames = _prefetch(
+            iter_video_frames(input, wrapper.width, wrapper.height), prefetch
+        )
+        run_batches(
+            wrapper,
+            iter_batches(frames, wrapper.frame_buffer_size),
+            write,
+            stats=stats,
+            seed=seed,
+        )
+        if pending_write is not None:
+            pending_write.result()
+    finally:
+        write_executor.shutdown(wait=True)
+        writer.close()
+        stats.end_time = time.perf_counter()
+
+    return stats
+
+
+def check_wrapper(wrapper: "StreamDiffusionWrapper") -> None:
+    if wrapper.mode != "img2img":
+        raise ValueError("Video processing only supports img2img mode.")
+    if wrapper.output_type != "uint8":
+        raise ValueError('Video processing needs output_type="uint8".')
@@ -1,8 +1,10 @@
 import gc
 import os
-from pathlib import Path
 import traceback
-from typing import List, Literal, Optional, Union, Dict
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Literal, Optional, Tuple, Union
+
 
 # 设置 Hugging Face 镜像源为国内镜像
 # 使用环境变量 HF_ENDPOINT 设置镜像地址
@@ -18,7 +20,12 @@ from diffusers import AutoencoderTiny, StableDiffusionPipeline
 from PIL import Image
 
 from streamdiffusion import StreamDiffusion
+from streamdiffusion.image_filter import SkipPolicy
 from streamdiffusion.image_utils import postprocess_image
+from streamdiffusion.metrics import MetricsRegistry
+from streamdiffusion.stream_state import StreamState
+from streamdiffusion.tracing import Tracer, traced
+from utils.stream_pipeline import StagedStream
 
 
 torch.set_grad_enabled(False)
@@ -33,7 +40,7 @@ class StreamDiffusionWrapper:
         t_index_list: List[int],
         lora_dict: Optional[Dict[str, float]] = None,
         mode: Literal["img2img", "txt2img"] = "img2img",
-        output_type: Literal["pil", "pt", "np", "latent"] = "pil",
+        output_type: Literal["pil", "pt", "np", "uint8", "latent"] = "pil",
         lcm_lora_id: Optional[str] = None,
         vae_id: Optional[str] = None,
         device: Literal["cpu", "cuda"] = "cuda",
@@ -50,11 +57,16 @@ class StreamDiffusionWrapper:
         enable_similar_image_filter: bool = False,
         similar_image_filter_threshold: float = 0.98,
         similar_image_filter_max_skip_frame: int = 10,
+        similar_image_filter_mode: Literal["full", "thumbnail"] = "full",
+        similar_image_filter_policy: Optional[Union[str, SkipPolicy]] = None,
+        similar_image_filter_policy_kwargs: Optional[Dict[str, Any]] = None,
+        similar_image_filter_skip_mode: Literal["sleep", "return", "advance"] = "sleep",
         use_denoising_batch: bool = True,
         cfg_type: Literal["none", "full", "self", "initialize"] = "self",
         seed: int = 2,
         use_safety_checker: bool = False,
         engine_dir: Optional[Union[str, Path]] = "engines",
+        resolution_buckets: Optional[List[Tuple[int, int]]] = None,
     ):
         """
         Initializes the StreamDiffusionWrapper.
@@ -71,8 +83,9 @@ class StreamDiffusionWrapper:
             Example: {'LoRA_1' : 0.5 , 'LoRA_2' : 0.7 ,...}
         mode : Literal["img2img", "txt2img"], optional
             txt2img or img2img, by default "img2img".
-        output_type : Literal["pil", "pt", "np", "latent"], optional
+        output_type : Literal["pil", "pt", "np", "uint8", "latent"], optional
             The output type of image, by default "pil".
+            "uint8" returns HWC uint8 numpy arrays.
         lcm_lora_id : Optional[str], optional
             The lcm_lora_id to load, by default None.
             If None, the default LCM-LoRA
@@ -111,6 +124,20 @@ class StreamDiffusionWrapper:
             The threshold for similar image filter, by default 0.98.
         similar_image_filter_max_skip_frame : int, optional
             The max skip frame for similar image filter, by default 10.
+        similar_image_filter_mode : Literal["full", "thumbnail"], optional
+            Whether the similar image filter compares full frames or
+            small luma thumbnails, by default "full".
+        similar_image_filter_policy : Optional[Union[str, SkipPolicy]], optional
+            The skip policy of the similar image filter, e.g. "hysteresis"
+            or a seeded StochasticSkipPolicy, by default the stochastic one.
+        similar_image_filter_policy_kwargs : Optional[Dict[str, Any]], optional
+            The arguments of a policy given by name, e.g.
+            {"target_fps": 15} for "target_fps", by default None.
+        similar_image_filter_skip_mode : Literal["sleep", "return", "advance"], optional
+            What happens to a skipped frame: "sleep" paces the call like an
+            inference, "return" returns the previous output immediately and
+            "advance" steps the in-flight latents and returns the output they
+            finish, by default "sleep".
         use_denoising_batch : bool, optional
             Whether to use denoising batch or not, by default True.
         cfg_type : Literal["none", "full", "self", "initialize"],
@@ -121,6 +148,14 @@ class StreamDiffusionWrapper:
             The seed, by default 2.
         use_safety_checker : bool, optional
             Whether to use safety checker or not, by default False.
+        engine_dir : Optional[Union[str, Path]], optional
+            The directory of the TensorRT engine cache, by default "engines".
+        resolution_buckets : Optional[List[Tuple[int, int]]], optional
+            (width, height) buckets the TensorRT engines are built for, one
+            optimization profile each. The stream runs its models at the
+            smallest bucket containing width x height, padding and cropping
+            at runtime, so streams of different resolutions share one set of
+            engines. By default None, engines for width x height only.
         """
         self.sd_turbo = "turbo" in model_id_or_path
 
@@ -156,6 +191,9 @@ class StreamDiffusionWrapper:
 
         self.use_denoising_batch = use_denoising_batch
         self.use_safety_checker = use_safety_checker
+        self._padding_states: List[StreamState] = []
+        self._last_image = None
+        self._last_image_tensor = None
 
         self.stream: StreamDiffusion = self._load_model(
             model_id_or_path=model_id_or_path,
@@ -171,6 +209,7 @@ class StreamDiffusionWrapper:
             cfg_type=cfg_type,
             seed=seed,
             engine_dir=engine_dir,
+            resolution_buckets=resolution_buckets,
         )
 
         if device_ids is not None:
@@ -179,7 +218,14 @@ class StreamDiffusionWrapper:
             )
 
         if enable_similar_image_filter:
-            self.stream.enable_similar_image_filter(similar_image_filter_threshold, similar_image_filter_max_skip_frame)
+            self.stream.enable_similar_image_filter(
+                similar_image_filter_threshold,
+                similar_image_filter_max_skip_frame,
+                similar_image_filter_mode,
+                similar_image_filter_policy,
+                similar_image_filter_skip_mode,
+                similar_image_filter_policy_kwargs,
+            )
 
     def prepare(
         self,
@@ -212,6 +258,18 @@ class StreamDiffusionWrapper:
             delta=delta,
         )
 
+    def set_timesteps(self, t_index_list: List[int]) -> None:
+        """
+        Changes the t_index_list at runtime, keeping the loaded models.
+
+        Parameters
+        ----------
+        t_index_list : List[int]
+            The new t_index_list to use for inference.
+        """
+        self.stream.set_timesteps(t_index_list)
+        self.batch_size = self.stream.batch_size
+
     def __call__(
         self,
         image: Optional[Union[str, Image.Image, torch.Tensor]] = None,
@@ -262,17 +320,7 @@ class StreamDiffusionWrapper:
             image_tensor = self.stream.txt2img(self.frame_buffer_size)
         image = self.postprocess_image(image_tensor, output_type=self.output_type)
 
-        if self.use_safety_checker:
-            safety_checker_input = self.feature_extractor(
-                image, return_tensors="pt"
-            ).to(self.device)
-            _, has_nsfw_concept = self.safety_checker(
-                images=image_tensor.to(self.dtype),
-                clip_input=safety_checker_input.pixel_values.to(self.dtype),
-            )
-            image = self.nsfw_fallback_img if has_nsfw_concept[0] else image
-
-        return image
+        return self.apply_safety_checker(image, image_tensor)
 
     def img2img(
         self, image: Union[str, Image.Image, torch.Tensor], prompt: Optional[str] = None
@@ -293,24 +341,244 @@ class StreamDiffusionWrapper:
         if prompt is not None:
             self.stream.update_prompt(prompt)
 
-        if isinstance(image, str) or isinstance(image, Image.Image):
+        if self._needs_preprocess(image):
             image = self.preprocess_image(image)
 
         image_tensor = self.stream(image)
+        if image_tensor is self._last_image_tensor and self._last_image is not None:
+            # the stream repeated the previous output, which is already postprocessed
+            return self._last_image
         image = self.postprocess_image(image_tensor, output_type=self.output_type)
 
-        if self.use_safety_checker:
+        self._last_image_tensor = image_tensor
+        self._last_image = self.apply_safety_checker(image, image_tensor)
+        return self._last_image
+
+    @property
+    def last_skipped(self) -> bool:
+        """
+        Whether the similar image filter skipped the last img2img frame, in
+        which case the previous output was returned, or with skip mode
+        "advance" the output of the earlier frame the skipped call finished.
+
+        Returns
+        -------
+        bool
+            True if the last frame was skipped.
+        """
+        return self.stream.last_skipped
+
+    def process(
+        self,
+        frames: Iterable[Union[str, Image.Image, torch.Tensor]],
+        queue_size: int = 2,
+    ) -> StagedStream:
+        """
+        Performs img2img over a sequence of frames with preprocessing, the
+        model and postprocessing running as overlapping stages.
+
+        Parameters
+        ----------
+        frames : Iterable[Union[str, Image.Image, torch.Tensor]]
+            The frames to generate from.
+        queue_size : int, optional
+            The number of frames each stage may run ahead, by default 2.
+
+        Returns
+        -------
+        StagedStream
+            An iterator and async iterator over the generated images, in
+            input order. Use it with ``with`` or ``async with`` so its
+            threads are stopped when the loop ends early.
+        """
+        return StagedStream(self, frames, queue_size=queue_size)
+
+    @traced("apply_safety_checker")
+    def apply_safety_checker(
+        self,
+        image: Union[Image.Image, List[Image.Image], torch.Tensor, np.ndarray],
+        image_tensor: torch.Tensor,
+    ) -> Union[Image.Image, List[Image.Image], torch.Tensor, np.ndarray]:
+        """
+        Replaces the image with a black image if the safety checker flags it.
+
+        Parameters
+        ----------
+        image : Union[Image.Image, List[Image.Image], torch.Tensor, np.ndarray]
+            The postprocessed image.
+        image_tensor : torch.Tensor
+            The image tensor the image was postprocessed from.
+
+        Returns
+        -------
+        Union[Image.Image, List[Image.Image], torch.Tensor, np.ndarray]
+            The image, or the fallback image if it was flagged.
+        """
+        if not self.use_safety_checker:
+            return image
+
+        with self.stream.metrics.time_stage("safety_checker"):
             safety_checker_input = self.feature_extractor(
                 image, return_tensors="pt"
             ).to(self.device)
             _, has_nsfw_concept = self.safety_checker(
-                images=image_tensor.to(self.dtype),
+                images=image_tensor.to(device=self.device, dtype=self.dtype),
                 clip_input=safety_checker_input.pixel_values.to(self.dtype),
             )
-            image = self.nsfw_fallback_img if has_nsfw_concept[0] else image
+        return self.nsfw_fallback_img if has_nsfw_concept[0] else image
+
+    @property
+    def metrics(self) -> MetricsRegistry:
+        """
+        The metrics registry of the underlying StreamDiffusion pipeline.
 
-        return image
+        Returns
+        -------
+        MetricsRegistry
+            Stage durations, skipped frames, prompt encodes and memory usage.
+        """
+        return self.stream.metrics
 
+    @property
+    def tracer(self) -> Tracer:
+        """
+        The tracer marking the pipeline stages, shared with StreamDiffusion.
+
+        Returns
+        -------
+        Tracer
+            The tracer, a no-op unless one was bound.
+        """
+        return self.stream.tracer
+
+    def set_tracer(self, tracer: Tracer) -> None:
+        """
+        Binds a tracer to the pipeline stages at runtime.
+
+        Parameters
+        ----------
+        tracer : Tracer
+            The tracer to use, e.g. from ``create_tracer("chrome", path=...)``.
+        """
+        self.stream.set_tracer(tracer)
+
+    def render_metrics(self) -> str:
+        """
+        Renders the metrics in the Prometheus text exposition format.
+
+        Returns
+        -------
+        str
+            The metrics, ready to be served on a /metrics endpoint.
+        """
+        return self.stream.metrics.render()
+
+    def create_state(self, prompt: Optional[str] = None) -> StreamState:
+        """
+        Creates the per-session state used by img2img_batch.
+
+        Parameters
+        ----------
+        prompt : Optional[str]
+            The prompt of the session, by default the current prompt.
+
+        Returns
+        -------
+        StreamState
+            An empty session state.
+        """
+        return self.stream.create_state(prompt)
+
+    @torch.no_grad()
+    def img2img_batch(
+        self,
+        images: List[Union[str, Image.Image, torch.Tensor]],
+        states: List[StreamState],
+    ) -> List[Union[Image.Image, torch.Tensor, np.ndarray]]:
+        """
+        Performs img2img for several independent sessions in one batched call.
+
+        Each session occupies one lane of the denoising batch and keeps its
+        in-flight latents and prompt in its own state, so sessions can join
+        and leave between calls. The batch always has ``frame_buffer_size``
+        lanes, the ones without a session are padded, so the latent buffers
+        and TensorRT engines keep their shapes as sessions come and go.
+
+        Parameters
+        ----------
+        images : List[Union[str, Image.Image, torch.Tensor]]
+            One input image per session.
+        states : List[StreamState]
+            One state per session, created with create_state.
+
+        Returns
+        -------
+        List[Union[Image.Image, torch.Tensor, np.ndarray]]
+            One generated image per session.
+        """
+        if len(images) != len(states):
+            raise ValueError("img2img_batch needs one state per image.")
+        num_sessions = len(states)
+        if num_sessions > self.frame_buffer_size:
+            raise ValueError(
+                f"img2img_batch supports at most frame_buffer_size={self.frame_buffer_size} sessions."
+            )
+
+        images = [
+            self.preprocess_image(image)
+            if self._needs_preprocess(image)
+            else image
+            for image in images
+        ]
+        # unused lanes are padded so the batch keeps the size its buffers were allocated for
+        num_padding = self.frame_buffer_size - num_sessions
+        if len(self._padding_states) < num_padding:
+            self._padding_states += [
+                self.stream.create_state()
+                for _ in range(num_padding - len(self._padding_states))
+            ]
+        states = states + self._padding_states[:num_padding]
+        images = images + [images[-1]] * num_padding
+
+        self.stream.set_lane_prompts(
+            [self.stream.prompt if state.prompt is None else state.prompt for state in states]
+        )
+        self.stream.load_states(states)
+        image_tensor = self.stream(torch.cat(images, dim=0))
+        self.stream.save_states(states)
+
+        image_tensor = image_tensor[:num_sessions]
+        if self.frame_buffer_size > 1:
+            images = self.postprocess_image(image_tensor, output_type=self.output_type)
+        else:
+            images = [self.postprocess_image(image_tensor, output_type=self.output_type)]
+
+        if self.use_safety_checker:
+            with self.stream.metrics.time_stage("safety_checker"):
+                safety_checker_input = self.feature_extractor(
+                    images, return_tensors="pt"
+                ).to(self.device)
+                _, has_nsfw_concept = self.safety_checker(
+                    images=image_tensor.to(device=self.device, dtype=self.dtype),
+                    clip_input=safety_checker_input.pixel_values.to(self.dtype),
+                )
+            images = [
+                self.nsfw_fallback_img if nsfw else image
+                for image, nsfw in zip(images, has_nsfw_concept)
+            ]
+
+        return images
+
+    def _needs_preprocess(
+        self, image: Union[str, Image.Image, torch.Tensor]
+    ) -> bool:
+        return (
+            isinstance(image, str)
+            or isinstance(image, Image.Image)
+            or image.dtype == torch.uint8
+        )
+
+    @traced("preprocess_image")
     def preprocess_image(self, image: Union[str, Image.Image]) -> torch.Tensor:
         """
         Preprocesses the image.
@@ -318,22 +586,35 @@ class StreamDiffusionWrapper:
         Parameters
         ----------
         image : Union[str, Image.Image, torch.Tensor]
-            The image to preprocess.
+            The image to preprocess. uint8 tensors are taken as HWC or NHWC
+            RGB pixels and are normalized without going through PIL.
 
         Returns
         -------
         torch.Tensor
             The preprocessed image.
         """
-        if isinstance(image, str):
-            image = Image.open(image).convert("RGB").resize((self.width, self.height))
-        if isinstance(image, Image.Image):
-            image = image.convert("RGB").resize((self.width, self.height))
-
-        return self.stream.image_processor.preprocess(
-            image, self.height, self.width
-        ).to(device=self.device, dtype=self.dtype)
+        with self.stream.metrics.time_stage("preprocess"):
+            if isinstance(image, torch.Tensor) and image.dtype == torch.uint8:
+                if image.ndim == 3:
+                    image = image[None]
+                image = image.to(device=self.device, non_blocking=True).permute(0, 3, 1, 2)
+                image = image.to(dtype=self.dtype).div_(127.5).sub_(1)
+                if image.shape[-2:] != (self.height, self.width):
+                    image = torch.nn.functional.interpolate(
+                        image, size=(self.height, self.width), mode="bilinear", antialias=True
+                    )
+                return image
+            if isinstance(image, str):
+                image = Image.open(image).convert("RGB").resize((self.width, self.height))
+            if isinstance(image, Image.Image):
+                image = image.convert("RGB").resize((self.width, self.height))
+
+            return self.stream.image_processor.preprocess(
+                image, self.height, self.width
+            ).to(device=self.device, dtype=self.dtype)
 
+    @traced("postprocess_image")
     def postprocess_image(
         self, image_tensor: torch.Tensor, output_type: str = "pil"
     ) -> Union[Image.Image, List[Image.Image], torch.Tensor, np.ndarray]:
@@ -350,16 +631,21 @@ class StreamDiffusionWrapper:
         Union[Image.Image, List[Image.Image]]
             The postprocessed image.
         """
-        # Convert float16 to float32 before moving to CPU, as CPU doesn't support
-        # some operations (like clamp) on float16
-        if image_tensor.dtype == torch.float16:
-            image_tensor = image_tensor.float()
-        image_tensor_cpu = image_tensor.cpu()
-        
+        with self.stream.metrics.time_stage("postprocess"):
+            if output_type in ("pil", "uint8"):
+                # converted to uint8 on the device, so only the final pixels are copied to the CPU
+                images = postprocess_image(image_tensor, output_type=output_type)
+            else:
+                # Convert float16 to float32 before moving to CPU, as CPU doesn't support
+                # some operations (like clamp) on float16
+                if image_tensor.dtype == torch.float16:
+                    image_tensor = image_tensor.float()
+                images = postprocess_image(image_tensor.cpu(), output_type=output_type)
+
         if self.frame_buffer_size > 1:
-            return postprocess_image(image_tensor_cpu, output_type=output_type)
+            return images
         else:
-            return postprocess_image(image_tensor_cpu, output_type=output_type)[0]
+            return images[0]
 
     def _load_model(
         self,
@@ -376,6 +662,7 @@ class StreamDiffusionWrapper:
         cfg_type: Literal["none", "full", "self", "initialize"] = "self",
         seed: int = 2,
         engine_dir: Optional[Union[str, Path]] = "engines",
+        resolution_buckets: Optional[List[Tuple[int, int]]] = None,
     ) -> StreamDiffusion:
         """
         Loads the model.
@@ -420,6 +707,11 @@ class StreamDiffusionWrapper:
             You cannot use anything other than "none" for txt2img mode.
         seed : int, optional
             The seed, by default 2.
+        engine_dir : Optional[Union[str, Path]], optional
+            The directory of the TensorRT engine cache, by default "engines".
+        resolution_buckets : Optional[List[Tuple[int, int]]], optional
+            The (width, height) buckets to build the TensorRT engines for,
+            by default None.
 
         Returns
         -------
@@ -493,137 +785,120 @@ class StreamDiffusionWrapper:
                     dummy = torch.randn(1, device="cuda")
                     del dummy
                     torch.cuda.synchronize()
-                
+
                 from polygraphy import cuda
+
+                from streamdiffusion.acceleration.engine_cache import (
+                    EngineCache,
+                    engine_key,
+                    fingerprint_weights,
+                    hash_weights,
+                    toolchain_versions,
+                )
+                from streamdiffusion.acceleration.engine_plan import (
+                    DeploymentProfile,
+                )
                 from streamdiffusion.acceleration.tensorrt import (
-                    TorchVAEEncoder,
-                    compile_unet,
-                    compile_vae_decoder,
-                    compile_vae_encoder,
+                    engine_build_key_options,
+                    plan_engines,
                 )
                 from streamdiffusion.acceleration.tensorrt.engine import (
                     AutoencoderKLEngine,
                     UNet2DConditionModelEngine,
                 )
-                from streamdiffusion.acceleration.tensorrt.models import (
-                    VAE,
-                    UNet,
-                    VAEEncoder,
-                )
 
-                def create_prefix(
-                    model_id_or_path: str,
-                    max_batch_size: int,
-                    min_batch_size: int,
-                ):
-                    maybe_path = Path(model_id_or_path)
-                    if maybe_path.exists():
-                        return f"{maybe_path.stem}--lcm_lora-{use_lcm_lora}--tiny_vae-{use_tiny_vae}--max_batch-{max_batch_size}--min_batch-{min_batch_size}--mode-{self.mode}"
-                    else:
-                        return f"{model_id_or_path}--lcm_lora-{use_lcm_lora}--tiny_vae-{use_tiny_vae}--max_batch-{max_batch_size}--min_batch-{min_batch_size}--mode-{self.mode}"
-
-                engine_dir = Path(engine_dir)
-                unet_path = os.path.join(
-                    engine_dir,
-                    create_prefix(
-                        model_id_or_path=model_id_or_path,
-                        max_batch_size=stream.trt_unet_batch_size,
-                        min_batch_size=stream.trt_unet_batch_size,
-                    ),
-                    "unet.engine",
-                )
-                vae_encoder_path = os.path.join(
-                    engine_dir,
-                    create_prefix(
-                        model_id_or_path=model_id_or_path,
-                        max_batch_size=self.batch_size
-                        if self.mode == "txt2img"
-                        else stream.frame_bff_size,
-                        min_batch_size=self.batch_size
-                        if self.mode == "txt2img"
-                        else stream.frame_bff_size,
-                    ),
-                    "vae_encoder.engine",
-                )
-                vae_decoder_path = os.path.join(
-                    engine_dir,
-                    create_prefix(
-                        model_id_or_path=model_id_or_path,
-                        max_batch_size=self.batch_size
-                        if self.mode == "txt2img"
-                        else stream.frame_bff_size,
-                        min_batch_size=self.batch_size
-                        if self.mode == "txt2img"
-                        else stream.frame_bff_size,
-                    ),
-                    "vae_decoder.engine",
+                engine_cache = EngineCache(str(engine_dir))
+                toolchain = toolchain_versions()
+                if resolution_buckets:
+                    # fail before building if the stream fits no bucket
+                    stream.set_resolution_buckets(resolution_buckets)
+                profile = DeploymentProfile.from_stream(
+                    stream, mode=self.mode, resolutions=resolution_buckets
                 )
-
-                if not os.path.exists(unet_path):
-                    os.makedirs(os.path.dirname(unet_path), exist_ok=True)
-                    unet_model = UNet(
-                        fp16=True,
-                        device=stream.device,
-                        max_batch_size=stream.trt_unet_batch_size,
-                        min_batch_size=stream.trt_unet_batch_size,
-                        embedding_dim=stream.text_encoder.config.hidden_size,
-                        unet_dim=stream.unet.config.in_channels,
+                engine_build_options = {}
+                build_key_options = engine_build_key_options(engine_build_options)
+                embedding_dim = stream.text_encoder.config.hidden_size
+
+                # the weights are hashed once per checkpoint, LoRA set and dtype
+                unet_sources = {
+                    "model": str(model_id_or_path),
+                    "lcm_lora": [use_lcm_lora and not self.sd_turbo, lcm_lora_id],
+                    "lora_dict": None if self.sd_turbo else lora_dict,
+                    "dtype": str(self.dtype),
+                }
+                vae_sources = {
+                    "model": str(model_id_or_path),
+                    "tiny_vae": [use_tiny_vae, vae_id],
+                    "dtype": str(self.dtype),
+                }
+                weights_hashes = {
+                    "unet": engine_cache.weights_hash(
+                        fingerprint_weights(unet_sources),
+                        lambda: hash_weights(stream.unet.state_dict()),
                     )
-                    compile_unet(
-                        stream.unet,
-                        unet_model,
-                        unet_path + ".onnx",
-                        unet_path + ".opt.onnx",
-                        unet_path,
-                        opt_batch_size=stream.trt_unet_batch_size,
+                }
+                weights_hashes["vae_decoder"] = weights_hashes["vae_encoder"] = (
+                    engine_cache.weights_hash(
+                        fingerprint_weights(vae_sources),
+                        lambda: hash_weights(stream.vae.state_dict()),
                     )
+                )
 
-                if not os.path.exists(vae_decoder_path):
-                    os.makedirs(os.path.dirname(vae_decoder_path), exist_ok=True)
-                    stream.vae.forward = stream.vae.decode
-                    vae_decoder_model = VAE(
-                        device=stream.device,
-                        max_batch_size=self.batch_size
-                        if self.mode == "txt2img"
-                        else stream.frame_bff_size,
-                        min_batch_size=self.batch_size
-                        if self.mode == "txt2img"
-                        else stream.frame_bff_size,
-                    )
-                    compile_vae_decoder(
-                        stream.vae,
-                        vae_decoder_model,
-                        vae_decoder_path + ".onnx",
-                        vae_decoder_path + ".opt.onnx",
-                        vae_decoder_path,
-                        opt_batch_size=self.batch_size
-                        if self.mode == "txt2img"
-                        else stream.frame_bff_size,
-                    )
-                    delattr(stream.vae, "forward")
-
-                if not os.path.exists(vae_encoder_path):
-                    os.makedirs(os.path.dirname(vae_encoder_path), exist_ok=True)
-                    vae_encoder = TorchVAEEncoder(stream.vae).to(torch.device("cuda"))
-                    vae_encoder_model = VAEEncoder(
-                        device=stream.device,
-                        max_batch_size=self.batch_size
-                        if self.mode == "txt2img"
-                        else stream.frame_bff_size,
-                        min_batch_size=self.batch_size
-                        if self.mode == "txt2img"
-                        else stream.frame_bff_size,
-                    )
-                    compile_vae_encoder(
-                        vae_encoder,
-                        vae_encoder_model,
-                        vae_encoder_path + ".onnx",
-                        vae_encoder_path + ".opt.onnx",
-                        vae_encoder_path,
-                        opt_batch_size=self.batch_size
-                        if self.mode == "txt2img"
-                        else stream.frame_bff_size,
+                # engines are keyed by the fused weights, profile, options and toolchain
+                engine_paths = {}
+                missing_engines = {}
+                for name, weights_hash in weights_hashes.items():
+                    engine_profile = profile.to_dict()
+                    if name == "unet":
+                        engine_profile["embedding_dim"] = embedding_dim
+                        engine_profile["unet_dim"] = stream.unet.config.in_channels
+                        # engines exported with float32 latents cannot bind the pipeline's latents
+                        engine_profile["sample_dtype"] = "float16"
+                    key = engine_key(
+                        name, weights_hash, engine_profile, build_key_options, toolchain
                     )
+                    path = engine_cache.lookup(key)
+                    if path is None:
+                        path = engine_cache.path_for(key, name)
+                        missing_engines[name] = (key, engine_profile)
+                    engine_paths[name] = os.path.join(path, f"{name}.engine")
+
+                if missing_engines:
+                    with ExitStack() as build_locks:
+                        for name in sorted(missing_engines):
+                            key = missing_engines[name][0]
+                            build_locks.enter_context(engine_cache.lock_key(key, name))
+                            # another process may have built it while we waited
+                            if engine_cache.lookup(key) is not None:
+                                del missing_engines[name]
+                        if missing_engines:
+                            plan = plan_engines(
+                                {name: engine_paths[name] for name in missing_engines},
+                                profile,
+                                unet=stream.unet,
+                                vae=stream.vae,
+                                embedding_dim=embedding_dim,
+                                device=torch.device("cuda"),
+                                engine_build_options=engine_build_options,
+                            )
+                            plan.execute(max_workers=2)
+                        for name, (key, engine_profile) in missing_engines.items():
+                            engine_cache.register(
+                                key,
+                                name,
+                                [f"{name}.engine"],
+                                metadata={
+                                    "model_id_or_path": str(model_id_or_path),
+                                    "lora_dict": lora_dict,
+                                    "lcm_lora_id": lcm_lora_id if use_lcm_lora else None,
+                                    "vae_id": vae_id if use_tiny_vae else None,
+                                    "profile": engine_profile,
+                                    "toolchain": toolchain,
+                                },
+                            )
+                unet_path = engine_paths["unet"]
+                vae_decoder_path = engine_paths["vae_decoder"]
+                vae_encoder_path = engine_paths["vae_encoder"]
 
                 cuda_stream = cuda.Stream()
 
@@ -657,6 +932,8 @@ class StreamDiffusionWrapper:
         except Exception:
             traceback.print_exc()
             print("Acceleration has failed. Falling back to normal mode.")
+            # the torch models run at any resolution, padding would only cost time
+            stream.set_resolution_buckets(None)
 
         if seed < 0: # Random seed
             seed = np.random.randint(0, 1000000)
@@ -673,10 +950,10 @@ class StreamDiffusionWrapper:
         )
 
         if self.use_safety_checker:
-            from transformers import CLIPFeatureExtractor
             from diffusers.pipelines.stable_diffusion.safety_checker import (
                 StableDiffusionSafetyChecker,
             )
+            from transformers import CLIPFeatureExtractor
 
             self.safety_checker = StableDiffusionSafetyChecker.from_pretrained(
                 "CompVis/stable-diffusion-safety-checker"